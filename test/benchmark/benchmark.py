@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+"""
+   Benchmarks for zfsbackup.py that don't need a pool.
+
+   Fake zfs, ssh and compressors (see bin/) are put first on PATH. The fake
+   zfs keeps its datasets in a json file and sends and receives synthetic
+   streams, the fake ssh runs the "remote" command locally. Every fake
+   process logs what it did, which is where the spawn counts and per stage
+   cpu time come from. zfsbackup itself runs in this process.
+
+   usage: python3 test/benchmark/benchmark.py [scenario ...] [options]
+   scenarios: send, clean, run (default: all of them)
+"""
+import argparse
+import collections
+import fcntl
+import json
+import logging
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(os.path.dirname(HERE)))
+import zfsbackup  # noqa: E402
+
+SCENARIOS = ('send', 'clean', 'run')
+
+
+class Bench:
+    """One scenario: a fresh fake pool, the environment pointing at it and
+       the numbers collected while it ran"""
+
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+        self.dir = tempfile.mkdtemp(prefix='zfsbackup-bench-')
+        self.state_path = os.path.join(self.dir, 'state.json')
+        self.log_path = os.path.join(self.dir, 'fake.log')
+        self.state = {'txg': 1, 'datasets': {}}
+        self.env = {'PATH': os.path.join(HERE, 'bin') + os.pathsep
+                    + os.environ.get('PATH', ''),
+                    'FAKE_ZFS_STATE': self.state_path,
+                    'FAKE_LOG': self.log_path,
+                    'FAKE_SSH_HANDSHAKE': str(args.ssh_handshake)}
+        if args.rate:
+            self.env['FAKE_ZFS_SEND_RATE'] = str(args.rate)
+        self.saved_env = {}
+
+    def add_dataset(self, name, referenced=0, snapshots=0, dirty=0):
+        self.state['txg'] += 1
+        snaps = collections.OrderedDict()
+        for i in range(snapshots):
+            self.state['txg'] += 1
+            snaps['bench-%06d' % i] = {
+                'guid': str(int.from_bytes(os.urandom(8), 'big')),
+                'createtxg': self.state['txg'],
+                'creation': int(time.time()) - snapshots + i,
+                'written': dirty}
+        self.state['datasets'][name] = {
+            'guid': str(int.from_bytes(os.urandom(8), 'big')),
+            'createtxg': self.state['txg'], 'creation': int(time.time()),
+            'snapshots': snaps, 'bookmarks': {},
+            'props': {'referenced': referenced, 'dirty': dirty,
+                      'compressratio': 1.0}}
+
+    def write(self, dataset, nbytes):
+        """Pretend nbytes were written to dataset while the scenario runs"""
+        with open(self.state_path + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            with open(self.state_path) as f:
+                state = json.load(f)
+            state['datasets'][dataset]['props']['dirty'] += nbytes
+            with open(self.state_path + '.tmp', 'w') as f:
+                json.dump(state, f)
+            os.rename(self.state_path + '.tmp', self.state_path)
+
+    def __enter__(self):
+        with open(self.state_path, 'w') as f:
+            json.dump(self.state, f)
+        for k, v in self.env.items():
+            self.saved_env[k] = os.environ.get(k)
+            os.environ[k] = v
+        self.usage = resource.getrusage(resource.RUSAGE_SELF)
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, *exc):
+        self.wall = time.monotonic() - self.start
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        self.cpu = (usage.ru_utime - self.usage.ru_utime
+                    + usage.ru_stime - self.usage.ru_stime)
+        zfsbackup.ssh_pool.close_all()
+        zfsbackup.ssh_pool = zfsbackup.SSHConnectionPool()
+        zfsbackup.clear_inventory()
+        for k, v in self.saved_env.items():
+            if v is None:
+                os.environ.pop(k, None)
+            else:
+                os.environ[k] = v
+        self.results = self.collect()
+        shutil.rmtree(self.dir, ignore_errors=True)
+        return False
+
+    def collect(self):
+        """Turn the fake tools' log into per stage numbers"""
+        stages = collections.OrderedDict()
+        received = 0
+        try:
+            with open(self.log_path) as f:
+                records = [json.loads(line) for line in f]
+        except FileNotFoundError:
+            records = []
+        for r in sorted(records, key=lambda r: (r['prog'], r['sub'])):
+            stage = stages.setdefault(r['prog']+' '+r['sub'],
+                                      {'spawns': 0, 'cpu': 0.0, 'bytes': 0,
+                                       'failed': 0})
+            stage['spawns'] += 1
+            stage['cpu'] += r['cpu']
+            stage['bytes'] += r['bytes']
+            stage['failed'] += 1 if r['status'] else 0
+            if r['prog'] == 'zfs' and r['sub'] == 'recv':
+                received += r['bytes']
+        return {'scenario': self.name, 'wall': self.wall,
+                'zfsbackup_cpu': self.cpu, 'received': received,
+                'throughput': received / self.wall if self.wall else 0,
+                'spawns': sum(s['spawns'] for s in stages.values()),
+                'stages': stages}
+
+
+def destinations(count, name):
+    """Alternate local and ssh destinations"""
+    dests = []
+    for i in range(count):
+        if i % 2:
+            dests.append({'dest': 'remote/'+name+'-'+str(i),
+                          'transport': 'ssh:bench@localhost'})
+        else:
+            dests.append({'dest': 'backup/'+name+'-'+str(i),
+                          'transport': 'local'})
+    return dests
+
+
+def bench_send(args):
+    """One big stream to every destination, then an incremental on top"""
+    bench = Bench('send', args)
+    bench.add_dataset('pool/big', referenced=args.size, snapshots=1,
+                      dirty=args.size // 10)
+    for pool in ('backup', 'remote'):
+        bench.add_dataset(pool)
+    dests = destinations(args.destinations, 'big')
+    with bench:
+        zfsbackup.create_snapshot('pool/big', 'bench-full')
+        zfsbackup.send_snapshot_multi('pool/big@bench-full', dests)
+        zfsbackup.create_snapshot('pool/big', 'bench-incr')
+        zfsbackup.send_snapshot_multi('pool/big@bench-incr', dests,
+                                      incremental_source='pool/big@bench-full')
+    return bench.results
+
+
+def bench_clean(args):
+    """Prune destinations holding lots of backup snapshots"""
+    bench = Bench('clean', args)
+    dests = destinations(args.destinations, 'many')
+    for d in dests:
+        bench.add_dataset(d['dest'], referenced=0,
+                          snapshots=args.snapshots)
+        # named like real ones so the retention logic picks them up
+        snaps = bench.state['datasets'][d['dest']]['snapshots']
+        renamed = collections.OrderedDict()
+        start = time.time() - 60 * len(snaps)
+        for i, (name, snap) in enumerate(snaps.items()):
+            stamp = datetime.fromtimestamp(start + 60 * i)
+            renamed[stamp.strftime('zfsbackup-%Y%m%d-%H%M%S')] = snap
+        bench.state['datasets'][d['dest']]['snapshots'] = renamed
+        d['retain_snaps'] = args.retain
+    with bench:
+        zfsbackup.clean_dest_snaps(dests)
+    return bench.results
+
+
+def bench_run(args):
+    """A whole config run, twice: full sends, then incrementals of the
+       datasets that changed"""
+    bench = Bench('run', args)
+    datasets = []
+    for i in range(args.datasets):
+        name = 'pool/ds%04d' % i
+        bench.add_dataset(name, referenced=args.dataset_size,
+                          snapshots=args.snapshots,
+                          dirty=args.dataset_size // 10)
+        datasets.append({'dataset_name': name,
+                         'destinations': destinations(args.destinations,
+                                                      'ds%04d' % i)})
+    for pool in ('backup', 'remote'):
+        bench.add_dataset(pool)
+    config = os.path.join(bench.dir, 'config.yml')
+    conf = {'lock_file': os.path.join(bench.dir, 'zfsbackup.lock'),
+            'retain_snaps': args.retain, 'max_workers': args.jobs,
+            'datasets': datasets}
+    with open(config, 'w') as f:
+        json.dump(conf, f)
+    os.chmod(config, 0o600)
+    level = logging.getLogger().level
+    argv = sys.argv
+    sys.argv = ['zfsbackup.py', '-c', config]
+    try:
+        with bench:
+            for attempt in range(2):
+                if zfsbackup.main() != 0:
+                    raise RuntimeError('config run failed, see the log')
+                changed = int(len(datasets) * args.changed)
+                for ds in datasets[:changed]:
+                    bench.write(ds['dataset_name'], args.dataset_size // 10)
+                # the backup lands after the timestamp snapshot, make sure
+                # the next one gets a different name
+                time.sleep(1)
+    finally:
+        sys.argv = argv
+        logging.getLogger().setLevel(level)
+    return bench.results
+
+
+def report(results, out):
+    for r in results:
+        out.write('== %s: %.2fs wall, %s received, %s/s, %d spawns, '
+                  '%.2fs zfsbackup cpu\n'
+                  % (r['scenario'], r['wall'],
+                     zfsbackup.__dict__['__human_bytes'](r['received']),
+                     zfsbackup.__dict__['__human_bytes'](r['throughput']),
+                     r['spawns'], r['zfsbackup_cpu']))
+        out.write('   %-20s %8s %10s %12s %7s\n'
+                  % ('stage', 'spawns', 'cpu (s)', 'bytes', 'failed'))
+        for name, s in r['stages'].items():
+            out.write('   %-20s %8d %10.2f %12d %7d\n'
+                      % (name, s['spawns'], s['cpu'], s['bytes'],
+                         s['failed']))
+
+
+def main():
+    ap = argparse.ArgumentParser(description='zfsbackup benchmarks with '
+                                 'fake zfs and ssh')
+    ap.add_argument('scenarios', nargs='*',
+                    help='what to run: '+', '.join(SCENARIOS)
+                    + ' (default: all)')
+    ap.add_argument('--size', type=int, default=256*1024**2,
+                    help='bytes in the send scenario stream')
+    ap.add_argument('--rate', type=int, default=0,
+                    help='bytes/s the fake zfs send produces, 0 = flat out')
+    ap.add_argument('--datasets', type=int, default=20,
+                    help='datasets in the run scenario')
+    ap.add_argument('--dataset-size', type=int, default=4*1024**2,
+                    help='bytes per dataset in the run scenario')
+    ap.add_argument('--changed', type=float, default=0.5,
+                    help='fraction of the datasets written to between the '
+                    'two runs of the run scenario')
+    ap.add_argument('--snapshots', type=int, default=200,
+                    help='existing snapshots per dataset')
+    ap.add_argument('--destinations', type=int, default=2,
+                    help='destinations per dataset, alternating local/ssh')
+    ap.add_argument('--retain', type=int, default=5,
+                    help='retain_snaps for the destinations')
+    ap.add_argument('-j', '--jobs', type=int, default=4,
+                    help='max_workers for the run scenario')
+    ap.add_argument('--ssh-handshake', type=float, default=0.05,
+                    help='seconds a new (non multiplexed) ssh connection '
+                    'costs')
+    ap.add_argument('--json', action='store_true',
+                    help='print the results as json')
+    ap.add_argument('-o', '--output', help='also write the report here')
+    ap.add_argument('--log', default=os.devnull,
+                    help='where zfsbackup logs to')
+    args = ap.parse_args()
+    for s in args.scenarios:
+        if s not in SCENARIOS:
+            ap.error('unknown scenario: '+s)
+    logging.basicConfig(filename=args.log,
+                        format='%(asctime)s (%(levelname)s) %(message)s')
+    funcs = {'send': bench_send, 'clean': bench_clean, 'run': bench_run}
+    results = [funcs[s](args) for s in (args.scenarios or SCENARIOS)]
+    outputs = [sys.stdout]
+    if args.output:
+        outputs.append(open(args.output, 'w'))
+    for out in outputs:
+        if args.json:
+            json.dump(results, out, indent=2)
+            out.write('\n')
+        else:
+            report(results, out)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
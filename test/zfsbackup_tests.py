@@ -1,9 +1,22 @@
 import unittest
+import asyncio
+import collections
+import hashlib
+import json
 import zfsbackup
 from zfsbackup import ZFSBackupError
 import subprocess
 import os
+import shutil
+import sys
+import tempfile
 import time
+import types
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                'benchmark'))
+import benchmark
 
 def generateLargeFile(path,size=1):
     """
@@ -57,6 +70,19 @@ class TestZFSBackup(unittest.TestCase):
         snaps = zfsbackup.get_snapshots(dataset)
         self.assertTrue(dataset+snap in snaps)
 
+    def testSnapshotDatasets(self):
+        source = self.base_dataset+'/'+self.source_dataset
+        dest = self.base_dataset+'/'+self.dest_dataset
+        # has stragglers, left alone
+        other = self.base_dataset+'/'+self.other_dataset
+        taken = zfsbackup.snapshot_datasets([source, dest, other])
+        self.assertEqual(sorted(taken), [dest, source])
+        self.assertEqual(taken[source], taken[dest])
+        for dataset in (source, dest):
+            self.assertEqual(zfsbackup.get_stragglers(dataset),
+                             [dataset+taken[dataset]])
+        self.assertEqual(zfsbackup.snapshot_datasets([source, dest]), {})
+
     def testListSnapshot(self):
         dataset = self.base_dataset+'/'+self.source_dataset
         desired_snap = self.base_dataset+'/'+self.source_dataset+'@zfsbackup-expected'
@@ -156,6 +182,19 @@ class TestZFSBackup(unittest.TestCase):
         snaps = zfsbackup.get_snapshots(destination)
         self.assertTrue(destination+'@zfsbackup-sendtest' in snaps)
 
+    def testSendSnapshotMulti(self):
+        dataset = self.base_dataset+'/'+self.source_dataset
+        snapshot = dataset+'@zfsbackup-sendtest'
+        dests = [{'dest': self.base_dataset+'/'+self.dest_dataset, 'transport': 'local'},
+                 {'dest': self.base_dataset+'/destination2', 'transport': 'local'},
+                 {'dest': self.base_dataset+'/non-existent-dataset/butreally', 'transport': 'local'}]
+        zfsbackup.create_snapshot(dataset,'zfsbackup-sendtest')
+        failed = zfsbackup.send_snapshot_multi(snapshot, dests)
+        self.assertEqual(failed, [dests[2]])
+        for d in dests[:2]:
+            snaps = zfsbackup.get_snapshots(d['dest'])
+            self.assertTrue(d['dest']+'@zfsbackup-sendtest' in snaps)
+
     def testSendFullLocal(self):
         dataset = self.base_dataset+'/'+self.source_dataset
         dest = self.base_dataset+'/'+self.dest_dataset
@@ -180,6 +219,41 @@ class TestZFSBackup(unittest.TestCase):
         snaps = zfsbackup.get_snapshots(dest)
         self.assertTrue(dest+snap in snaps)
 
+    def testFindUnchanged(self):
+        source = self.base_dataset+'/'+self.source_dataset
+        other = self.base_dataset+'/'+self.other_dataset
+        datasets = [{'dataset_name': source}, {'dataset_name': other}]
+        # other has a straggler to finish, so it always gets a run
+        self.assertEqual(zfsbackup.find_unchanged(datasets, '@zfsbackup-last-test'),
+                         {source})
+        self.assertEqual(zfsbackup.find_unchanged(datasets, '@zfsbackup-last-test',
+                                                  {'force_after': 0}), set())
+        self.assertEqual(zfsbackup.find_unchanged(datasets, '@zfsbackup-last-test',
+                                                  {'skip_unchanged': False}), set())
+        with open('/'+source+'/changed', 'wb') as f:
+            f.write(os.urandom(1024*1024))
+        subprocess.run(['sync'])
+        self.assertEqual(zfsbackup.find_unchanged(datasets, '@zfsbackup-last-test'),
+                         set())
+
+    def testEstimateSendSize(self):
+        dataset = self.base_dataset+'/'+self.source_dataset
+        generateLargeFile('/'+dataset+'/largefile', 1)
+        snap = zfsbackup.create_timestamp_snap(dataset)
+        size = zfsbackup.estimate_send_size(dataset+snap)
+        self.assertTrue(size > 1024**3)
+        self.assertTrue(zfsbackup.estimate_send_size(dataset+snap, dataset+snap) < size)
+
+    def testPlanBackups(self):
+        dataset = self.base_dataset+'/'+self.source_dataset
+        ds = [{'dataset_name': dataset,
+               'destinations': [{'dest': self.base_dataset+'/'+self.dest_dataset,
+                                 'transport': 'local'}]}]
+        plans = zfsbackup.plan_backups(ds, '@zfsbackup-last-test')
+        self.assertEqual(len(plans), 1)
+        self.assertEqual(plans[0]['kind'], 'incremental')
+        self.assertTrue(plans[0]['bytes'] is not None)
+
     def testVerifyBackupLocal(self):
         dataset = self.base_dataset+'/'+self.source_dataset
         dest = self.base_dataset+'/'+self.dest_dataset
@@ -203,6 +277,23 @@ class TestZFSBackup(unittest.TestCase):
         except ZFSBackupError:
             pass
 
+    def testVerifyBackups(self):
+        dataset = self.base_dataset+'/'+self.source_dataset
+        dest = self.base_dataset+'/'+self.dest_dataset
+        snap = zfsbackup.create_timestamp_snap(dataset)
+        zfsbackup.send_full(dataset+snap,dest)
+        dests = [{'dest': dest, 'transport': 'local'},
+                 {'dest': dest, 'transport': 'ssh:root@localhost'},
+                 {'dest': dataset, 'transport': 'local'}]
+        # the source itself has the snapshot, with the same guid
+        self.assertEqual(zfsbackup.verify_backups(dataset+snap, dests), [])
+        dests.append({'dest': self.base_dataset, 'transport': 'local'})
+        self.assertEqual(zfsbackup.verify_backups(dataset+snap, dests),
+                         [dests[3]])
+        other = zfsbackup.create_timestamp_snap(dest)
+        self.assertRaises(ZFSBackupError, zfsbackup.verify_backup, other,
+                          dest, 'local', guid='1')
+
     def testSendIncrementalLocal(self):
         dataset = self.base_dataset+'/'+self.source_dataset
         dest = self.base_dataset+'/'+self.dest_dataset
@@ -257,6 +348,34 @@ class TestZFSBackup(unittest.TestCase):
         except ZFSBackupError as e:
             self.fail("caught exception "+e.message)
 
+    def testBackupDatasetBookmarks(self):
+        dataset = self.base_dataset+'/'+self.source_dataset
+        dest = [{'dest':self.base_dataset+'/'+self.dest_dataset,'transport':'local'}]
+        try:
+            zfsbackup.backup_dataset(dataset,dest,'@zfsbackup-last',bookmark=True)
+            time.sleep(1)
+            zfsbackup.backup_dataset(dataset,dest,'@zfsbackup-last',bookmark=True)
+        except ZFSBackupError as e:
+            self.fail("caught exception "+e.message)
+        self.assertFalse(zfsbackup.has_backuplast(dataset,'@zfsbackup-last'))
+        self.assertEqual(zfsbackup.get_stragglers(dataset),[])
+        self.assertEqual(zfsbackup.incremental_base(dataset,'@zfsbackup-last'),
+                         dataset+'#zfsbackup-last')
+
+    def testBackupDatasetCommonSnapshot(self):
+        dataset = self.base_dataset+'/'+self.source_dataset
+        dest = [{'dest':self.base_dataset+'/'+self.dest_dataset,'transport':'local'}]
+        try:
+            zfsbackup.backup_dataset(dataset,dest,'@zfsbackup-last')
+            # lost track of the last backup, the copy is still there
+            zfsbackup.rename_snapshot(dataset+'@zfsbackup-last',
+                                      dataset+'@zfsbackup-renamed')
+            time.sleep(1)
+            zfsbackup.backup_dataset(dataset,dest,'@zfsbackup-last')
+        except ZFSBackupError as e:
+            self.fail("caught exception "+e.message)
+        self.assertEqual(len(zfsbackup.get_snapshots(dest[0]['dest'])),2)
+
     def testBackupDatasetIncrementalSSH(self):
         dataset = self.base_dataset+'/'+self.source_dataset
         dest = [{'dest':self.base_dataset+'/'+self.dest_dataset,'transport':'ssh:root@localhost'}]
@@ -376,6 +495,63 @@ class TestZFSBackup(unittest.TestCase):
         zfsbackup.verify_backup(saved_penultimate, dataset, 'ssh:root@localhost')
         zfsbackup.verify_backup(saved_last, dataset, 'ssh:root@localhost')
 
+    def testDestSnapshotDeleteMultiple(self):
+        dests = [{'dest': self.base_dataset+'/'+self.dest_dataset, 'transport': 'local'},
+                 {'dest': self.base_dataset+'/destination2', 'transport': 'ssh:root@localhost'}]
+        for i in range(5):
+            for d in dests:
+                zfsbackup.create_snapshot(d['dest'], 'zfsbackup-2018010'+str(i)+'-000000')
+        zfsbackup.create_snapshot(dests[0]['dest'], 'not-ours')
+        zfsbackup.clean_dest_snaps(dests, 2)
+        for d in dests:
+            snaps = [s for s in zfsbackup.get_snapshots(d['dest']) if 'zfsbackup-' in s]
+            self.assertEqual(snaps, [d['dest']+'@zfsbackup-20180103-000000',
+                                     d['dest']+'@zfsbackup-20180104-000000'])
+        self.assertTrue(dests[0]['dest']+'@not-ours' in zfsbackup.get_snapshots(dests[0]['dest']))
+
+
+    def testBackupConfigDataset(self):
+        ds = {'dataset_name': self.base_dataset+'/'+self.source_dataset,
+              'destinations': [{'dest': self.base_dataset+'/'+self.dest_dataset,
+                                'transport': 'local'}]}
+        self.assertEqual(zfsbackup.backup_config_dataset(ds, '@zfsbackup-last', {'retain_snaps': 2}), 0)
+        snaps = zfsbackup.get_snapshots(ds['destinations'][0]['dest'])
+        self.assertTrue(len(snaps) > 0)
+
+    def testBackupConfigDatasetStragglers(self):
+        ds = {'dataset_name': self.base_dataset+'/'+self.other_dataset,
+              'destinations': [{'dest': self.base_dataset+'/'+self.dest_dataset,
+                                'transport': 'local'}]}
+        self.assertEqual(zfsbackup.backup_config_dataset(ds, '@zfsbackup-last', {'resume': False}), 1)
+
+    def testBackupConfigDatasetResume(self):
+        # a single straggler is an interrupted backup that gets finished
+        dataset = self.base_dataset+'/'+self.other_dataset
+        ds = {'dataset_name': dataset,
+              'destinations': [{'dest': self.base_dataset+'/'+self.dest_dataset+'/other',
+                                'transport': 'local'}]}
+        self.assertEqual(zfsbackup.backup_config_dataset(ds, '@zfsbackup-last'), 0)
+        self.assertEqual(zfsbackup.get_snapshots(dataset), [dataset+'@zfsbackup-last'])
+        self.assertTrue(zfsbackup.verify_backup('@zfsbackup-20180507-142000',
+                                                ds['destinations'][0]['dest'], 'local'))
+
+    def testInventory(self):
+        dataset = self.base_dataset+'/'+self.source_dataset
+        cli_snaps = zfsbackup.get_snapshots(dataset)
+        zfsbackup.load_inventory([dataset, self.base_dataset+'/doesnotexist'])
+        try:
+            self.assertTrue(zfsbackup.inventory.has_dataset(dataset))
+            self.assertFalse(zfsbackup.inventory.has_dataset(self.base_dataset+'/doesnotexist'))
+            self.assertEqual(zfsbackup.get_snapshots(dataset), cli_snaps)
+            self.assertFalse(zfsbackup.is_encrypted_dataset(dataset))
+            zfsbackup.create_snapshot(dataset, 'zfsbackup-unittest')
+            zfsbackup.rename_snapshot(dataset+'@zfsbackup-unittest', dataset+'@zfsbackup-renamed')
+            zfsbackup.delete_snapshot(dataset+'@zfsbackup-delete')
+            snaps = zfsbackup.get_snapshots(dataset)
+            zfsbackup.clear_inventory()
+            self.assertEqual(snaps, zfsbackup.get_snapshots(dataset))
+        finally:
+            zfsbackup.clear_inventory()
 
     def testValidateConfig(self):
         # do more than this
@@ -388,5 +564,703 @@ class TestZFSBackup(unittest.TestCase):
                 self.assertTrue(('dest' in t) and ('transport' in t))
 
 
+class TestZFSBackupNoPool(unittest.TestCase):
+    """
+       Tests for the parts of zfsbackup.py that don't need a pool
+    """
+
+    def writeConfig(self, contents):
+        path = './testing-config.yml'
+        with open(path, 'w') as f:
+            f.write(contents)
+        os.chmod(path, 0o600)
+        return path
+
+    def tearDown(self):
+        if os.path.exists('./testing-config.yml'):
+            os.remove('./testing-config.yml')
+
+    def fakePool(self):
+        """A benchmark.Bench: the fake zfs and ssh from test/benchmark/bin
+           on PATH, with a pool and backup/remote pools to send to"""
+        bench = benchmark.Bench('test', types.SimpleNamespace(
+            rate=0, ssh_handshake=0))
+        bench.add_dataset('pool/a', referenced=1024**2, dirty=1000)
+        for pool in ('backup', 'remote'):
+            bench.add_dataset(pool)
+        return bench
+
+    def fakeCommands(self, bench, sub=None):
+        """returns: the args of every fake zfs run so far"""
+        with open(bench.log_path) as f:
+            records = [json.loads(line) for line in f]
+        return [r['args'] for r in records
+                if r['prog'] == 'zfs' and sub in (None, r['sub'])]
+
+    def testValidateConfigMaxWorkers(self):
+        conf = """
+max_workers: 4
+datasets:
+  - dataset_name: "trash/a"
+    destinations:
+      - dest: "trash/b"
+        transport: "local"
+"""
+        c = zfsbackup.validate_config(self.writeConfig(conf))
+        self.assertEqual(c.get('max_workers'), 4)
+        path = self.writeConfig(conf.replace('max_workers: 4', 'max_workers: 0'))
+        self.assertRaises(ZFSBackupError, zfsbackup.validate_config, path)
+
+    def testStreamTee(self):
+        source = subprocess.Popen(['head', '-c', '3000000', '/dev/zero'],
+                                  stdout=subprocess.PIPE)
+        good = [subprocess.Popen(['wc', '-c'], stdin=subprocess.PIPE,
+                                 stdout=subprocess.PIPE) for i in range(2)]
+        bad = subprocess.Popen(['false'], stdin=subprocess.PIPE)
+        sinks = [(p.stdin, [p], []) for p in good+[bad]]
+        tee = zfsbackup.StreamTee(source.stdout, sinks, chunk_size=65536)
+        tee.start()
+        tee.join()
+        source.wait()
+        bad.wait()
+        for p in good:
+            self.assertEqual(int(p.stdout.read()), 3000000)
+            p.wait()
+        self.assertTrue(tee.sinks[2].failed)
+
+    def testSSHConnectionPool(self):
+        # stand in for ssh that only knows how to open a master
+        bindir = tempfile.mkdtemp()
+        with open(bindir+'/ssh', 'w') as f:
+            f.write('#!/bin/sh\n'
+                    'case "$*" in *ControlMaster=yes*) exit 0;; esac\n'
+                    'exit 1\n')
+        os.chmod(bindir+'/ssh', 0o755)
+        path = os.environ['PATH']
+        os.environ['PATH'] = bindir+':'+path
+        try:
+            pool = zfsbackup.SSHConnectionPool()
+            first = pool.command('root', 'localhost', '22', 'zfs list')
+            second = pool.command('root', 'localhost', '22', 'zfs get')
+            other = pool.command('root', 'otherhost', '22', 'zfs list')
+            self.assertEqual(len(pool.masters), 2)
+            control = [o for o in first if o.startswith('ControlPath=')]
+            self.assertEqual(control, [o for o in second if o.startswith('ControlPath=')])
+            self.assertFalse(control[0] in other)
+            self.assertEqual(first[-4:], ['-l', 'root', 'localhost', 'zfs list'])
+            pool.close_all()
+            self.assertEqual(pool.masters, {})
+        finally:
+            os.environ['PATH'] = path
+            shutil.rmtree(bindir)
+
+    def testDestroyBatches(self):
+        destroy_batches = getattr(zfsbackup, '__destroy_batches')
+        all_snaps = ['t/d@s'+str(i) for i in range(1, 7)]
+        doomed = ['t/d@s1', 't/d@s2', 't/d@s3', 't/d@s5']
+        self.assertEqual(destroy_batches('t/d', doomed, all_snaps),
+                         [('t/d@s1%s3,s5', doomed)])
+        self.assertEqual(destroy_batches('t/d', doomed, all_snaps, max_length=10),
+                         [('t/d@s1%s3', doomed[:3]), ('t/d@s5', doomed[3:])])
+        self.assertEqual(destroy_batches('t/d', [], all_snaps), [])
+
+    def testInventoryUpdates(self):
+        inv = zfsbackup.ZFSInventory()
+        inv.datasets['t/a'] = {'snapshots': collections.OrderedDict(
+            (n, {'guid': '1', 'createtxg': i, 'creation': i})
+            for i, n in enumerate(['t/a@one', 't/a@two'])),
+            'bookmarks': {}, 'props': {}}
+        inv.add_snapshot('t/a@three')
+        inv.add_bookmark('t/a#two', 't/a@two')
+        self.assertEqual(inv.get_snapshot('t/a#two')['guid'], '1')
+        inv.add_snapshot('t/b@nope')
+        inv.rename('t/a@one', 't/a@first')
+        inv.remove_snapshot('t/a@two')
+        self.assertEqual(inv.get_snapshots('t/a'), ['t/a@first', 't/a@three'])
+        self.assertFalse(inv.has_dataset('t/b'))
+        inv.rename('t/a', 't/c')
+        self.assertEqual(inv.get_snapshots('t/c'), ['t/c@first', 't/c@three'])
+        self.assertEqual(inv.get_bookmarks('t/c'), ['t/c#two'])
+        inv.remove_bookmark('t/c#two')
+        self.assertEqual(inv.get_bookmarks('t/c'), [])
+        self.assertIsNone(inv.get_property('t/a', 'encryption'))
+
+    def testCodec(self):
+        self.assertEqual(zfsbackup.get_codec({'dest': 'a', 'transport': 'ssh:root@localhost'}).compress_command(),
+                         ['lz4', '-q', '-1'])
+        self.assertIsNone(zfsbackup.get_codec({'dest': 'a', 'transport': 'ssh:root@localhost',
+                                               'compression': 'none'}))
+        zstd = zfsbackup.get_codec({'dest': 'a', 'transport': 'ssh:root@localhost', 'compression': 'zstd',
+                                    'compression_level': 9, 'compression_threads': 4})
+        self.assertEqual(zstd.compress_command(), ['zstd', '-q', '-9', '-T4'])
+        self.assertEqual(zstd.decompress_command(), 'zstd -d')
+        self.assertEqual(zfsbackup.Codec('pigz', threads=8).compress_command(),
+                         ['pigz', '-q', '-6', '-p', '8'])
+        self.assertRaises(ZFSBackupError, zfsbackup.Codec, 'bzip2')
+
+    def testValidateConfigCompression(self):
+        conf = """
+datasets:
+  - dataset_name: "trash/a"
+    destinations:
+      - dest: "trash/b"
+        transport: "ssh:root@localhost"
+        compression: "zstd"
+"""
+        zfsbackup.validate_config(self.writeConfig(conf))
+        path = self.writeConfig(conf.replace('"zstd"', '"bzip2"'))
+        self.assertRaises(ZFSBackupError, zfsbackup.validate_config, path)
+        for option in ('compression_level: 3', 'compression_threads: 4'):
+            zfsbackup.validate_config(self.writeConfig(
+                conf+'        '+option+'\n'))
+        for option in ('compression_level: "max"', 'compression_level: 0',
+                       'compression_threads: -2'):
+            path = self.writeConfig(conf+'        '+option+'\n')
+            self.assertRaises(ZFSBackupError, zfsbackup.validate_config,
+                              path)
+
+    def testZFSBackend(self):
+        conf = """
+zfs_backend: "cli"
+datasets:
+  - dataset_name: "trash/a"
+    destinations:
+      - dest: "trash/b"
+        transport: "local"
+"""
+        zfsbackup.validate_config(self.writeConfig(conf))
+        path = self.writeConfig(conf.replace('"cli"', '"ioctl"'))
+        self.assertRaises(ZFSBackupError, zfsbackup.validate_config, path)
+        try:
+            zfsbackup.set_zfs_backend('cli')
+            self.assertEqual(zfsbackup.zfs_backend.name, 'cli')
+            # auto always ends up with something that works
+            zfsbackup.set_zfs_backend('auto')
+            self.assertIn(zfsbackup.zfs_backend.name, ('cli', 'libzfs_core'))
+        finally:
+            zfsbackup.set_zfs_backend('cli')
+
+    def testAsyncEngine(self):
+        engine = zfsbackup.AsyncEngine(max_commands=4, max_host_commands=1)
+        try:
+            self.assertEqual(engine.run_command(['echo', 'hi']).stdout, 'hi\n')
+            self.assertRaises(subprocess.CalledProcessError,
+                              engine.run_command, ['false'])
+            start = time.monotonic()
+            self.assertRaises(subprocess.TimeoutExpired, engine.run_command,
+                              ['sleep', '10'], timeout=0.2)
+            # a cancelled task takes its process with it
+            self.assertRaises(subprocess.TimeoutExpired, engine.call,
+                              engine.command(['sleep', '10'], timeout=None),
+                              timeout=0.2)
+            self.assertLess(time.monotonic() - start, 5)
+
+            async def sleeps(hosts):
+                await asyncio.gather(*[engine.command(['sleep', '0.3'], host=h)
+                                       for h in hosts])
+            # one at a time per host, but hosts don't wait for each other
+            start = time.monotonic()
+            engine.call(sleeps(['a', 'a']))
+            self.assertGreater(time.monotonic() - start, 0.55)
+            start = time.monotonic()
+            engine.call(sleeps(['a', 'b']))
+            self.assertLess(time.monotonic() - start, 0.55)
+
+            async def send(resources):
+                slots = await engine.acquire_sends(resources)
+                try:
+                    await asyncio.sleep(0.3)
+                finally:
+                    engine.release(slots)
+
+            async def sends(*resources):
+                await asyncio.gather(*[send(r) for r in resources])
+            async def chatty():
+                # far more stderr than a pipe holds, nobody reading stdout
+                stage = await engine.spawn(
+                    'chatty', [sys.executable, '-c',
+                               'import sys\n'
+                               'for i in range(50000):\n'
+                               ' sys.stderr.write("line %d\\n" % i)'])
+                await stage.wait()
+                return stage
+            with self.assertLogs(level='DEBUG') as logs:
+                stage = engine.call(chatty(), timeout=30)
+            self.assertEqual(stage.returncode, 0)
+            self.assertEqual(len(stage.stderr), stage.stderr_limit)
+            self.assertGreater(stage.stderr_dropped, 0)
+            self.assertTrue(stage.stderr.endswith(b'line 49999\n'))
+            self.assertIn('DEBUG:root:chatty: line 0', logs.output)
+            self.assertIn('DEBUG:root:chatty: line 49999', logs.output)
+
+            # sends don't take command slots, nor wait for them
+            engine.configure(max_commands=1, max_sends=2)
+
+            async def busy():
+                await asyncio.gather(send([]), send([]),
+                                     engine.command(['sleep', '0.3']))
+            start = time.monotonic()
+            engine.call(busy())
+            self.assertLess(time.monotonic() - start, 0.55)
+            start = time.monotonic()
+            engine.call(sends([], [], []))
+            self.assertGreater(time.monotonic() - start, 0.55)
+            engine.configure(max_commands=4, max_sends=16)
+
+            engine.configure(send_limits={'source_pool': 1, 'dest_host': 2})
+            start = time.monotonic()
+            engine.call(sends([('source_pool', 'tank'), ('dest_host', 'a')],
+                              [('source_pool', 'tank'), ('dest_host', 'b')]))
+            self.assertGreater(time.monotonic() - start, 0.55)
+            # no limit for local pools
+            start = time.monotonic()
+            engine.call(sends([('source_pool', 'tank'), ('dest_host', 'a')],
+                              [('source_pool', 'data'), ('dest_host', 'a')],
+                              [('dest_pool', 'b')], [('dest_pool', 'b')]))
+            self.assertLess(time.monotonic() - start, 0.55)
+        finally:
+            engine.close()
+
+    def testDestinationInventory(self):
+        dests = [{'dest': 'backup/a', 'transport': 'local'},
+                 {'dest': 'remote/a', 'transport': 'ssh:root@localhost'}]
+        with self.fakePool() as bench:
+            zfsbackup.load_inventory(['pool/a'], dests)
+            self.assertTrue(zfsbackup.dest_inventory.reachable('local'))
+            self.assertEqual(zfsbackup.dest_inventory.snapshots(dests[0]), {})
+            for i in range(2):
+                zfsbackup.backup_dataset('pool/a', dests, '@zfsbackup-last')
+                time.sleep(1)
+                # what was sent to isn't known anymore
+                self.assertIsNone(zfsbackup.dest_inventory.dataset(dests[1]))
+                zfsbackup.load_inventory(['pool/a'], dests)
+            self.assertEqual(len(zfsbackup.dest_inventory.snapshots(dests[1])), 2)
+            # guids come with the snapshots, tokens and the connection
+            # state with the destination listing
+            gets = self.fakeCommands(bench, 'get')
+            self.assertEqual([a for a in gets if 'receive_resume_token' in a], [])
+            self.assertEqual(len([a for a in gets if 'guid' in a]), 2)
+            self.assertEqual(self.fakeCommands(bench, 'version'), [])
+
+    def testCommonBaseNewerSnapshots(self):
+        dests = [{'dest': 'backup/a', 'transport': 'local'},
+                 {'dest': 'remote/a', 'transport': 'ssh:root@localhost'}]
+        with self.fakePool() as bench:
+            zfsbackup.backup_dataset('pool/a', dests, '@zfsbackup-last')
+            # lost track of the last backup, and one destination got a
+            # snapshot of its own since
+            zfsbackup.rename_snapshot('pool/a@zfsbackup-last',
+                                      'pool/a@zfsbackup-renamed')
+            zfsbackup.engine.run_command(['zfs', 'snapshot',
+                                          'remote/a@mine'])
+            time.sleep(1)
+            failed = []
+            self.assertRaises(ZFSBackupError, zfsbackup.backup_dataset,
+                              'pool/a', dests, '@zfsbackup-last',
+                              failed=failed)
+            # it'd only be refused again
+            self.assertEqual(failed, [])
+            self.assertIn('remote/a@mine',
+                          zfsbackup.get_snapshots('remote/a'))
+            self.assertEqual(len(zfsbackup.get_snapshots('backup/a')), 2)
+            recvs = self.fakeCommands(bench, 'recv')
+            self.assertEqual([args[-1] for args in recvs],
+                             ['backup/a', 'remote/a', 'backup/a'])
+
+    def testKeepBookmark(self):
+        dests = [{'dest': 'backup/a', 'transport': 'local'}]
+        last = 'pool/a#zfsbackup-last'
+        with self.fakePool() as bench:
+            for i in range(2):
+                zfsbackup.backup_dataset('pool/a', dests, '@zfsbackup-last',
+                                         bookmark=True)
+                time.sleep(1)
+            self.assertEqual(zfsbackup.get_bookmarks('pool/a'), [last])
+            # the new one is in place before the old one goes
+            swaps = [[args[0], args[-1]] for args in self.fakeCommands(bench)
+                     if args[0] in ('bookmark', 'destroy')
+                     and '#' in args[-1]]
+            self.assertEqual(swaps[-4:], [['bookmark', last+'-next'],
+                                          ['destroy', last],
+                                          ['bookmark', last],
+                                          ['destroy', last+'-next']])
+            # interrupted half way, the -next one is sent from
+            create_bookmark = zfsbackup.create_bookmark
+
+            def interrupted(snapshot, bookmark):
+                if bookmark == last:
+                    raise ZFSBackupError("interrupted")
+                create_bookmark(snapshot, bookmark)
+            zfsbackup.create_bookmark = interrupted
+            try:
+                self.assertRaises(ZFSBackupError, zfsbackup.backup_dataset,
+                                  'pool/a', dests, '@zfsbackup-last',
+                                  bookmark=True)
+            finally:
+                zfsbackup.create_bookmark = create_bookmark
+            self.assertEqual(zfsbackup.get_bookmarks('pool/a'),
+                             [last+'-next'])
+            self.assertEqual(zfsbackup.incremental_base(
+                'pool/a', '@zfsbackup-last'), last+'-next')
+            straggler = zfsbackup.get_stragglers('pool/a')
+            self.assertEqual(len(straggler), 1)
+            zfsbackup.backup_dataset('pool/a', dests, '@zfsbackup-last',
+                                     new_snap='@'+straggler[0].split('@')[1],
+                                     bookmark=True)
+            self.assertEqual(zfsbackup.get_bookmarks('pool/a'), [last])
+            self.assertEqual(zfsbackup.get_stragglers('pool/a'), [])
+
+    def testSnapshotDatasetsPools(self):
+        bench = self.fakePool()
+        bench.add_dataset('pool/b', referenced=1024**2)
+        bench.add_dataset('tank/c', referenced=1024**2)
+        with bench:
+            snaps = zfsbackup.snapshot_datasets(['pool/a', 'tank/c',
+                                                 'pool/b'])
+            self.assertEqual(sorted(snaps), ['pool/a', 'pool/b', 'tank/c'])
+            # one call per pool, none of them falling back to one by one
+            calls = self.fakeCommands(bench, 'snap')
+            self.assertEqual(sorted(sorted(args[1:]) for args in calls),
+                             [['pool/a'+snaps['pool/a'],
+                               'pool/b'+snaps['pool/b']],
+                              ['tank/c'+snaps['tank/c']]])
+
+    def testDropUnsentSnapshot(self):
+        ds = {'dataset_name': 'pool/a',
+              'destinations': [{'dest': 'backup/a', 'transport': 'local'}]}
+        with self.fakePool() as bench:
+            snaps = zfsbackup.snapshot_datasets(['pool/a'])
+            incremental_base = zfsbackup.incremental_base
+
+            def broken(dataset, inc_snap):
+                raise ZFSBackupError("broken")
+            zfsbackup.incremental_base = broken
+            try:
+                self.assertEqual(zfsbackup.backup_config_dataset(
+                    ds, '@zfsbackup-last', new_snap=snaps['pool/a']), 1)
+            finally:
+                zfsbackup.incremental_base = incremental_base
+            # never sent anywhere, so it's gone again
+            self.assertEqual(zfsbackup.get_stragglers('pool/a'), [])
+            # a partly received one stays to be resumed
+            snaps = zfsbackup.snapshot_datasets(['pool/a'])
+            os.environ['FAKE_ZFS_FAIL_RECV'] = 'backup/a'
+            try:
+                self.assertEqual(zfsbackup.backup_config_dataset(
+                    ds, '@zfsbackup-last', new_snap=snaps['pool/a']), 1)
+            finally:
+                del os.environ['FAKE_ZFS_FAIL_RECV']
+            self.assertEqual(zfsbackup.get_stragglers('pool/a'),
+                             ['pool/a'+snaps['pool/a']])
+
+    def testRefusedNotRetried(self):
+        ds = {'dataset_name': 'pool/a', 'destinations': [
+            {'dest': 'backup/a', 'transport': 'local'},
+            {'dest': 'remote/a', 'transport': 'ssh:root@localhost'}]}
+        conf = {'retry_delay': '1s', 'retain_snaps': 1}
+        with self.fakePool() as bench:
+            self.assertEqual(zfsbackup.run_backup_jobs(
+                [ds], '@zfsbackup-last', conf, 1), 0)
+            zfsbackup.rename_snapshot('pool/a@zfsbackup-last',
+                                      'pool/a@zfsbackup-renamed')
+            zfsbackup.engine.run_command(['zfs', 'snapshot',
+                                          'remote/a@mine'])
+            bench.write('pool/a', 1000)
+            time.sleep(1)
+            with self.assertLogs(level='INFO') as logs:
+                self.assertEqual(zfsbackup.run_backup_jobs(
+                    [ds], '@zfsbackup-last', conf, 1), 1)
+            self.assertFalse([line for line in logs.output
+                              if 'Retrying' in line])
+            # the one that made it is still cleaned up
+            self.assertEqual(len(zfsbackup.get_snapshots('backup/a')), 1)
+
+    def testVerifyPerHost(self):
+        names = ['pool/a', 'pool/b', 'pool/c']
+        datasets = [{'dataset_name': name, 'destinations': [
+            {'dest': 'backup/'+name[5:], 'transport': 'local'},
+            {'dest': 'remote/'+name[5:], 'transport': 'ssh:root@localhost'}]}
+            for name in names]
+        bench = self.fakePool()
+        for name in names[1:]:
+            bench.add_dataset(name, referenced=1024**2, dirty=1000)
+        with bench:
+            zfsbackup.load_inventory(
+                names, zfsbackup.config_destinations(datasets))
+            self.assertEqual(zfsbackup.run_backup_jobs(
+                datasets, '@zfsbackup-last', {}, 2), 0)
+            for name in names:
+                bench.write(name, 1000)
+            skip = len(self.fakeCommands(bench))
+            zfsbackup.load_inventory(
+                names, zfsbackup.config_destinations(datasets))
+            self.assertEqual(zfsbackup.run_backup_jobs(
+                datasets, '@zfsbackup-last', {}, 2), 0)
+            commands = self.fakeCommands(bench)[skip:]
+            # one listing per host for all three, before any renames
+            listings = [i for i, args in enumerate(commands)
+                        if args[0] == 'list' and 'name,guid' in args]
+            self.assertEqual(sorted(commands[i][-1].split('/')[0]
+                                    for i in listings),
+                             ['backup', 'remote'])
+            for i in listings:
+                self.assertEqual(len([a for a in commands[i] if '@' in a]), 3)
+            renames = [i for i, args in enumerate(commands)
+                       if args[0] == 'rename']
+            self.assertEqual(len(renames), 3)
+            self.assertGreater(min(renames), max(listings))
+
+    def testFindUnchangedDestinations(self):
+        dests = [{'dest': 'backup/a', 'transport': 'local'},
+                 {'dest': 'remote/a', 'transport': 'ssh:root@localhost'}]
+        ds = {'dataset_name': 'pool/a', 'destinations': dests}
+        with self.fakePool() as bench:
+            zfsbackup.backup_dataset('pool/a', dests, '@zfsbackup-last')
+            zfsbackup.load_inventory(['pool/a'], dests)
+            self.assertEqual(zfsbackup.find_unchanged([ds], '@zfsbackup-last'),
+                             {'pool/a'})
+            # a new destination needs its first backup
+            new = dict(ds, destinations=dests+[{'dest': 'backup/new',
+                                                'transport': 'local'}])
+            self.assertEqual(zfsbackup.find_unchanged([new], '@zfsbackup-last'),
+                             set())
+            # and so does a wiped one, without the inventory too
+            for snap in zfsbackup.get_snapshots('remote/a'):
+                zfsbackup.engine.run_command(['zfs', 'destroy', snap])
+            zfsbackup.clear_inventory()
+            self.assertEqual(zfsbackup.find_unchanged([ds], '@zfsbackup-last'),
+                             set())
+
+    def testCleanDestSnapsNone(self):
+        # every destination failed, nothing to clean
+        self.assertIsNone(zfsbackup.clean_dest_snaps([], 2))
+
+    def testSlots(self):
+        async def check():
+            slots = zfsbackup._Slots(2)
+            await slots.acquire()
+            await slots.acquire()
+            # shrunk while both are taken: nobody gets in until that's
+            # back under the new limit
+            slots.resize(1)
+            waiter = asyncio.ensure_future(slots.acquire())
+            slots.release()
+            await asyncio.sleep(0.01)
+            self.assertFalse(waiter.done())
+            slots.release()
+            await asyncio.sleep(0.01)
+            self.assertTrue(waiter.done())
+            self.assertEqual(slots.taken, 1)
+            # grown: waiters get in right away
+            other = asyncio.ensure_future(slots.acquire())
+            await asyncio.sleep(0.01)
+            self.assertFalse(other.done())
+            slots.resize(float('inf'))
+            await asyncio.sleep(0.01)
+            self.assertTrue(other.done())
+            # giving up while waiting doesn't cost a slot
+            slots.resize(2)
+            gone = asyncio.ensure_future(slots.acquire())
+            await asyncio.sleep(0.01)
+            gone.cancel()
+            await asyncio.sleep(0.01)
+            self.assertEqual((slots.taken, len(slots.waiters)), (2, 0))
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(check())
+        finally:
+            loop.close()
+
+    def testSendFlags(self):
+        dest = {'dest': 'a', 'transport': 'ssh:root@localhost'}
+        self.assertEqual(zfsbackup.get_send_flags(dest), ['-L', '-c', '-e'])
+        self.assertEqual(zfsbackup.get_send_flags(dest, encrypted=True), ['-w'])
+        self.assertEqual(zfsbackup.get_send_flags(dict(dest, send_flags='plain')), [])
+        self.assertEqual(zfsbackup.get_send_flags(dict(dest, send_flags=['-e', '-L'])), ['-L', '-e'])
+        # compressed streams skip the default compression, but not one asked for
+        self.assertIsNone(zfsbackup.get_codec(dest, compressed=True))
+        self.assertIsNone(zfsbackup.get_codec(dict(dest, compression='auto'), compressed=True))
+        self.assertEqual(zfsbackup.get_codec(dict(dest, compression='zstd'), compressed=True).name, 'zstd')
+        self.assertEqual(zfsbackup.get_codec(dest, compressed=False).name, 'lz4')
+
+    def testStreamRelay(self):
+        class CopyRelay(zfsbackup.StreamRelay):
+            def splice(self, src, dst):
+                return False
+        for relay_class in (zfsbackup.StreamRelay, CopyRelay):
+            source = subprocess.Popen(['head', '-c', '3000000', '/dev/zero'],
+                                      stdout=subprocess.PIPE)
+            sink = subprocess.Popen(['wc', '-c'], stdin=subprocess.PIPE,
+                                    stdout=subprocess.PIPE)
+            relay = relay_class(source.stdout, sink.stdin)
+            relay.start()
+            relay.join()
+            source.wait()
+            self.assertEqual(int(sink.stdout.read()), 3000000)
+            sink.wait()
+            self.assertEqual(relay.stats()[0], 3000000)
+            self.assertIsNone(relay.error)
+
+    def testStreamDigest(self):
+        data = os.urandom(3000000)
+        expected = hashlib.blake2b(data).hexdigest()
+        # what the receiving side runs in front of zfs recv
+        recv = subprocess.run([sys.executable, '-c',
+                               zfsbackup.RECV_DIGEST_SCRIPT], input=data,
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        self.assertEqual(recv.stdout, data)
+        self.assertEqual(recv.stderr.decode(),
+                         'zfsbackup-digest '+expected+'\n')
+        for tee in (False, True):
+            source = subprocess.Popen(['cat'], stdin=subprocess.PIPE,
+                                      stdout=subprocess.PIPE)
+            sink = subprocess.Popen(['wc', '-c'], stdin=subprocess.PIPE,
+                                    stdout=subprocess.PIPE)
+            digest = zfsbackup.StreamDigest()
+            if tee:
+                relay = zfsbackup.StreamTee(source.stdout,
+                                            [(sink.stdin, [], [])],
+                                            digest=digest)
+            else:
+                relay = zfsbackup.StreamRelay(source.stdout, sink.stdin,
+                                              digest=digest)
+            relay.start()
+            source.stdin.write(data)
+            source.stdin.close()
+            relay.join()
+            source.wait()
+            self.assertEqual(int(sink.stdout.read()), len(data))
+            sink.wait()
+            self.assertEqual(digest.hexdigest(), expected)
+
+    def testParseRate(self):
+        self.assertEqual(zfsbackup.parse_rate('20M'), 20*1024**2)
+        self.assertEqual(zfsbackup.parse_rate('1.5GB/s'), int(1.5*1024**3))
+        self.assertEqual(zfsbackup.parse_rate(4096), 4096)
+        self.assertIsNone(zfsbackup.parse_rate(0))
+        self.assertIsNone(zfsbackup.parse_rate('unlimited'))
+        self.assertRaises(ZFSBackupError, zfsbackup.parse_rate, 'fast')
+
+    def testParseInterval(self):
+        self.assertEqual(zfsbackup.parse_interval('15m'), 900)
+        self.assertEqual(zfsbackup.parse_interval('1.5h'), 5400)
+        self.assertEqual(zfsbackup.parse_interval(30), 30)
+        self.assertEqual(zfsbackup.parse_interval('2d'), 172800)
+        self.assertRaises(ZFSBackupError, zfsbackup.parse_interval, 0)
+        self.assertRaises(ZFSBackupError, zfsbackup.parse_interval, 'often')
+        conf = """
+interval: "1h"
+datasets:
+  - dataset_name: "trash/a"
+    interval: "5m"
+    destinations:
+      - dest: "trash/b"
+        transport: "local"
+"""
+        zfsbackup.validate_config(self.writeConfig(conf))
+        path = self.writeConfig(conf.replace('"5m"', '"soon"'))
+        self.assertRaises(ZFSBackupError, zfsbackup.validate_config, path)
+
+    def testSnapshotIndex(self):
+        start = int(time.mktime((2018, 1, 1, 0, 30, 0, 0, 0, -1)))
+        lines = ['trash/b@manual\t1\t'+str(start - 60)]
+        # hourly backups for 60 days
+        for i in range(24*60):
+            created = start + 3600*i
+            lines.append('trash/b@'+time.strftime('zfsbackup-%Y%m%d-%H%M%S',
+                                                   time.localtime(created))
+                         + '\t'+str(i+2)+'\t'+str(created))
+        lines.append('trash/b@zfsbackup-last\t0\t'+str(created))
+        index = zfsbackup.SnapshotIndex.parse(lines + ['garbage'])
+        self.assertEqual(len(index), 24*60 + 2)
+        self.assertEqual(index.guids[1], '2')
+        newest = lines[-2].split('\t')[0]
+        # keep the last n
+        expired = index.expired(3)
+        self.assertEqual(len(expired), 24*60 - 3)
+        self.assertEqual(expired[0], lines[1].split('\t')[0])
+        # the newest one is kept whatever the config says
+        self.assertNotIn(newest, index.expired(0))
+        expired = set(index.expired(None, {'hourly': 24, 'daily': 7,
+                                           'weekly': 4, 'monthly': 12}))
+        kept = [n for n in index.names if n not in expired]
+        self.assertIn('trash/b@manual', kept)
+        self.assertIn('trash/b@zfsbackup-last', kept)
+        # the newest of each month, week, day and hour
+        self.assertIn('trash/b@zfsbackup-20180131-233000', kept)
+        self.assertIn('trash/b@zfsbackup-20180211-233000', kept)
+        self.assertIn('trash/b@zfsbackup-20180226-233000', kept)
+        self.assertNotIn('trash/b@zfsbackup-20180226-223000', kept)
+        # 24 hourly, 6 more days, 2 more weeks and 1 more month
+        self.assertEqual(len(kept), 2 + 24 + 6 + 2 + 1)
+        # both kinds of rules together, the last 30 cover two of the days
+        self.assertEqual(len(index.expired(30, {'daily': 7})),
+                         24*60 - 30 - 5)
+
+    def testRetryQueue(self):
+        dests = [{'dest': 'trash/b', 'transport': 'local'},
+                 {'dest': 'trash/c', 'transport': 'ssh:root@localhost'}]
+        ds = {'dataset_name': 'trash/a', 'destinations': dests}
+        retries = zfsbackup.RetryQueue({'retry_delay': 10, 'max_attempts': 3})
+        self.assertFalse(retries)
+        self.assertIsNone(retries.next_due())
+        # nothing worth retrying
+        self.assertFalse(retries.add(ds, [], 1))
+        self.assertTrue(retries.add(ds, [dests[1]], 1))
+        self.assertTrue(5 <= retries.next_due() <= 15)
+        self.assertEqual(retries.pop_due(), [])
+        retries.waiting[0] = (0,) + retries.waiting[0][1:]
+        [(retry, attempt)] = retries.pop_due()
+        self.assertFalse(retries)
+        self.assertEqual(attempt, 2)
+        self.assertEqual(retry['destinations'], [dests[1]])
+        self.assertEqual(ds['destinations'], dests)
+        # backs off
+        self.assertTrue(retries.add(retry, [dests[1]], 2))
+        self.assertTrue(10 <= retries.next_due() <= 30)
+        # out of attempts
+        self.assertFalse(retries.add(retry, [dests[1]], 3))
+        # or out of time
+        retries = zfsbackup.RetryQueue({'retry_delay': 10,
+                                        'retry_deadline': 4})
+        self.assertFalse(retries.add(ds, dests, 1))
+        retries = zfsbackup.RetryQueue({'resume': False})
+        self.assertFalse(retries.add(ds, dests, 1, {'resume': False}))
+
+    def testRateSchedule(self):
+        limiter = zfsbackup.RateLimiter([{'start': '08:00', 'end': '18:00', 'rate': '20M'},
+                                         {'start': '22:00', 'end': '02:00', 'rate': '50M'}])
+        at = lambda t: datetime.strptime(t, '%H:%M').time()
+        self.assertEqual(limiter.current_rate(at('12:00')), 20*1024**2)
+        self.assertIsNone(limiter.current_rate(at('19:00')))
+        self.assertEqual(limiter.current_rate(at('23:30')), 50*1024**2)
+        self.assertEqual(limiter.current_rate(at('01:00')), 50*1024**2)
+        self.assertEqual(zfsbackup.RateLimiter('1M').current_rate(at('03:00')), 1024**2)
+        self.assertRaises(ZFSBackupError, zfsbackup.RateLimiter, [{'start': '8', 'rate': '1M'}])
+
+    def testRateLimiter(self):
+        limiter = zfsbackup.RateLimiter('4M')
+        start = time.monotonic()
+        for i in range(6):
+            limiter.consume(1024**2)
+        # 6M at 4M/s, less up to a second of burst
+        self.assertTrue(1.0 <= time.monotonic() - start < 2.5)
+
+    def testOrderLargestFirst(self):
+        estimate = getattr(zfsbackup, '__estimate_from_properties')
+        props = {'written@zfsbackup-last': '100', 'compressratio': '1.50',
+                 'referenced': '1000', 'logicalreferenced': '2000'}
+        self.assertEqual(estimate(props, '@zfsbackup-last', True, True), 100)
+        self.assertEqual(estimate(props, '@zfsbackup-last', True, False), 150)
+        self.assertEqual(estimate(props, '@zfsbackup-last', False, True), 1000)
+        self.assertEqual(estimate(props, '@zfsbackup-last', False, False), 2000)
+        self.assertRaises(ZFSBackupError, estimate, {}, '@zfsbackup-last', True, True)
+        datasets = [{'dataset_name': n} for n in ('small', 'unknown', 'big')]
+        plans = [{'dataset': 'small', 'bytes': 10}, {'dataset': 'big', 'bytes': 5},
+                 {'dataset': 'big', 'bytes': 50}, {'dataset': 'unknown', 'bytes': None}]
+        self.assertEqual([ds['dataset_name'] for ds in zfsbackup.order_largest_first(datasets, plans)],
+                         ['big', 'small', 'unknown'])
+
+
 if __name__ == '__main__':
     unittest.main()
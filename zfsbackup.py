@@ -2,16 +2,69 @@
    zfsbackup.py a simple zfs backup utility
 """
 import argparse
+import asyncio
+import collections
+import concurrent.futures
+import errno
+import fcntl
+import hashlib
 import logging
 import subprocess
 from subprocess import CalledProcessError, TimeoutExpired
 import re
 import os
+import shlex
+import shutil
+import signal
 import sys
+import tempfile
+import threading
+import time
+import queue
+import random
 from datetime import datetime
 import yaml
 
 
+# named sets of zfs send flags a destination can pick with send_flags
+SEND_PROFILES = {'compressed': ['-L', '-e', '-c'],
+                 'largeblock': ['-L', '-e'],
+                 'raw': ['-w'],
+                 'plain': []}
+SEND_FLAGS = ('-L', '-e', '-c', '-w')
+# what retain can keep snapshots for
+RETAIN_PERIODS = ('hourly', 'daily', 'weekly', 'monthly', 'yearly')
+# kinds of send limits the engine knows, and the config key for each
+SEND_LIMITS = {'source_pool': 'max_source_pool_sends',
+               'dest_host': 'max_dest_host_sends',
+               'dest_pool': 'max_dest_pool_sends'}
+# how often the daemon backs up a dataset unless told otherwise
+DEFAULT_INTERVAL = '1h'
+# runs in front of zfs recv for destinations with checksum set: copies
+# stdin to stdout, hashing it on a second thread, then reports the blake2b
+# of what went through on stderr
+RECV_DIGEST_SCRIPT = """import fcntl,hashlib,os,queue,sys,threading
+for fd in 0,1:
+ try:fcntl.fcntl(fd,1031,1048576)
+ except OSError:pass
+q=queue.Queue(16)
+h=hashlib.blake2b()
+def work():
+ for b in iter(q.get,None):h.update(b)
+t=threading.Thread(target=work,daemon=True)
+t.start()
+while True:
+ b=os.read(0,1048576)
+ if not b:break
+ q.put(b)
+ v=memoryview(b)
+ while v:v=v[os.write(1,v):]
+q.put(None)
+t.join()
+sys.stderr.write("zfsbackup-digest "+h.hexdigest()+chr(10))
+"""
+
+
 def main():
     # TODO: argparse setup
     ap_desc = """Program to automatically create and send snapshots of zfs
@@ -29,6 +82,18 @@ def main():
                             + 'If not provided, local assumed.'
                             + 'ssh format: '
                             + 'ssh:username@hostname<:port>')
+    arg_parser.add_argument('-j', '--jobs', type=int,
+                            help='number of datasets to back up concurrently '
+                            + 'in a config run. Overrides max_workers from '
+                            + 'the config file.')
+    arg_parser.add_argument('--plan', action='store_true',
+                            help='print the estimated size and duration of '
+                            + 'every send in a config run and exit without '
+                            + 'sending anything')
+    arg_parser.add_argument('--daemon', action='store_true',
+                            help='keep running and back up every dataset '
+                            + 'in the config on its own interval. SIGHUP '
+                            + 'reloads the config.')
     args = arg_parser.parse_args()
     # hard coded if you don't provide one in the config file, sorry.
     lf_path = "/var/lock/zfsbackup.lock"
@@ -36,6 +101,9 @@ def main():
     incremental_name = "@zfsbackup-last"
     # error counter
     errors = 0
+    if args.daemon and (args.dataset or not args.config):
+        logging.error("Daemon mode only works with a config file.")
+        return -1
     if args.dataset or args.destination:
         # single dataset run
         if not args.dataset and args.destination:
@@ -51,6 +119,8 @@ def main():
         dest = args.destination
         transport = args.transport
         dests = [{'dest': dest, 'transport': transport}]
+        set_zfs_backend()
+        load_inventory([name], dests)
         try:
             stragglers = has_stragglers(name)
         except ZFSBackupError:
@@ -89,43 +159,46 @@ def main():
             lf_path = conf.get('lock_file')
         # TODO future: user selectable logging levels
         logging.getLogger().setLevel(logging.INFO)
-        retain_snaps = conf.get('retain_snaps')
+        datasets = conf.get('datasets')
+        apply_config(conf)
+        if args.plan:
+            # only looking, no need for the lockfile
+            load_inventory([ds.get('dataset_name') for ds in datasets])
+            print_plan(plan_backups(datasets, incremental_name, conf))
+            ssh_pool.close_all()
+            clear_inventory()
+            engine.close()
+            return 0
         # create lockfile
         try:
             lf_fd = create_lockfile(lf_path)
         except Exception:
             logging.critical("Exiting: cannot get a lockfile.")
             return -1
-        for ds in conf.get('datasets'):
-            # for each dataset check stragglers
-            # if none, backup
-            name = ds.get('dataset_name')
-            try:
-                stragglers = has_stragglers(name)
-            except ZFSBackupError:
-                logging.warning("Unable to get list of existing snapshots for "
-                         + "dataset: "+name+". IT WAS NOT BACKED UP!")
-                errors += 1
-                continue
-            if stragglers:
-                logging.warning("Dataset: "+name+" has left over temporary "
-                             + "snapshots. IT WAS NOT BACKED UP! You need "
-                             + "to resolve this manually. Make sure "
-                             + "everything is consistent and remove "
-                             + "the left over zfsbackup-yyyymmdd-hhmm snaps.")
-                errors += 1
-                continue
-            else:
-                try:
-                    backup_dataset(name, ds.get('destinations'),
-                                   incremental_name)
-                    # Delete old snaps
-                    clean_dest_snaps(ds.get('destinations'), retain_snaps)
-                except ZFSBackupError:
-                    logging.warning("Dataset backup of "+name+" to "
-                                 + str(ds.get('destinations'))+" FAILED!"
-                                 + " YOU'LL WANT TO SEE TO THAT!")
-                    errors += 1
+        max_workers = args.jobs or conf.get('max_workers') or 1
+        if max_workers < 1:
+            logging.error("Exiting: number of jobs must be at least 1.")
+            clean_lockfile(lf_path, lf_fd)
+            return -1
+        if args.daemon:
+            Daemon(args.config, conf, incremental_name, args.jobs).run()
+        else:
+            load_inventory([ds.get('dataset_name') for ds in datasets],
+                           config_destinations(datasets))
+            unchanged = find_unchanged(datasets, incremental_name, conf)
+            if unchanged:
+                logging.info("Skipping "+str(len(unchanged))+" datasets "
+                             + "that haven't changed since their last "
+                             + "backup: "+', '.join(sorted(unchanged)))
+                datasets = [ds for ds in datasets
+                            if ds.get('dataset_name') not in unchanged]
+            if max_workers > 1:
+                # start the biggest sends first so they don't end up running
+                # on their own at the end
+                datasets = order_largest_first(
+                    datasets, plan_backups(datasets, incremental_name, conf))
+            errors += run_backup_jobs(datasets, incremental_name, conf,
+                                      max_workers)
     elif not args.config:
         # config file not provided
         logging.error("Config file required if no other arguments given.")
@@ -135,8 +208,9 @@ def main():
         logging.error("Woops, I guess I broke argument parsing")
         return -128
 
-    # TODO: determine if we want a 'retry queue' of failed datasets
-    # if so, make sure those are added into the failure queue above
+    ssh_pool.close_all()
+    clear_inventory()
+    engine.close()
     clean_lockfile(lf_path, lf_fd)
     if errors > 0:
         return -10
@@ -144,6 +218,90 @@ def main():
         return 0
 
 
+def load_inventory(datasets, destinations=()):
+    """Build the run wide zfs inventory for datasets, and the one of their
+       destinations. If that doesn't work everything just keeps asking zfs
+       directly.
+       param datasets: list of datasets that will be backed up
+       param destinations: list of the dest dicts they go to
+    """
+    global inventory, dest_inventory
+    try:
+        inventory = ZFSInventory.load(datasets)
+    except ZFSBackupError:
+        logging.warning("Unable to build zfs inventory, continuing without it.")
+        inventory = None
+    dest_inventory = DestinationInventory()
+    dest_inventory.load(destinations)
+
+
+def set_bandwidth_limit(schedule):
+    """Set the global bandwidth limit shared by every ssh send
+       param schedule: bandwidth_limit from the config, None for no limit
+    """
+    global bandwidth_limiter
+    if parse_rate_schedule(schedule):
+        bandwidth_limiter = RateLimiter(schedule)
+    else:
+        bandwidth_limiter = None
+
+
+def set_zfs_backend(name='auto'):
+    """Pick how local snapshots are created, destroyed, renamed and looked
+       at. Sends and receives always use the zfs command.
+       param name: 'cli', 'libzfs_core', or 'auto' for libzfs_core when
+                   pyzfs is installed and usable, the cli otherwise
+       throws: ZFSBackupError if libzfs_core is asked for and unusable
+    """
+    global zfs_backend
+    lzc = None
+    if name != 'cli':
+        lzc = __load_libzfs_core()
+    if lzc is None and name == 'libzfs_core':
+        raise ZFSBackupError("zfs_backend libzfs_core asked for, but pyzfs "
+                             + "isn't installed or /dev/zfs can't be used.")
+    zfs_backend = LibZFSCoreBackend(lzc) if lzc else CLIBackend()
+    logging.debug("Using the "+zfs_backend.name+" zfs backend")
+
+
+def __load_libzfs_core():
+    """returns: the libzfs_core module if it imports and works, else None"""
+    try:
+        import libzfs_core
+        import libzfs_core.exceptions
+        # opens /dev/zfs, which needs root and the module loaded
+        libzfs_core.lzc_exists(b'zfsbackup-probe')
+        return libzfs_core
+    except Exception as e:
+        logging.debug("libzfs_core unavailable: "+str(e))
+        return None
+
+
+def apply_config(conf):
+    """Set up the run wide state a config asks for
+       param conf: validated config
+    """
+    set_bandwidth_limit(conf.get('bandwidth_limit'))
+    set_zfs_backend(conf.get('zfs_backend', 'auto'))
+    engine.configure(conf.get('max_commands'), conf.get('max_host_commands'),
+                     conf.get('send_timeout'),
+                     dict((kind, conf.get(key))
+                          for kind, key in SEND_LIMITS.items()),
+                     conf.get('max_sends'))
+
+
+def clear_inventory():
+    """Throw away the run wide zfs inventories"""
+    global inventory, dest_inventory
+    inventory = None
+    dest_inventory = None
+
+
+def config_destinations(datasets):
+    """returns: every dest dict of the dataset dicts from a config"""
+    return [d for ds in datasets for d in ds.get('destinations')]
+
+
 def validate_config(conf_path):
     """Peforms basic validation of config file format.
        I hope for your sake the actual dataset and destination paths
@@ -170,30 +328,662 @@ def validate_config(conf_path):
             raise e
     if not conf.get('datasets'):
         raise ZFSBackupError("Error: no datasets defined, or defined incorrectly.")
+    for key in (('max_workers', 'max_commands', 'max_host_commands',
+                 'max_sends', 'max_attempts') + tuple(SEND_LIMITS.values())):
+        if conf.get(key) is not None:
+            if not isinstance(conf.get(key), int) or conf.get(key) < 1:
+                raise ZFSBackupError("Error: "+key+" must be a positive "
+                                     + "integer.")
+    if conf.get('send_timeout') is not None:
+        if (not isinstance(conf.get('send_timeout'), (int, float))
+                or conf.get('send_timeout') <= 0):
+            raise ZFSBackupError("Error: send_timeout must be a positive "
+                                 + "number of seconds.")
+    parse_rate_schedule(conf.get('bandwidth_limit'))
+    parse_rate(conf.get('estimated_throughput'))
+    parse_interval(conf.get('interval', DEFAULT_INTERVAL))
+    parse_interval(conf.get('retry_delay', '1m'))
+    parse_interval(conf.get('retry_deadline', '2h'))
+    if conf.get('zfs_backend', 'auto') not in ('auto', 'cli', 'libzfs_core'):
+        raise ZFSBackupError("Error: zfs_backend must be auto, cli or "
+                             + "libzfs_core.")
+    __validate_retain(conf.get('retain'))
     for d in conf.get('datasets'):
         if not d or not d.get('dataset_name') or not d.get('destinations'):
             raise ZFSBackupError("Error: dataset config incorrectly defined.")
+        if d.get('interval') is not None:
+            parse_interval(d.get('interval'))
+        for bookmarks in (conf.get('bookmarks', False),
+                          d.get('bookmarks', False)):
+            if not isinstance(bookmarks, bool):
+                raise ZFSBackupError("Error: bookmarks must be true or "
+                                     + "false.")
+        for force_after in (conf.get('force_after'), d.get('force_after')):
+            if force_after is not None and (
+                    not isinstance(force_after, (int, float))
+                    or force_after < 0):
+                raise ZFSBackupError("Error: force_after must be a number "
+                                     + "of hours.")
         for l in d.get('destinations'):
             if (not l) or (not l.get('dest')) or (not l.get('transport')):
                 ZFSBackupError("Error: destination config incorrectly "
                                + "defined for: "+d.get('dataset_name'))
+            send_flags = l.get('send_flags') if l else None
+            if send_flags is not None and not (
+                    (isinstance(send_flags, str) and send_flags in SEND_PROFILES)
+                    or (isinstance(send_flags, list)
+                        and all(f in SEND_FLAGS for f in send_flags))):
+                raise ZFSBackupError("Error: send_flags must be one of "
+                                     + ', '.join(SEND_PROFILES)+" or a list "
+                                     + "of "+', '.join(SEND_FLAGS)+" for: "
+                                     + d.get('dataset_name'))
+            if l:
+                parse_rate_schedule(l.get('bandwidth_limit'))
+                __validate_retain(l.get('retain'))
+            if l and not isinstance(l.get('checksum', False), bool):
+                raise ZFSBackupError("Error: checksum must be true or false "
+                                     + "for: "+d.get('dataset_name'))
+            compression = l.get('compression') if l else None
+            if (compression is not None and compression not in Codec.codecs
+                    and compression not in ('none', 'auto')):
+                raise ZFSBackupError("Error: unknown compression "
+                                     + str(compression)+" for: "
+                                     + d.get('dataset_name'))
+            for key in ('compression_level', 'compression_threads'):
+                value = l.get(key) if l else None
+                if value is not None and (not isinstance(value, int)
+                                          or value < 1):
+                    raise ZFSBackupError("Error: "+key+" must be a positive "
+                                         + "integer for: "
+                                         + d.get('dataset_name'))
     return conf
 
 
-def backup_dataset(dataset, destinations, inc_snap):
+def __validate_retain(retain):
+    """throws: ZFSBackupError if retain isn't a dict of RETAIN_PERIODS
+       to numbers of them to keep"""
+    if retain is None:
+        return
+    if not isinstance(retain, dict) or not all(
+            kind in RETAIN_PERIODS and isinstance(n, int) and n >= 0
+            for kind, n in retain.items()):
+        raise ZFSBackupError("Error: retain must map some of "
+                             + ', '.join(RETAIN_PERIODS)+" to how many "
+                             + "of them to keep.")
+
+
+def estimate_send_size(snapshot, incremental_source=None, send_flags=()):
+    """Ask zfs how big a send would be (zfs send -nvP)
+       param snapshot: snapshot that would be sent
+       param incremental_source: snapshot to use as the incremental source
+       param send_flags: flags the send would use
+       returns: estimated size of the stream in bytes
+       throws: ZFSBackupError if zfs can't tell us
+    """
+    zfs_command = ['zfs', 'send', '-nvP'] + list(send_flags)
+    if incremental_source:
+        zfs_command += ['-i', incremental_source]
+    zfs_command.append(snapshot)
+    try:
+        zfs = engine.run_command(zfs_command, stderr=subprocess.STDOUT)
+    except CalledProcessError as e:
+        raise ZFSBackupError("Unable to estimate send size of "+snapshot
+                             + " Got: "+str(__cleanup_stdout(e.stdout)))
+    except TimeoutExpired:
+        raise ZFSBackupError("Unable to estimate send size of "+snapshot
+                             + ". Timeout reached.")
+    sizes = re.findall(r'^size\s+(\d+)$', zfs.stdout, re.MULTILINE)
+    if not sizes:
+        raise ZFSBackupError("Unable to estimate send size of "+snapshot)
+    return int(sizes[-1])
+
+
+def plan_backups(datasets, inc_snap, conf=None):
+    """Estimate how much every dataset/destination pair of a config run
+       will send and how long it will take. Where the snapshot to send
+       already exists (an interrupted backup) zfs send -nvP is asked,
+       otherwise the estimate comes from the written@inc_snap (or
+       referenced for full sends) of the dataset, all fetched with one
+       zfs get.
+       param datasets: dataset dicts from the config file
+       param inc_snap: the incremental source snapshot
+       param conf: the global config, estimated_throughput in it is the
+       transfer rate to assume where there is no bandwidth limit
+       returns: list of dicts with dataset, dest, transport, kind, bytes
+       and seconds, bytes and seconds are None if there's no estimate
+    """
+    if conf is None:
+        conf = {}
+    default_rate = (parse_rate(conf.get('estimated_throughput'))
+                    or parse_rate('100M'))
+    props = __get_size_properties([ds.get('dataset_name') for ds in datasets],
+                                  inc_snap, __bookmark_datasets(datasets, conf))
+    plans = []
+    for ds in datasets:
+        name = ds.get('dataset_name')
+        try:
+            stragglers = get_stragglers(name)
+            base = incremental_base(name, inc_snap)
+            encrypted = is_encrypted_dataset(name)
+        except ZFSBackupError:
+            stragglers, base, encrypted = [], None, False
+        incremental = base is not None
+        sizes = {}
+        for d in ds.get('destinations'):
+            send_flags = get_send_flags(d, encrypted)
+            size = sizes.get(tuple(send_flags))
+            if size is None:
+                try:
+                    if len(stragglers) == 1:
+                        size = estimate_send_size(stragglers[0], base,
+                                                  send_flags)
+                    else:
+                        size = __estimate_from_properties(
+                            props.get(name, {}), inc_snap, incremental,
+                            '-c' in send_flags or '-w' in send_flags)
+                except ZFSBackupError:
+                    size = None
+                sizes[tuple(send_flags)] = size
+            rates = [default_rate]
+            for limiter in __get_limiters(d):
+                rates.append(limiter.current_rate())
+            rate = min(r for r in rates if r)
+            plans.append({'dataset': name, 'dest': d.get('dest'),
+                          'transport': d.get('transport'),
+                          'kind': 'incremental' if incremental else 'full',
+                          'bytes': size,
+                          'seconds': size / rate if size is not None else None})
+    return plans
+
+
+def __get_size_properties(datasets, inc_snap, bookmarks=()):
+    """Fetch what's needed to estimate send sizes for datasets, in one
+       zfs get for the sizes and one for written@inc_snap.
+       param datasets: list of datasets
+       param inc_snap: the incremental source snapshot (@name)
+       param bookmarks: datasets backed up with bookmarks, see
+       __get_written()
+       returns: dict of dataset -> dict of property -> value
+    """
+    props = __get_properties(datasets,
+                             'referenced,logicalreferenced,compressratio')
+    for name, written in __get_written(datasets, inc_snap,
+                                       bookmarks).items():
+        props.setdefault(name, {}).update(written)
+    return props
+
+
+def __get_written(datasets, inc_snap, bookmarks=()):
+    """Fetch written@inc_snap of datasets, or written#inc_snap for the
+       ones that keep a bookmark, one zfs get for each kind.
+       param datasets: list of datasets
+       param inc_snap: the incremental source snapshot (@name)
+       param bookmarks: datasets backed up with bookmarks
+       returns: dict of dataset -> {'written'+inc_snap: value}, whichever
+       of the two it was
+    """
+    written = {}
+    for marker in (inc_snap, '#'+inc_snap[1:]):
+        names = [name for name in datasets
+                 if (name in bookmarks) == (marker[0] == '#')]
+        if not names:
+            continue
+        for name, props in __get_properties(names,
+                                            'written'+marker).items():
+            if 'written'+marker in props:
+                written[name] = {'written'+inc_snap: props['written'+marker]}
+    return written
+
+
+def __bookmark_datasets(datasets, conf):
+    """returns: set of the names of the datasets that have bookmarks on"""
+    return set(ds.get('dataset_name') for ds in datasets
+               if ds.get('bookmarks', conf.get('bookmarks', False)))
+
+
+def __get_properties(datasets, properties):
+    """Fetch properties of many datasets with a single zfs get
+       param datasets: list of datasets
+       param properties: comma separated properties to get
+       returns: dict of dataset -> dict of property -> value, datasets
+       zfs had nothing to say about are left out
+    """
+    props = {}
+    try:
+        # datasets that don't exist or don't have a snapshot a written@
+        # property asks about make this exit non-zero, the rest are
+        # still there
+        zfs = engine.run_command(['zfs', 'get', '-H', '-p', '-o',
+                                  'name,property,value', properties]
+                                 + list(datasets), timeout=600,
+                                 check=False, stderr=subprocess.DEVNULL)
+    except TimeoutExpired:
+        logging.warning("Timed out getting "+properties+" of datasets")
+        return props
+    for line in __cleanup_stdout(zfs.stdout):
+        fields = line.split('\t')
+        if len(fields) == 3:
+            props.setdefault(fields[0], {})[fields[1]] = fields[2]
+    return props
+
+
+def find_unchanged(datasets, inc_snap, conf=None):
+    """Find the datasets nothing has been written to since their last
+       backup, with one zfs get of written@inc_snap (written#inc_snap
+       for datasets with bookmarks on) for all of them.
+       Those can skip the backup cycle, unless they have stragglers to
+       finish, their last backup is older than force_after hours or a
+       destination doesn't have it (new, wiped or rolled back). The
+       destinations are checked by guid, with one zfs list per transport
+       for the ones the destination inventory doesn't know about.
+       param datasets: list of dataset dicts from the config
+       param inc_snap: the incremental source snapshot (@name)
+       param conf: the global config, for skip_unchanged and force_after
+       returns: set of names of datasets that don't need a backup
+    """
+    if conf is None:
+        conf = {}
+    candidates = [ds for ds in datasets
+                  if ds.get('skip_unchanged',
+                            conf.get('skip_unchanged', True))]
+    if not candidates:
+        return set()
+    written = __get_written([ds.get('dataset_name') for ds in candidates],
+                            inc_snap, __bookmark_datasets(candidates, conf))
+    quiet = {}
+    for ds in candidates:
+        name = ds.get('dataset_name')
+        if written.get(name, {}).get('written'+inc_snap) != '0':
+            continue
+        try:
+            if get_stragglers(name):
+                continue
+            base = incremental_base(name, inc_snap)
+        except ZFSBackupError:
+            continue
+        if base is not None:
+            quiet[name] = base
+    holders = dest_inventory or DestinationInventory()
+    holders.load([d for ds in candidates if ds.get('dataset_name') in quiet
+                  for d in ds.get('destinations') or []
+                  if holders.snapshots(d) is None])
+    unchanged = set()
+    for ds in candidates:
+        name = ds.get('dataset_name')
+        if name not in quiet:
+            continue
+        base = quiet[name]
+        guid = __snapshot_guid(base)
+        missing = [d for d in ds.get('destinations') or []
+                   if guid is None or not any(
+                       info['guid'] == guid for info
+                       in (holders.snapshots(d) or {}).values())]
+        if missing:
+            logging.info("Not skipping unchanged "+name+", "
+                         + ', '.join(d.get('dest')+" via "+d.get('transport')
+                                     for d in missing)
+                         + " doesn't have its last backup")
+            continue
+        force_after = ds.get('force_after', conf.get('force_after'))
+        if force_after is not None:
+            last_backup = __snapshot_creation(base)
+            if (last_backup is None
+                    or time.time() - last_backup >= force_after * 3600):
+                continue
+        unchanged.add(name)
+    return unchanged
+
+
+def __snapshot_creation(snapshot):
+    """returns: creation time of snapshot (or bookmark) in seconds since
+       the epoch, None if it can't be found out"""
+    if snapshot is None:
+        return None
+    info = inventory.get_snapshot(snapshot) if inventory else None
+    if info and info.get('creation') is not None:
+        return info['creation']
+    try:
+        value = zfs_backend.get_property(snapshot, 'creation')
+        return int(value) if value else None
+    except (subprocess.SubprocessError, ValueError):
+        return None
+
+
+def __estimate_from_properties(props, inc_snap, incremental, compressed):
+    """Estimate the size of a send from dataset properties
+       param props: properties of the dataset from __get_size_properties()
+       param inc_snap: the incremental source snapshot (@name)
+       param incremental: True for an incremental send
+       param compressed: True if the stream carries compressed blocks
+       returns: estimated bytes
+       throws: ZFSBackupError if the properties aren't there
+    """
+    try:
+        if incremental:
+            size = int(props['written'+inc_snap])
+            if not compressed:
+                size = int(size * float(props['compressratio'].rstrip('x')))
+            return size
+        if compressed:
+            return int(props['referenced'])
+        return int(props['logicalreferenced'])
+    except (KeyError, ValueError):
+        raise ZFSBackupError("No size estimate available")
+
+
+def order_largest_first(datasets, plans):
+    """Sort datasets so the ones with the most to send come first
+       param datasets: dataset dicts from the config file
+       param plans: output of plan_backups()
+       returns: sorted list of datasets
+    """
+    totals = {}
+    for plan in plans:
+        totals[plan['dataset']] = (totals.get(plan['dataset'], 0)
+                                   + (plan['bytes'] or 0))
+    return sorted(datasets, key=lambda ds: totals.get(ds.get('dataset_name'), 0),
+                  reverse=True)
+
+
+def print_plan(plans):
+    """Print the output of plan_backups() for humans, biggest first
+       param plans: output of plan_backups()
+    """
+    total = 0
+    for plan in sorted(plans, key=lambda p: p['bytes'] or 0, reverse=True):
+        if plan['bytes'] is None:
+            estimate = "unknown size"
+        else:
+            total += plan['bytes']
+            estimate = (__human_bytes(plan['bytes'])+", about "
+                        + str(int(plan['seconds']))+"s")
+        print(plan['dataset']+" -> "+plan['dest']+" via "+plan['transport']
+              + ": "+plan['kind']+", "+estimate)
+    print("Total: "+__human_bytes(total))
+
+
+def __human_bytes(size):
+    """returns: size formatted with a binary unit"""
+    for unit in ('B', 'KiB', 'MiB', 'GiB', 'TiB'):
+        if size < 1024 or unit == 'TiB':
+            return "%.1f %s" % (size, unit)
+        size /= 1024
+
+
+def run_backup_jobs(datasets, inc_snap, conf, max_workers):
+    """Back up datasets from the config, max_workers of them at a time,
+       after snapshotting all of them at once with snapshot_datasets().
+       Destinations that fail for a reason that might go away are retried
+       with backoff, see RetryQueue. What is sent to a host is verified
+       with one listing once the last send to it is over, and only then
+       are the incremental snapshots moved up, see SnapshotVerifier.
+       param datasets: dataset dicts from the config file
+       param inc_snap: the incremental source snapshot
+       param conf: the global config
+       param max_workers: number of datasets to back up at once
+       returns: number of datasets that still failed in the end
+    """
+    errors = 0
+    retries = RetryQueue(conf)
+    # what gets sent to a host is verified in one go once it's all sent
+    verifier = SnapshotVerifier()
+    snaps = snapshot_datasets(resumable_datasets(datasets, conf))
+    # each dataset is its own job, with max_workers of them in flight
+    # at once. max_workers of 1 gives the old one at a time behavior.
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers) as executor:
+        jobs = {}
+
+        def submit(ds, attempt):
+            failed = []
+            # retries pick the snapshot up like an interrupted backup
+            new_snap = snaps.get(ds.get('dataset_name')) if attempt == 1 \
+                else None
+            job = submit_backup(executor.submit, verifier, ds, inc_snap,
+                                conf, failed, new_snap)
+            jobs[job] = (ds, attempt, failed)
+
+        for ds in datasets:
+            submit(ds, 1)
+        while jobs or retries:
+            done, running = concurrent.futures.wait(
+                jobs, timeout=retries.next_due(),
+                return_when=concurrent.futures.FIRST_COMPLETED)
+            for job in done:
+                ds, attempt, failed = jobs.pop(job)
+                try:
+                    if not job.result():
+                        continue
+                except Exception as e:
+                    # anything unexpected still only costs us this dataset
+                    logging.error("Unexpected error while backing up "
+                                  + ds.get('dataset_name')+": "+str(e))
+                    failed = []
+                if not retries.add(ds, failed, attempt, conf):
+                    errors += 1
+            for ds, attempt in retries.pop_due():
+                submit(ds, attempt)
+    return errors
+
+
+def resumable_datasets(datasets, conf):
+    """returns: names of the datasets that have resume on. Only those get
+       their snapshot taken up front, a backup that fails after sending
+       some of it leaves it behind for the next run to pick up."""
+    return [ds.get('dataset_name') for ds in datasets
+            if ds.get('resume', conf.get('resume', True))]
+
+
+def backup_config_dataset(ds, inc_snap, conf=None, failed=None,
+                          new_snap=None):
+    """Run the whole backup cycle for one dataset entry from the config.
+       Checks for stragglers, backs the dataset up to all of its
+       destinations and cleans up old snapshots on them. Meant to be run
+       as its own job, so it reports failure by count instead of raising.
+       A single straggler is taken to be an interrupted backup and is
+       finished off instead, unless resume is turned off.
+       param ds: dataset dict from the config file
+       param inc_snap: the incremental source snapshot
+       param conf: the global config
+       param failed: list to add the dest dicts that weren't backed up to
+       because of something that might be over on another try
+       param new_snap: snapshot snapshot_datasets() took of it for this
+       run (@name), None to take one now
+       returns: number of errors encountered
+    """
+    if conf is None:
+        conf = {}
+    backup = __send_config_dataset(ds, inc_snap, conf, failed, new_snap)
+    if backup is None:
+        return 1
+    return __finish_config_dataset(ds, conf, backup,
+                                   find_snapshots(backup['lookups']))
+
+
+def submit_backup(submit, verifier, ds, inc_snap, conf=None, failed=None,
+                  new_snap=None):
+    """backup_config_dataset() as jobs, verified along with the other
+       backups of the run: sending is one job, finishing it off once
+       verifier has listed what it sent is another.
+       param submit: runs a job, takes a function and its args and returns
+       a concurrent.futures.Future, like an executor's submit
+       param verifier: SnapshotVerifier of the run
+       Takes the other params of backup_config_dataset().
+       returns: concurrent.futures.Future of the number of errors
+    """
+    if conf is None:
+        conf = {}
+    destinations = ds.get('destinations')
+    outcome = concurrent.futures.Future()
+
+    def settle(job):
+        try:
+            errors = job.result()
+        except Exception as e:
+            outcome.set_exception(e)
+            return
+        if errors is not None:
+            outcome.set_result(errors)
+
+    def verified(backup, listings):
+        try:
+            job = submit(__finish_config_dataset, ds, conf, backup, listings)
+        except Exception as e:
+            outcome.set_exception(e)
+            return
+        job.add_done_callback(settle)
+
+    def send():
+        backup = None
+        try:
+            backup = __send_config_dataset(ds, inc_snap, conf, failed,
+                                           new_snap)
+        finally:
+            if backup is None:
+                verifier.done(destinations)
+            else:
+                verifier.done(destinations, backup['lookups'],
+                              lambda listings: verified(backup, listings))
+        # still to be finished off if it got this far
+        return 1 if backup is None else None
+
+    verifier.expect(destinations)
+    submit(send).add_done_callback(settle)
+    return outcome
+
+
+def __send_config_dataset(ds, inc_snap, conf, failed, new_snap):
+    """Sending half of backup_config_dataset()
+       returns: the send_backup() of it, None if it failed
+    """
+    # for each dataset check stragglers
+    # if none, backup
+    name = ds.get('dataset_name')
+    try:
+        stragglers = get_stragglers(name)
+    except ZFSBackupError:
+        logging.warning("Unable to get list of existing snapshots for "
+                        + "dataset: "+name+". IT WAS NOT BACKED UP!")
+        if failed is not None:
+            failed.extend(ds.get('destinations'))
+        if new_snap is not None:
+            __drop_unsent(name+new_snap, False)
+        return None
+    resume = ds.get('resume', conf.get('resume', True))
+    fresh = new_snap is not None and stragglers == [name+new_snap]
+    if fresh:
+        # taken for this run, not something left over
+        pass
+    elif len(stragglers) == 1 and resume:
+        new_snap = '@'+stragglers[0].split('@')[1]
+        logging.info("Dataset: "+name+" has an interrupted backup, resuming "
+                     + "it from "+name+new_snap)
+    elif stragglers:
+        logging.warning("Dataset: "+name+" has left over temporary "
+                        + "snapshots. IT WAS NOT BACKED UP! You need "
+                        + "to resolve this manually. Make sure "
+                        + "everything is consistent and remove "
+                        + "the left over zfsbackup-yyyymmdd-hhmm snaps.")
+        return None
+    else:
+        new_snap = None
+    try:
+        return send_backup(name, ds.get('destinations'), inc_snap,
+                           new_snap=new_snap, failed=failed, fresh=fresh,
+                           bookmark=ds.get('bookmarks',
+                                           conf.get('bookmarks', False)))
+    except ZFSBackupError:
+        logging.warning("Dataset backup of "+name+" to "
+                        + str(ds.get('destinations'))+" FAILED!"
+                        + " YOU'LL WANT TO SEE TO THAT!")
+        return None
+
+
+def __finish_config_dataset(ds, conf, backup, listings):
+    """Finishing half of backup_config_dataset()
+       param backup: what __send_config_dataset() returned
+       param listings: find_snapshots() of its lookups
+       returns: number of errors encountered
+    """
+    try:
+        finish_backup(backup, listings)
+    except ZFSBackupError:
+        logging.warning("Dataset backup of "+ds.get('dataset_name')+" to "
+                        + str(ds.get('destinations'))+" FAILED!"
+                        + " YOU'LL WANT TO SEE TO THAT!")
+        # the ones that made it don't wait for the others to be retried
+        good = [d for d in ds.get('destinations') if d not in backup['bad']]
+        try:
+            clean_dest_snaps(good, conf.get('retain_snaps'),
+                             conf.get('retain'))
+        except ZFSBackupError as e:
+            logging.warning("Unable to clean up the destinations of "
+                            + ds.get('dataset_name')+" that were backed "
+                            + "up: "+e.message)
+        return 1
+    try:
+        # Delete old snaps
+        clean_dest_snaps(ds.get('destinations'), conf.get('retain_snaps'),
+                         conf.get('retain'))
+    except ZFSBackupError:
+        logging.warning("Dataset backup of "+ds.get('dataset_name')+" to "
+                        + str(ds.get('destinations'))+" FAILED!"
+                        + " YOU'LL WANT TO SEE TO THAT!")
+        return 1
+    return 0
+
+
+def backup_dataset(dataset, destinations, inc_snap, new_snap=None,
+                   failed=None, fresh=False, bookmark=False):
     """Backup a dataset to the specified destinations using the specified
        transport. If it is determined that this is an incremental backup
        it will do an incremental send and delete the old inc_snap and
        rename the most recent snapshot to inc_snap.
        Otherwise it will create a snap, send it, and rename it to
        inc_snap when finished.
+       If new_snap is given it is used instead of creating a new snapshot,
+       which is how an interrupted backup is picked up again. Destinations
+       that already have it are not sent to again, and interrupted
+       receives are resumed.
+       This is send_backup() and finish_backup() in one go, verifying
+       right away instead of along with other backups.
        param dataset: dataset to be backed up
        param destinations: list of dest dicts
        param inc_snap: the incremental source snapshot
+       param new_snap: existing snapshot to back up (@name)
+       param failed: list to add the dest dicts that didn't get the backup
+       to and might on another try. That's all of them if it failed before
+       or after the sends, but never refused destinations.
+       param fresh: new_snap was only just taken, so no destination has it
+       param bookmark: keep a #inc_snap bookmark instead of the inc_snap
+       snapshot, the sent snapshot is destroyed once it's bookmarked
        raises: ZFSBackupError"""
+    backup = send_backup(dataset, destinations, inc_snap, new_snap=new_snap,
+                         failed=failed, fresh=fresh, bookmark=bookmark)
+    finish_backup(backup, find_snapshots(backup['lookups']))
+
+
+def send_backup(dataset, destinations, inc_snap, new_snap=None,
+                failed=None, fresh=False, bookmark=False):
+    """First half of backup_dataset(): snapshot the dataset if needed and
+       send it to the destinations. Nothing is renamed or deleted until
+       finish_backup() has the sent snapshot verified.
+       Takes the same params as backup_dataset().
+       A snapshot taken for this backup that it fails before sending is
+       destroyed again, one that was sent stays behind for the next run
+       to resume from.
+       returns: the backup, a dict for finish_backup(). Its 'lookups' are
+       the snapshots to list for verification, transport -> names.
+       raises: ZFSBackupError"""
+    taken = fresh
+    sending = False
+    refused = []
     try:
         for d in destinations:
             transport = d.get("transport")
+            if dest_inventory and dest_inventory.reachable(transport):
+                # listed it at the start of the run
+                continue
             if get_transport_type(transport) == "ssh":
                 # if we're doing ssh and the connection fails abort to avoid nuisance snapshot cleanup.
                 username, hostname, port = parse_ssh_transport(transport)
@@ -203,62 +993,104 @@ def backup_dataset(dataset, destinations, inc_snap):
                     raise ZFSBackupError("Error: Test connection to "+transport+" failed. Aborting.")
                 except TimeoutExpired as e:
                     raise ZFSBackupError("Error: Test connection to "+transport+" timed out. Aborting.")
-        new_snap = create_timestamp_snap(dataset)
-        if has_backuplast(dataset, inc_snap):
-            errors = 0
+        if new_snap is None:
+            new_snap = create_timestamp_snap(dataset)
+            taken = True
+            pending = destinations
+        elif fresh:
+            pending = destinations
+        else:
+            pending = [d for d in destinations
+                       if not __dest_has_snapshot(d, new_snap)]
+        base = incremental_base(dataset, inc_snap)
+        incremental = base is not None
+        unsent = []
+        if incremental:
             # do incremental
-            for d in destinations:
-                current_errors = False
-                destination = d.get("dest")
-                transport = d.get("transport")
-                try:
-                    send_incremental(dataset+inc_snap, dataset+new_snap,
-                                     destination, transport=transport)
-                    logging.info("Incremental send of "+dataset+new_snap+" to "
-                             + destination+" via "+transport
-                             + " finished.")
-                except ZFSBackupError as e:
-                    errors += 1
-                    current_errors = True
-                if not current_errors and verify_backup(new_snap, destination, transport):
-                    # good backup
-                    logging.info("Verifcation of "+destination+new_snap+" via "+transport+" succeeded")
-                else:
-                    # verify failed for whatever reason
-                    errors +=1
-            if errors > 0:
-                raise ZFSBackupError("Errors were encountered while backing up "+dataset+new_snap+". Please check the logs.")
+            if pending:
+                sending = True
+                unsent = send_snapshot_multi(dataset+new_snap, pending,
+                                             incremental_source=base)
+            kind = "Incremental"
+        else:
+            # do full send, except to destinations that still have a
+            # snapshot in common with the source
+            bases, unsent, refused = __common_bases(dataset, new_snap,
+                                                    pending)
+            unsent += refused
+            for source, group in bases:
+                sending = True
+                unsent += send_snapshot_multi(dataset+new_snap, group,
+                                              incremental_source=source)
+            kind = "Full"
+        sent = [d for d in destinations if d not in unsent]
+        lookups = {}
+        for d in sent:
+            destination = d.get("dest")
+            transport = d.get("transport")
+            if d not in pending:
+                logging.info(destination+" via "+transport+" already has "
+                             + dataset+new_snap)
+            logging.info(kind+" send of "+dataset+new_snap+" to "
+                         + destination+" via "+transport+" finished.")
+            lookups.setdefault(transport.lower(), []).append(
+                destination+new_snap)
+        guid = __snapshot_guid(dataset+new_snap) if sent else None
+        if sent and guid is None:
+            logging.warning("Unable to get the guid of "+dataset+new_snap
+                            + ", only checking that it's at the "
+                            + "destinations")
+    except ZFSBackupError as e:
+        logging.error("Failed backup of "+dataset+" to "+str(destinations))
+        if failed is not None:
+            failed.extend(destinations)
+        if new_snap is not None:
+            __drop_unsent(dataset+new_snap, taken and not sending)
+        raise e
+    return {'dataset': dataset, 'destinations': destinations,
+            'inc_snap': inc_snap, 'new_snap': new_snap, 'base': base,
+            'bookmark': bookmark, 'sent': sent, 'unsent': unsent,
+            'guid': guid, 'failed': failed, 'lookups': lookups,
+            'taken': taken, 'sending': sending, 'refused': refused}
+
+
+def finish_backup(backup, listings):
+    """Second half of backup_dataset(): verify the sends of a backup from
+       send_backup() and move the incremental source up to the sent
+       snapshot, provided every destination got it.
+       param backup: what send_backup() returned
+       param listings: find_snapshots() of the backup's lookups, it may
+       have more in it
+       raises: ZFSBackupError"""
+    dataset = backup['dataset']
+    destinations = backup['destinations']
+    inc_snap = backup['inc_snap']
+    new_snap = backup['new_snap']
+    base = backup['base']
+    failed = backup['failed']
+    bad = []
+    try:
+        # verify failed for whatever reason
+        bad = backup['unsent'] + __check_listings(new_snap, backup['sent'],
+                                                  backup['guid'], listings)
+        errors = len(bad)
+        if errors > 0:
+            raise ZFSBackupError("Errors were encountered while backing up "+dataset+new_snap+". Please check the logs.")
+        if backup['bookmark']:
+            __keep_bookmark(dataset, new_snap, inc_snap, base)
+            return
+        if base is not None:
             # delete old incremental marker
             try:
-                delete_snapshot(dataset+inc_snap)
-                logging.info("Deleted old incremental snapshot")
+                if '#' in base:
+                    delete_bookmark(base)
+                else:
+                    delete_snapshot(base)
+                logging.info("Deleted old incremental "+base)
             except ZFSBackupError as e:
-                logging.error("Unable to delete "+dataset+inc_snap
+                logging.error("Unable to delete "+base
                               + " YOU NEED TO DELETE THAT AND THEN RENAME "
                               + dataset+new_snap+" TO "+dataset+inc_snap)
-        else:
-            # do full send
-            errors = 0
-            for d in destinations:
-                current_errors = False
-                destination = d.get("dest")
-                transport = d.get("transport")
-                try:
-                    send_full(dataset+new_snap, destination,
-                            transport=transport)
-                    logging.info("Full send of "+dataset+new_snap+" to "
-                             + destination
-                             + " via "+transport+" finished.")
-                except ZFSBackupError as e:
-                    errors += 1
-                if not current_errors and verify_backup(new_snap, destination, transport):
-                    # good backup
-                    logging.info("Verifcation of "+destination+new_snap+" via "+transport+" succeeded")
-                else:
-                    # verify failed
-                    errors += 1
-            if errors > 0:
-                raise ZFSBackupError("Errors were encountered while backing up "+dataset+new_snap+". Please check the logs.")
         # rename dataset+new_snap to dataset+inc_snap
         try:
             rename_snapshot(dataset+new_snap, dataset+inc_snap)
@@ -271,44 +1103,332 @@ def backup_dataset(dataset, destinations, inc_snap):
             raise e
     except ZFSBackupError as e:
         logging.error("Failed backup of "+dataset+" to "+str(destinations))
+        backup['bad'] = bad or destinations
+        if failed is not None:
+            # refusals would only be refused again
+            failed.extend(d for d in backup['bad']
+                          if d not in backup['refused'])
+        __drop_unsent(dataset+new_snap,
+                      backup['taken'] and not backup['sending'])
         raise e
 
 
-def verify_backup(snapshot, destination, transport):
+def __drop_unsent(snapshot, destroy):
+    """Deal with the snapshot of a backup that failed, and say so
+       param snapshot: the snapshot that was being backed up
+       param destroy: it was taken for the backup and nothing was sent
+       from it, so there's nothing to resume
+    """
+    if destroy:
+        try:
+            delete_snapshot(snapshot)
+            logging.info("Destroyed "+snapshot+", the backup failed "
+                         + "before sending it anywhere")
+            return
+        except ZFSBackupError:
+            logging.error("Unable to destroy "+snapshot+", it was never "
+                          + "sent anywhere")
+    logging.warning("Left "+snapshot+" behind, the next backup of "
+                    + snapshot.split('@')[0]+" resumes from it unless "
+                    + "resume is off")
+
+
+def __keep_bookmark(dataset, new_snap, inc_snap, base):
+    """Finish a backup by making new_snap the #inc_snap bookmark the next
+       incremental is sent from, and destroying it. Anything that goes
+       wrong leaves new_snap as a straggler, which the next run picks up
+       again and finishes off. The old bookmark is only destroyed once
+       the new one exists as #inc_snap-next, that stands in for it until
+       it's been replaced.
+       param dataset: dataset that was backed up
+       param new_snap: snapshot that was sent (@name)
+       param inc_snap: the incremental source snapshot (@name)
+       param base: what the send was incremental from, None for full
+       raises: ZFSBackupError
+    """
+    bookmark = dataset+'#'+inc_snap[1:]
+    staging = bookmark+'-next'
+    if base != staging and staging in get_bookmarks(dataset):
+        # left behind by a backup that didn't get to finish
+        delete_bookmark(staging)
+    if base == bookmark:
+        # bookmarks can't be renamed or replaced, so the new one is made
+        # under another name before the old one goes. There's always
+        # something to send the next incremental from.
+        create_bookmark(dataset+new_snap, staging)
+        delete_bookmark(bookmark)
+        base = staging
+    create_bookmark(dataset+new_snap, bookmark)
+    logging.info("Bookmarked "+dataset+new_snap+" as "+bookmark)
+    if base == staging:
+        delete_bookmark(staging)
+    if base == dataset+inc_snap:
+        # switching over from keeping the snapshot
+        try:
+            delete_snapshot(base)
+        except ZFSBackupError:
+            logging.error("Unable to delete "+base+" YOU NEED TO DELETE "
+                          + "THAT, the next backup would be sent from it")
+            raise
+    delete_snapshot(dataset+new_snap)
+    logging.info("Deleted "+dataset+new_snap+", it's been backed up")
+
+
+def verify_backup(snapshot, destination, transport, guid=None):
     """Verify backup is at destination
        param snapshot: snapshot that needs its presence verified (@name)
        param destination: where snapshot should be (dataset)
        param transport: how to get to destination
+       param guid: guid the snapshot has to have, None to only check
+       that it's there
        returns: True if the snapshot is present at destination, else False
+       throws: ZFSBackupError if it isn't there or can't be checked
        """
-    try:
-        if get_transport_type(transport) == 'local':
-            zfs_command = ['zfs', 'list', '-H', '-t', 'snapshot',
-                           '-o', 'name', destination+snapshot]
-            zfs = subprocess.run(zfs_command, check=True, timeout=60,
-                                 encoding='utf-8', stderr=subprocess.DEVNULL,
-                                 stdout=subprocess.DEVNULL)
-            return True
-        elif get_transport_type(transport) == 'ssh':
-            # TODO: make the ssh communication it's own function probably
-            username, hostname, port = parse_ssh_transport(transport)
-            zfs = "zfs list -H -t snapshot -o name "+destination+snapshot
-            ssh_command = ['ssh', '-o', 'PreferredAuthentications=publickey',
-                           '-o', 'PubkeyAuthentication=yes',
-                           '-o', 'StrictHostKeyChecking=yes', '-p', port, '-l',
-                           username, hostname, zfs]
-            ssh = subprocess.run(ssh_command, check=True, timeout=60,
-                                 encoding='utf-8', stderr=subprocess.DEVNULL,
-                                 stdout=subprocess.DEVNULL)
-            return True
-        else:
-            # crap we don't do
-            return False
-    except Exception:
-        logging.error("Unable to verify snap: "+snapshot+" exists at: "
-                      + destination+" via "+transport)
+    if get_transport_type(transport) not in ('local', 'ssh'):
+        # crap we don't do
+        return False
+    listings = find_snapshots({transport.lower(): [destination+snapshot]})
+    if __check_listings(snapshot, [{'dest': destination,
+                                    'transport': transport}], guid, listings):
         raise ZFSBackupError("Failed to verify backup of "+snapshot+" to "
                              + destination+" via "+transport)
+    return True
+
+
+def verify_backups(snapshot, destinations):
+    """Verify a snapshot made it to every destination intact: the copy
+       there has to have the same guid as the source. Destinations on the
+       same host are all checked with a single zfs list.
+       param snapshot: the source snapshot (dataset@name)
+       param destinations: list of dest dicts it was sent to
+       returns: list of the dest dicts it couldn't be verified at
+    """
+    if not destinations:
+        return []
+    guid = __snapshot_guid(snapshot)
+    if guid is None:
+        logging.warning("Unable to get the guid of "+snapshot+", only "
+                        + "checking that it's at the destinations")
+    snapshot = '@'+snapshot.split('@')[1]
+    names = {}
+    for d in destinations:
+        names.setdefault(d.get('transport').lower(), []).append(
+            d.get('dest')+snapshot)
+    return __check_listings(snapshot, destinations, guid,
+                            find_snapshots(names))
+
+
+def __common_bases(dataset, new_snap, destinations):
+    """Find the snapshot or bookmark of dataset each destination can be
+       sent to incrementally from, by guid, for when there's no inc_snap
+       to send from. Only the newest snapshot of a destination will do:
+       receiving from an older one would roll back and destroy the newer
+       ones, so destinations like that are refused. So are destinations
+       with snapshots but nothing in common, a full send would replace
+       them. Destinations come from dest_inventory, the ones it doesn't
+       know are listed first, with one zfs list per transport.
+       param dataset: dataset being backed up
+       param new_snap: the snapshot about to be sent (@name)
+       param destinations: list of dest dicts
+       returns: (list of (incremental source or None, list of dest dicts),
+       list of dest dicts that couldn't be looked at, list of refused dest
+       dicts), None being a full send. Refusals stand until someone sorts
+       the destination out, the others may go away on their own.
+    """
+    if not destinations:
+        return [], [], []
+    try:
+        zfs = engine.run_command(['zfs', 'list', '-H', '-p', '-t',
+                                  'snapshot,bookmark', '-o', 'name,guid',
+                                  '-s', 'createtxg', '-d', '1', dataset],
+                                 timeout=600)
+    except (CalledProcessError, TimeoutExpired):
+        logging.warning("Unable to list the snapshots of "+dataset
+                        + ", not sending it")
+        return [], list(destinations), []
+    # newest first, the snapshot being sent doesn't count
+    sources = [line.split('\t') for line in __cleanup_stdout(zfs.stdout)
+               if line.split('\t')[0] != dataset+new_snap]
+    sources.reverse()
+    holders = dest_inventory or DestinationInventory()
+    holders.load([d for d in destinations if holders.dataset(d) is None])
+    groups = collections.OrderedDict()
+    unreachable = []
+    refused = []
+    for d in destinations:
+        where = d.get('dest')+" via "+d.get('transport')
+        info = holders.dataset(d)
+        if info is None:
+            logging.error("Unable to list "+where+", not sending "
+                          + dataset+new_snap+" to it")
+            unreachable.append(d)
+            continue
+        if not info['snapshots'] or (
+                info['token'] and __resume_token_snapshot(info['token'])
+                == dataset+new_snap):
+            # nothing there yet, or the full send was interrupted
+            groups.setdefault(None, []).append(d)
+            continue
+        newest = list(info['snapshots'].values())[-1]['guid']
+        base = next((name for name, guid in sources if guid == newest),
+                    None)
+        if base is None:
+            guids = set(snap['guid'] for snap in info['snapshots'].values())
+            if any(guid in guids for name, guid in sources):
+                logging.error(where+" has snapshots newer than the last "
+                              + "one it has of "+dataset+", receiving "
+                              + dataset+new_snap+" would destroy them. "
+                              + "NOT SENDING IT THERE!")
+            else:
+                logging.error(where+" has snapshots, but none of "+dataset
+                              + ", receiving "+dataset+new_snap+" would "
+                              + "destroy them. NOT SENDING IT THERE!")
+            refused.append(d)
+            continue
+        logging.info(where+" has "+base+", sending "+dataset+new_snap
+                     + " incrementally from it")
+        groups.setdefault(base, []).append(d)
+    return list(groups.items()), unreachable, refused
+
+
+def __check_listings(snapshot, destinations, guid, listings):
+    """Look for snapshot at destinations in what find_snapshots() found.
+       param snapshot: snapshot name (@name)
+       param destinations: list of dest dicts
+       param guid: guid the copies have to have, None to not check
+       param listings: find_snapshots() result with the destinations in it
+       returns: list of the dest dicts it couldn't be verified at
+    """
+    failed = []
+    for d in destinations:
+        transport = d.get('transport')
+        name = d.get('dest')+snapshot
+        listing = listings.get(transport.lower(), {})
+        if isinstance(listing, Exception):
+            logging.error("Unable to verify snap: "+snapshot+" exists at: "
+                          + d.get('dest')+" via "+transport+": "
+                          + str(listing))
+        elif name not in listing:
+            logging.error("Unable to verify snap: "+snapshot+" exists at: "
+                          + d.get('dest')+" via "+transport)
+        elif guid is not None and listing[name] != guid:
+            logging.error("Verification of "+name+" via "+transport
+                          + " failed: it has guid "+listing[name]
+                          + ", the source has "+guid)
+        else:
+            logging.info("Verifcation of "+name+" via "+transport
+                         + " succeeded")
+            continue
+        failed.append(d)
+    return failed
+
+
+def find_snapshots(names):
+    """Look snapshots up at destinations, with one zfs list per transport
+       for all of its names, the transports all at once.
+       param names: dict of transport -> snapshot names (dataset@name) to
+       look up there
+       returns: dict of transport -> dict of snapshot name -> guid of the
+       ones that are there, or the exception that kept it from being listed
+    """
+    if not names:
+        return {}
+    for transport in names:
+        if get_transport_type(transport) == 'ssh':
+            # set up outside the engine, connecting blocks
+            ssh_pool.connect(*parse_ssh_transport(transport))
+    return engine.call(__list_snapshots(names))
+
+
+async def __list_snapshots(names):
+    """param names: dict of transport -> snapshot names to look up there
+       returns: dict of transport -> dict of snapshot name -> guid, or the
+       exception that kept it from being listed
+    """
+    transports = list(names)
+    results = await asyncio.gather(
+        *[__list_transport(t, sorted(set(names[t]))) for t in transports],
+        return_exceptions=True)
+    return dict(zip(transports, results))
+
+
+async def __list_transport(transport, names, max_length=65536):
+    """List snapshots at a transport, in as few zfs lists as the command
+       line length allows
+       param transport: transport of the destinations
+       param names: snapshots to look for (dataset@name)
+       param max_length: longest zfs list command line to build
+       returns: dict of snapshot -> guid for the names that exist
+       throws: CalledProcessError if the host can't be reached,
+       TimeoutExpired
+    """
+    base = ['zfs', 'list', '-H', '-p', '-t', 'snapshot', '-o', 'name,guid']
+    chunks = [[]]
+    length = 0
+    for name in names:
+        if chunks[-1] and length + len(name) + 1 > max_length:
+            chunks.append([])
+            length = 0
+        chunks[-1].append(name)
+        length += len(name) + 1
+    found = {}
+    for chunk in chunks:
+        command = base + chunk
+        host = 'localhost'
+        if get_transport_type(transport) == 'ssh':
+            user, host, port = parse_ssh_transport(transport)
+            command = ssh_pool.command(user, host, port, ' '.join(command))
+        # missing snapshots make zfs exit 1, the rest are still listed
+        zfs = await engine.command(command, host=host, check=False)
+        if zfs.returncode not in (0, 1):
+            raise CalledProcessError(zfs.returncode, command,
+                                     output=zfs.stdout, stderr=zfs.stderr)
+        for line in zfs.stdout.split('\n'):
+            fields = line.split('\t')
+            if len(fields) == 2:
+                found[fields[0]] = fields[1]
+    return found
+
+
+def __snapshot_guid(snapshot):
+    """returns: guid of snapshot (dataset@name) or bookmark (dataset#name),
+       None if unknown"""
+    info = inventory.get_snapshot(snapshot) if inventory else None
+    if info and info.get('guid') is not None:
+        return info['guid']
+    try:
+        return zfs_backend.get_property(snapshot, 'guid')
+    except subprocess.SubprocessError:
+        return None
+
+
+def __dest_has_snapshot(dest, snapshot):
+    """Check whether a destination already has a snapshot
+       param dest: dest dict to look at
+       param snapshot: snapshot to look for (@name)
+       returns: True if the snapshot is there, else False
+       throws: ZFSBackupError if the destination can't be reached
+    """
+    snapshots = dest_inventory.snapshots(dest) if dest_inventory else None
+    if snapshots is not None:
+        return dest.get('dest')+snapshot in snapshots
+    zfs_command = ['zfs', 'list', '-H', '-t', 'snapshot', '-o', 'name',
+                   dest.get('dest')+snapshot]
+    transport = dest.get('transport')
+    try:
+        if get_transport_type(transport) == 'ssh':
+            user, host, port = parse_ssh_transport(transport)
+            __run_ssh_command(user, host, port, zfs_command)
+        else:
+            __run_command(zfs_command)
+        return True
+    except CalledProcessError as e:
+        if e.returncode == 255 and get_transport_type(transport) == 'ssh':
+            raise ZFSBackupError("Unable to reach "+transport)
+        return False
+    except TimeoutExpired:
+        raise ZFSBackupError("Timed out looking for "+dest.get('dest')
+                             + snapshot+" via "+transport)
 
 
 def create_snapshot(dataset, name):
@@ -318,9 +1438,8 @@ def create_snapshot(dataset, name):
        throws: ZFSBackupError if snapshot fails
        """
     try:
-        zfs = subprocess.run(['zfs', 'snap', dataset+'@'+name], timeout=60,
-                             stderr=subprocess.PIPE, check=True,
-                             encoding='utf-8')
+        zfs_backend.snapshot([dataset+'@'+name])
+        __add_to_inventory([dataset+'@'+name])
     except CalledProcessError as e:
         # returned non-zero
         raise ZFSBackupError("Failed to create snapshot "+dataset+'@'+name
@@ -331,6 +1450,110 @@ def create_snapshot(dataset, name):
                              '@' + name+". Timeout reached.")
 
 
+def snapshot_datasets(datasets, max_length=65536):
+    """Take a run's zfsbackup-<timestamp> snapshots up front: one for every
+       dataset that doesn't have a left over one already, all with the
+       same name and with as few zfs snapshot calls as the command line
+       allows (usually one per pool, zfs can't snapshot across pools in
+       one call). The snapshots made by one call are atomic, so they're
+       all of the same point in time.
+       param datasets: names of the datasets to snapshot
+       param max_length: longest list of snapshots to hand to one call
+       returns: dict of dataset -> snapshot taken of it (@name). Datasets
+       that were left out, or whose call failed, aren't in it and get
+       snapshotted on their own when they're backed up.
+    """
+    name = '@zfsbackup-'+datetime.now().strftime('%Y%m%d-%H%M%S')
+    pools = collections.OrderedDict()
+    for dataset in datasets:
+        try:
+            if get_stragglers(dataset):
+                continue
+        except ZFSBackupError:
+            # its backup will complain about it
+            continue
+        pools.setdefault(dataset.split('/')[0], []).append(dataset)
+    chunks = []
+    for pool_datasets in pools.values():
+        chunks.append([])
+        length = 0
+        for dataset in pool_datasets:
+            if chunks[-1] and length + len(dataset+name) + 1 > max_length:
+                chunks.append([])
+                length = 0
+            chunks[-1].append(dataset)
+            length += len(dataset+name) + 1
+    taken = {}
+    for chunk in filter(None, chunks):
+        try:
+            zfs_backend.snapshot([dataset+name for dataset in chunk])
+        except (CalledProcessError, TimeoutExpired) as e:
+            logging.warning("Unable to snapshot "+str(len(chunk))
+                            + " datasets at once, they will be snapshotted "
+                            + "one at a time. Got: "
+                            + str(__cleanup_stdout(getattr(e, 'stderr',
+                                                           None))))
+            continue
+        __add_to_inventory([dataset+name for dataset in chunk])
+        for dataset in chunk:
+            taken[dataset] = name
+    if taken:
+        logging.info("Created "+name+" of "+str(len(taken))+" datasets")
+    return taken
+
+
+def __add_to_inventory(snapshots):
+    """Record snapshots that were just taken in the inventory, guids and
+       all, with one zfs get for the lot so verification doesn't have to
+       ask for them one at a time.
+       param snapshots: list of snapshots (dataset@name)
+    """
+    if not inventory:
+        return
+    guids = __get_properties(snapshots, 'guid')
+    for snapshot in snapshots:
+        inventory.add_snapshot(snapshot,
+                               guids.get(snapshot, {}).get('guid'))
+
+
+def create_bookmark(snapshot, bookmark):
+    """Bookmark a snapshot
+       param snapshot: snapshot to bookmark (dataset@name)
+       param bookmark: bookmark to create (dataset#name)
+       throws: ZFSBackupError if the bookmark can't be made
+    """
+    try:
+        zfs_backend.bookmark(snapshot, bookmark)
+        if inventory:
+            inventory.add_bookmark(bookmark, snapshot)
+    except CalledProcessError as e:
+        raise ZFSBackupError("Failed to bookmark "+snapshot+" as "+bookmark
+                             + " Got: "+str(__cleanup_stdout(e.stderr)))
+    except TimeoutExpired:
+        raise ZFSBackupError("Failed to bookmark "+snapshot+" as "+bookmark
+                             + ". Timeout reached.")
+
+
+def delete_bookmark(bookmark):
+    """Destroy a bookmark
+       param bookmark: bookmark to destroy (dataset#name)
+       throws: ZFSBackupError if it can't be destroyed
+    """
+    if '#' not in bookmark:
+        raise ZFSBackupError("Tried to delete something other than a "
+                             + "bookmark. Was: "+bookmark)
+    try:
+        zfs_backend.destroy(bookmark)
+        if inventory:
+            inventory.remove_bookmark(bookmark)
+    except CalledProcessError as e:
+        raise ZFSBackupError("Failed to delete bookmark "+bookmark
+                             + " Got: "+str(__cleanup_stdout(e.stderr)))
+    except TimeoutExpired:
+        raise ZFSBackupError("Unable to destroy bookmark "+bookmark
+                             + ". Timeout reached.")
+
+
 def create_timestamp_snap(dataset):
     """Create a snapshot with the zfsbackup-YYYYMMDD-HHMM name format.
        returns name of created snapshot
@@ -356,9 +1579,9 @@ def delete_snapshot(snapshot):
         raise ZFSBackupError(
             "Tried to delete something other than a snapshot. Was: "+snapshot)
     try:
-        zfs = subprocess.run(['zfs', 'destroy', snapshot], timeout=180,
-                             stderr=subprocess.PIPE, check=True,
-                             encoding='utf-8')
+        zfs_backend.destroy(snapshot)
+        if inventory:
+            inventory.remove_snapshot(snapshot)
     except CalledProcessError as e:
         # returned non-zero
         logging.error("Unable to destroy snapshot "+snapshot)
@@ -377,9 +1600,9 @@ def rename_dataset(dataset, newname):
        throws: ZFSBackupError if rename fails
     """
     try:
-        zfs = subprocess.run(['zfs', 'rename', dataset, newname],
-                             stderr=subprocess.PIPE, check=True, timeout=60,
-                             encoding='utf-8')
+        zfs_backend.rename(dataset, newname)
+        if inventory:
+            inventory.rename(dataset, newname)
     except CalledProcessError as e:
         # command returned non-zero error code
         logging.error("Error: Unable to rename dataset "+dataset+"to "+newname)
@@ -422,102 +1645,529 @@ def send_snapshot(snapshot, destination, transport='local',
     param incremental_source: snapshot to use as the incremental source
     throws: ZFSBackup error if send fails, or snapshot params aren't snapshots
     """
-    send_flags = '-ec'
-    recv_flags = '-F'
-    if is_encrypted_dataset(snapshot):
-        send_flags = '-w'
-        recv_flags = ''
-    elif get_transport_type(transport) == "ssh":
-        send_flags = ""
+    failed = send_snapshot_multi(snapshot,
+                                 [{'dest': destination, 'transport': transport}],
+                                 incremental_source=incremental_source)
+    if failed:
+        raise ZFSBackupError("Send of "+snapshot+" to "+destination
+                             + " via "+transport+" failed.")
+
 
+def send_snapshot_multi(snapshot, destinations, incremental_source=None):
+    """Send a snapshot to several destinations while only reading it from
+    the source once. Destinations that can share a stream (same send flags)
+    get a single zfs send whose output is teed to each of their receive
+    pipelines. A destination that fails or stalls is dropped on its own,
+    the rest carry on.
+    param snapshot: snapshot to be sent
+    param destinations: list of dest dicts
+    param incremental_source: snapshot to use as the incremental source
+    returns: list of the dest dicts the send failed for
+    throws: ZFSBackupError if snapshot params aren't snapshots, or a
+    transport is invalid
+    """
     if '@' not in snapshot:
         raise ZFSBackupError("Error: tried to send non snapshot "+snapshot)
-    
-    if incremental_source:
-        if '@' not in incremental_source:
-            raise ZFSBackupError("incremental_source not a snapshot. snap: "
-                                 + snapshot+" dest: "+destination
-                                 + " inc_source: "+incremental_source)
-        if not send_flags:
-            zsend_command = ["zfs", "send", "-i", incremental_source, snapshot]
-        else:
-            zsend_command = ['zfs', 'send', send_flags, '-i', incremental_source,
-                         snapshot]
-    else:
-        if not send_flags:
-            zsend_command = ["zfs", "send", snapshot]
-        else:
-            zsend_command = ['zfs', 'send', send_flags, snapshot]
+    if incremental_source and '@' not in incremental_source \
+            and '#' not in incremental_source:
+        raise ZFSBackupError("incremental_source not a snapshot. snap: "
+                             + snapshot+" dests: "+str(destinations)
+                             + " inc_source: "+incremental_source)
+    for d in destinations:
+        if get_transport_type(d.get('transport')) not in ('local', 'ssh'):
+            # some transport we don't support
+            # shouldn't happen with config parsing
+            # handle it anyway
+            raise ZFSBackupError("Invalid transport: "+d.get('transport'))
 
-    zrecv_command = ['zfs', 'recv', recv_flags, destination]
-    if get_transport_type(transport) == 'local':
-        with run('zfs send', zsend_command, stdout=subprocess.PIPE, stderr=subprocess.PIPE) as zfs_send:
-            with run('zfs recv', zrecv_command, stdin=zfs_send.stdout, stderr=subprocess.PIPE) as zfs_recv:
-                try:
-                    zfs_recv.wait()
-                    if zfs_recv.returncode != 0:
-                        zfs_send.kill()
-                        zfs_send.wait()
-                        raise ZFSBackupError("zfs recv of "+snapshot+" to "
-                                             + destination+" failed.")
-                    zfs_send.wait()
-                    if zfs_send.returncode != 0:
-                        raise ZFSBackupError("zfs send of "+snapshot+" to"
-                                             + destination+" failed.")
-                except Exception as e:
-                    raise ZFSBackupError("Caught an exception while sending "+str(e))
-                logging.info("Finished send of "+snapshot+" via <"
-                             + transport.lower()+"> to "+destination)
-                             
-    elif get_transport_type(transport) == "ssh":
-        username, hostname, port = parse_ssh_transport(transport)
-        with run('zfs send', zsend_command, stdout=subprocess.PIPE, stderr=subprocess.PIPE) as zfs_send:
-            # TODO: have a configurable for ssh-key instead of just assuming
-            ssh_remote_command = "lz4 -d | zfs recv "+recv_flags+" "+destination
-            ssh_command = ['ssh', '-o', 'PreferredAuthentications=publickey',
-                           '-o', 'PubkeyAuthentication=yes',
-                           '-o', 'StrictHostKeyChecking=yes', '-p', port, '-l',
-                           username, hostname, ssh_remote_command]
-            with run("lz4 pipe", ["lz4"], stdin=zfs_send.stdout, stdout=subprocess.PIPE, stderr=subprocess.PIPE) as lz4:
-                with run('ssh recv', ssh_command, stdin=lz4.stdout, stderr=subprocess.PIPE) as ssh_recv:
-                    try:
-                        ssh_recv.wait()
-                        if ssh_recv.returncode != 0:
-                            lz4.kill()
-                            lz4.wait()
-                            zfs_send.kill()
-                            zfs_send.wait()
-                            raise ZFSBackupError("ssh recv of "+snapshot+" to "
-                                                + destination+" failed.")
-                        
-                        lz4.wait()
-                        if lz4.returncode != 0:
-                            zfs_send.kill()
-                            zfs_send.wait()
-                            raise ZFSBackupError(f"ssh send of {snapshot} to {destination} failed. lz4 errors: {lz4.stderr.read}")
-
-                        zfs_send.wait()
-                        if zfs_send.returncode != 0:
-                            raise ZFSBackupError("zfs send of "+snapshot+" to"
-                                                + destination+" failed.")
-                    except Exception as e:
-                        raise ZFSBackupError("Caught an exception while sending "+str(e))
-                    if (zfs_send.returncode != 0) or (ssh_recv.returncode != 0):
-                        # we failed somewhere
-                        raise ZFSBackupError("Send of "+snapshot+" to "
-                                            + destination+" failed.")
-                    logging.info("Finished send of "+snapshot+"via <"
-                                + transport.lower()+"> to "+destination)
-    else:
-        # some transport we don't support
-        # shouldn't happen with config parsing
-        # handle it anyway
-        raise ZFSBackupError("Invalid transport: "+transport)
+    encrypted = is_encrypted_dataset(snapshot)
+    tokens = __get_resume_tokens(destinations)
+    if dest_inventory:
+        # whatever happens next, what we know about them won't be true
+        dest_inventory.forget(destinations)
+    failed = []
+    # group destinations by the send stream they need
+    streams = {}
+    for d, token in zip(destinations, tokens):
+        send_flags = get_send_flags(d, encrypted)
+        # blocks that stay compressed don't need another compression pass
+        compressed = '-c' in send_flags or '-w' in send_flags
+        # always receive resumably, so an interrupted send can pick up
+        # where it left off next time
+        recv_flags = ['-s', '-F']
+        if encrypted:
+            recv_flags = ['-s']
+        if token:
+            if __resume_token_snapshot(token) == snapshot:
+                logging.info("Resuming interrupted send of "+snapshot+" to "
+                             + d.get('dest')+" via "+d.get('transport'))
+                # one stream per token, they can't be shared
+                streams[('zfs', 'send', '-t', token)] = [(d, recv_flags,
+                                                          compressed)]
+                continue
+            # left over from something we aren't sending anymore
+            if not __abort_partial_recv(d):
+                failed.append(d)
+                continue
+        zsend_command = ['zfs', 'send'] + send_flags
+        if incremental_source:
+            zsend_command += ['-i', incremental_source]
+        zsend_command.append(snapshot)
+        streams.setdefault(tuple(zsend_command), []).append((d, recv_flags,
+                                                             compressed))
 
+    for zsend_command, members in streams.items():
+        failed += __send_stream(snapshot, list(zsend_command), members)
+    return failed
 
-def send_full(snapshot, destination, transport='local'):
-    """Do a full send of snapshot specified by snapshot to destination
-    using transport. If transport is not provided, it's assumed to be local.
+
+def get_send_flags(dest, encrypted=False):
+    """Work out the zfs send flags for a destination from its send_flags,
+       which is either the name of one of SEND_PROFILES or a list of
+       flags out of -L, -e, -c and -w. Defaults to the compressed profile,
+       which keeps blocks compressed all the way to the destination pool.
+       Encrypted datasets are always sent raw.
+       param dest: dest dict
+       param encrypted: True if the dataset being sent is encrypted
+       returns: sorted list of send flags
+    """
+    if encrypted:
+        return ['-w']
+    flags = dest.get('send_flags', 'compressed')
+    if isinstance(flags, str):
+        flags = SEND_PROFILES[flags]
+    return sorted(flags)
+
+
+def __get_resume_tokens(destinations):
+    """Look up the receive_resume_token of every destination, from the
+       destination inventory or with one zfs get per host.
+       param destinations: list of dest dicts
+       returns: list of tokens in the same order as destinations, None
+       where there's nothing to resume
+    """
+    hosts = {}
+    tokens = {}
+    for d in destinations:
+        known = dest_inventory.dataset(d) if dest_inventory else None
+        if known is not None:
+            tokens[(d.get('transport').lower(), d.get('dest'))] = \
+                known['token']
+            continue
+        hosts.setdefault(d.get('transport').lower(), []).append(d.get('dest'))
+    for transport, datasets in hosts.items():
+        zfs_command = ['zfs', 'get', '-H', '-o', 'name,value',
+                       'receive_resume_token'] + datasets
+        host = 'localhost'
+        if get_transport_type(transport) == 'ssh':
+            user, host, port = parse_ssh_transport(transport)
+            zfs_command = ssh_pool.command(user, host, port,
+                                           ' '.join(zfs_command))
+        try:
+            # destinations that don't exist yet make this exit non-zero,
+            # but the ones that do are still listed
+            zfs = engine.run_command(zfs_command, host=host, check=False,
+                                     stderr=subprocess.DEVNULL)
+        except TimeoutExpired:
+            logging.warning("Timed out looking for resume tokens via "
+                            + transport)
+            continue
+        for line in __cleanup_stdout(zfs.stdout):
+            fields = line.split('\t')
+            if len(fields) == 2 and fields[1] not in ('-', ''):
+                tokens[(transport, fields[0])] = fields[1]
+    return [tokens.get((d.get('transport').lower(), d.get('dest')))
+            for d in destinations]
+
+
+def __resume_token_snapshot(token):
+    """Figure out which snapshot a receive_resume_token is for
+       param token: the receive_resume_token
+       returns: name of the snapshot (dataset@name), or None if the
+       token can't be resumed from here
+    """
+    try:
+        zfs = engine.run_command(['zfs', 'send', '-nv', '-t', token],
+                                 check=False, stderr=subprocess.STDOUT)
+    except TimeoutExpired:
+        return None
+    if zfs.returncode != 0:
+        logging.warning("Unable to resume from token: "+zfs.stdout.strip())
+        return None
+    match = re.search(r'^\s*toname = (\S+)$', zfs.stdout, re.MULTILINE)
+    return match.group(1) if match else None
+
+
+def __abort_partial_recv(dest):
+    """Throw away the partially received state at a destination
+       param dest: dest dict
+       returns: True if it was cleaned up, else False
+    """
+    zfs_command = ['zfs', 'recv', '-A', dest.get('dest')]
+    transport = dest.get('transport')
+    logging.warning("Discarding partial receive that can't be resumed at "
+                    + dest.get('dest')+" via "+transport)
+    try:
+        if get_transport_type(transport) == 'ssh':
+            user, host, port = parse_ssh_transport(transport)
+            __run_ssh_command(user, host, port, zfs_command)
+        else:
+            __run_command(zfs_command)
+        return True
+    except subprocess.SubprocessError:
+        logging.error("Unable to discard partial receive at "
+                      + dest.get('dest')+" via "+transport)
+        return False
+
+
+def __send_stream(snapshot, zsend_command, members):
+    """Run one zfs send and feed it to the receive pipeline of every member.
+    param snapshot: snapshot being sent
+    param zsend_command: the zfs send command to run
+    param members: list of (dest dict, recv flags, compressed) tuples
+    returns: list of the dest dicts the send failed for
+    """
+    # anything that might block (ssh masters, compression probes) is done
+    # here, the engine only starts processes
+    pipelines = [__recv_pipeline_commands(d, recv_flags, compressed)
+                 for d, recv_flags, compressed in members]
+    limiters = [__get_limiters(d) for d, r, c in members]
+    resources = ([('source_pool', snapshot.split('/')[0].split('@')[0])]
+                 + [__dest_resource(d) for d, r, c in members])
+    try:
+        results, mismatched = engine.call(
+            __send_stream_async(snapshot, zsend_command, members, pipelines,
+                                limiters, resources))
+    except TimeoutExpired:
+        logging.error("Send of "+snapshot+" took longer than "
+                      + str(engine.send_timeout)+"s, gave up on it.")
+        results, mismatched = [False for m in members], []
+    for i in mismatched:
+        # zfs recv took it, but it isn't what we sent
+        __discard_received(members[i][0], snapshot)
+    failed = []
+    for (d, recv_flags, compressed), ok in zip(members, results):
+        if ok:
+            logging.info("Finished send of "+snapshot+" via <"
+                         + d.get('transport').lower()+"> to "
+                         + d.get('dest'))
+            continue
+        logging.error("Send of "+snapshot+" to "+d.get('dest')+" via "
+                      + d.get('transport')+" failed.")
+        failed.append(d)
+    return failed
+
+
+async def __send_stream_async(snapshot, zsend_command, members, pipelines,
+                              limiters, resources):
+    """The part of __send_stream that runs on the engine. Once there's
+    room for it under the send limits, it has send_timeout to finish.
+    Sends only take send slots, see AsyncEngine.acquire_sends().
+    param pipelines: per member, the (tag, command) list of its receive
+    pipeline from __recv_pipeline_commands
+    param limiters: per member, the RateLimiters it has to stay under
+    param resources: (kind, name) pairs for the send limits
+    returns: (per member True if it got the whole stream, indexes of the
+    members that received a stream whose checksum didn't match)
+    throws: TimeoutExpired
+    """
+    send_slots = await engine.acquire_sends(resources)
+    try:
+        return await asyncio.wait_for(
+            __run_send_stream(snapshot, zsend_command, members, pipelines,
+                              limiters),
+            engine.send_timeout)
+    except asyncio.TimeoutError:
+        raise TimeoutExpired(zsend_command, engine.send_timeout)
+    finally:
+        engine.release(send_slots)
+
+
+async def __run_send_stream(snapshot, zsend_command, members, pipelines,
+                            limiters):
+    """Run the send itself, see __send_stream_async"""
+    stages = []
+    try:
+        try:
+            procs, relay = await __start_send(zsend_command, members,
+                                              pipelines, limiters, stages)
+        except (OSError, subprocess.SubprocessError) as e:
+            raise ZFSBackupError("Caught an exception while sending "+str(e))
+        zfs_send = stages[0]
+        results = [await __wait_pipeline(p) for p in procs]
+        digest = None
+        if relay:
+            # don't hold up the loop while the relay thread finishes
+            loop = asyncio.get_event_loop()
+            await loop.run_in_executor(None, relay.join)
+            sent, elapsed, rate = relay.stats()
+            logging.info("Sent "+str(sent)+" bytes of "+snapshot+" in "
+                         + "%.1fs (%.1f MiB/s)" % (elapsed, rate/1024/1024))
+            if relay.digest is not None:
+                digest = await loop.run_in_executor(None,
+                                                    relay.digest.hexdigest)
+        if not any(results):
+            # nobody is listening anymore
+            zfs_send.kill()
+        await zfs_send.wait()
+        if zfs_send.returncode != 0 and any(results):
+            # the stream itself is bad, so nobody got a good copy
+            zfs_send.log_stderr()
+            results = [False for r in results]
+        for p, ok in zip(procs, results):
+            if not ok:
+                for stage in p:
+                    if stage.returncode != 0:
+                        stage.log_stderr()
+        mismatched = []
+        for i, (member, p) in enumerate(zip(members, procs)):
+            if results[i] and member[0].get('checksum'):
+                if not __check_digest(snapshot, member[0], digest, p):
+                    results[i] = False
+                    mismatched.append(i)
+        return results, mismatched
+    finally:
+        # cancelled, timed out or broken: nothing gets left running
+        for stage in stages:
+            stage.kill()
+        for stage in stages:
+            await stage.wait()
+
+
+async def __start_send(zsend_command, members, pipelines, limiters, stages):
+    """Start zfs send and every receive pipeline, hooked up to each other
+       directly or through a relay.
+    param stages: list every started process is appended to, zfs send
+    first
+    returns: (list of receive pipelines, relay thread or None)
+    """
+    digest = None
+    if any(d.get('checksum') for d, r, c in members):
+        digest = StreamDigest()
+    send_out, send_in = os.pipe()
+    try:
+        stages.append(await engine.spawn('zfs send', zsend_command,
+                                         stdout=send_in))
+    finally:
+        os.close(send_in)
+    if len(members) == 1 and not members[0][0].get('relay') \
+            and not limiters[0] and not digest:
+        # nothing to fan out, hook the pipeline straight up to send
+        try:
+            return [await __start_recv_pipeline(pipelines[0], send_out,
+                                                stages)], None
+        finally:
+            os.close(send_out)
+    files = [os.fdopen(send_out, 'rb')]
+    procs = []
+    try:
+        for commands in pipelines:
+            recv_out, recv_in = os.pipe()
+            files.append(os.fdopen(recv_in, 'wb'))
+            try:
+                procs.append(await __start_recv_pipeline(commands, recv_out,
+                                                         stages))
+            finally:
+                os.close(recv_out)
+    except BaseException:
+        for f in files:
+            f.close()
+        raise
+    if len(members) == 1:
+        # relay the stream through us so we can see it go by
+        relay = StreamRelay(files[0], files[1], limiters=limiters[0],
+                            digest=digest)
+    else:
+        relay = StreamTee(files[0], [(f, p, l) for f, p, l
+                                     in zip(files[1:], procs, limiters)],
+                          digest=digest)
+    relay.start()
+    return procs, relay
+
+
+def __check_digest(snapshot, dest, digest, procs):
+    """Compare the checksum of what was sent with the one the receiving
+       side worked out.
+    param snapshot: snapshot that was sent
+    param dest: dest dict it was sent to
+    param digest: hex digest of the stream that was sent
+    param procs: the destination's receive pipeline
+    returns: True if they match, else False
+    """
+    received = None
+    for stage in procs:
+        match = re.search(br'^zfsbackup-digest ([0-9a-f]+)$', stage.stderr,
+                          re.MULTILINE)
+        if match:
+            received = match.group(1).decode()
+    if digest is not None and received == digest:
+        logging.info("Checksum of "+snapshot+" at "+dest.get('dest')+" via "
+                     + dest.get('transport')+" matches: "+digest)
+        return True
+    logging.error("Checksum mismatch for "+snapshot+" at "+dest.get('dest')
+                  + " via "+dest.get('transport')+": sent "+str(digest)
+                  + ", received "+str(received))
+    return False
+
+
+def __discard_received(dest, snapshot):
+    """Destroy a snapshot that was received, but not intact
+       param dest: dest dict it was received at
+       param snapshot: the source snapshot (dataset@name)
+       returns: True if it was destroyed, else False
+    """
+    zfs_command = ['zfs', 'destroy',
+                   dest.get('dest')+'@'+snapshot.split('@')[1]]
+    transport = dest.get('transport')
+    try:
+        if get_transport_type(transport) == 'ssh':
+            user, host, port = parse_ssh_transport(transport)
+            __run_ssh_command(user, host, port, zfs_command)
+        else:
+            __run_command(zfs_command)
+        return True
+    except subprocess.SubprocessError:
+        logging.error("Unable to destroy "+zfs_command[-1]+" via "
+                      + transport+" after its checksum didn't match")
+        return False
+
+
+def __get_limiters(dest):
+    """Find the rate limits a send to dest has to stay under: its own
+       bandwidth_limit, and the global one if it goes over ssh.
+       param dest: dest dict
+       returns: list of RateLimiters
+    """
+    limiters = []
+    if parse_rate_schedule(dest.get('bandwidth_limit')):
+        limiters.append(RateLimiter(dest.get('bandwidth_limit')))
+    if (bandwidth_limiter is not None
+            and get_transport_type(dest.get('transport')) == 'ssh'):
+        limiters.append(bandwidth_limiter)
+    return limiters
+
+
+def __recv_pipeline_commands(dest, recv_flags, compressed=False):
+    """Work out the receiving side of a send for a destination.
+    param dest: dest dict to receive into
+    param recv_flags: list of flags for zfs recv
+    param compressed: True if the stream carries compressed blocks
+    returns: list of (log tag, command) for the pipeline, first to last
+    """
+    destination = dest.get('dest')
+    transport = dest.get('transport')
+    if get_transport_type(transport) == 'local':
+        zrecv = [('zfs recv', ['zfs', 'recv'] + recv_flags + [destination])]
+        if dest.get('checksum'):
+            zrecv.insert(0, ('digest', [sys.executable, '-c',
+                                        RECV_DIGEST_SCRIPT]))
+        return zrecv
+    username, hostname, port = parse_ssh_transport(transport)
+    codec = get_codec(dest, compressed)
+    zrecv_command = ' '.join(['zfs recv'] + recv_flags + [destination])
+    if dest.get('checksum'):
+        zrecv_command = ('python3 -c '+shlex.quote(RECV_DIGEST_SCRIPT)
+                         + ' | '+zrecv_command)
+    if codec:
+        ssh_remote_command = codec.decompress_command()+' | '+zrecv_command
+    else:
+        ssh_remote_command = zrecv_command
+    # TODO: have a configurable for ssh-key instead of just assuming
+    ssh_command = ssh_pool.command(username, hostname, port,
+                                   ssh_remote_command)
+    if not codec:
+        return [('ssh recv', ssh_command)]
+    return [(codec.name+" pipe", codec.compress_command()),
+            ('ssh recv', ssh_command)]
+
+
+async def __start_recv_pipeline(commands, stdin, stages):
+    """Start a receive pipeline
+    param commands: (log tag, command) list from __recv_pipeline_commands
+    param stdin: fd the first process reads the stream from
+    param stages: list every started process is appended to
+    returns: list of the processes in the pipeline, first to last
+    """
+    procs = []
+    # read end of the pipe from the previous stage, ours to close
+    prev = None
+    try:
+        for i, (tag, command) in enumerate(commands):
+            out = into = None
+            if i < len(commands) - 1:
+                out, into = os.pipe()
+            try:
+                procs.append(await engine.spawn(tag, command, stdin=stdin,
+                                                stdout=into))
+            except BaseException:
+                if out is not None:
+                    os.close(out)
+                raise
+            finally:
+                if into is not None:
+                    os.close(into)
+            stages.append(procs[-1])
+            if prev is not None:
+                os.close(prev)
+            stdin = prev = out
+    finally:
+        if prev is not None:
+            os.close(prev)
+    return procs
+
+
+def __dest_resource(dest):
+    """returns: (kind, name) of what a destination counts against for the
+       send limits, its host for ssh, its pool for local ones"""
+    if get_transport_type(dest.get('transport')) == 'ssh':
+        return ('dest_host', parse_ssh_transport(dest.get('transport'))[1])
+    return ('dest_pool', dest.get('dest').split('/')[0])
+
+
+def get_codec(dest, compressed=False):
+    """Work out which compression to use for an ssh destination
+       param dest: dest dict, may have compression, compression_level
+       and compression_threads set. compression defaults to lz4.
+       param compressed: True if the stream already carries compressed
+       blocks, in which case there's no compression unless the
+       destination explicitly asks for a codec.
+       returns: Codec to use, or None for no compression
+    """
+    name = dest.get('compression', 'lz4')
+    if compressed and dest.get('compression') in (None, 'auto'):
+        return None
+    if name == 'auto':
+        user, host, port = parse_ssh_transport(dest.get('transport'))
+        codec = link_probe.pick_codec(user, host, port,
+                                      dest.get('compression_threads'))
+        if codec:
+            logging.info("Using "+codec.name+" compression for "
+                         + dest.get('dest')+" via "+dest.get('transport'))
+        return codec
+    if name == 'none':
+        return None
+    return Codec(name, dest.get('compression_level'),
+                 dest.get('compression_threads'))
+
+
+async def __wait_pipeline(procs):
+    """Wait for every process in a pipeline to finish. If the last stage
+    fails the earlier ones are killed so they can't hang around.
+    param procs: list of _Stages, first to last
+    returns: True if every process exited cleanly, False otherwise
+    """
+    await procs[-1].wait()
+    if procs[-1].returncode != 0:
+        for p in procs[:-1]:
+            p.kill()
+    for p in procs:
+        await p.wait()
+    return all(p.returncode == 0 for p in procs)
+
+
+def send_full(snapshot, destination, transport='local'):
+    """Do a full send of snapshot specified by snapshot to destination
+    using transport. If transport is not provided, it's assumed to be local.
     currently only local and ssh are supported as transports. ssh
     transport has form 'ssh:user@hostname<:port>'
     param snapshot: snapshot to send
@@ -549,32 +2199,72 @@ def has_stragglers(dataset):
        returns: True if stragglers are found, False otherwise
        throws: ZFSBackupError if unable to get list of snapshots
     """
-    snaps = get_snapshots(dataset)
-    regex = re.compile(".*@zfsbackup-\d{8}-\d{6}")
-    # this is likely not the best way to do this, but it shouldn't be too awful
-    matches = list(filter(regex.match, snaps))
-    if matches:
+    if get_stragglers(dataset):
         return True
     else:
         return False
 
 
+def get_stragglers(dataset):
+    """Returns the straggler zfsbackup-<datestamp> snapshots of dataset
+       param dataset: dataset to check
+       returns: list of straggler snapshots, oldest first
+       throws: ZFSBackupError if unable to get list of snapshots
+    """
+    snaps = get_snapshots(dataset)
+    regex = re.compile(".*@zfsbackup-\d{8}-\d{6}")
+    # this is likely not the best way to do this, but it shouldn't be too awful
+    return list(filter(regex.match, snaps))
+
+
+def get_bookmarks(dataset):
+    """returns: list of the bookmarks of a dataset (dataset#name)
+       throws: ZFSBackupError if they can't be listed
+    """
+    if inventory and inventory.has_dataset(dataset):
+        return inventory.get_bookmarks(dataset)
+    try:
+        return zfs_backend.list_bookmarks(dataset)
+    except CalledProcessError as e:
+        raise ZFSBackupError("Unable to get list of bookmarks for "+dataset
+                             + " Got: "+str(__cleanup_stdout(e.stderr)))
+    except TimeoutExpired:
+        raise ZFSBackupError("Unable to get list of bookmarks for "
+                             + dataset+". Timeout reached.")
+
+
+def incremental_base(dataset, inc_snap):
+    """Find what the next incremental of a dataset is sent from: the
+       inc_snap snapshot, or the bookmark it was turned into when
+       bookmarks are on, or the one that's replacing it.
+       param dataset: dataset to look at
+       param inc_snap: the incremental source snapshot (@name)
+       returns: dataset@name or dataset#name, None if neither is there
+       throws: ZFSBackupError if the dataset can't be looked at
+    """
+    if has_backuplast(dataset, inc_snap):
+        return dataset+inc_snap
+    bookmark = dataset+'#'+inc_snap[1:]
+    bookmarks = get_bookmarks(dataset)
+    if bookmark in bookmarks:
+        return bookmark
+    if bookmark+'-next' in bookmarks:
+        # the bookmark was being replaced when a backup was interrupted
+        return bookmark+'-next'
+    return None
+
+
 def get_snapshots(dataset):
     """returns a python list of snapshots for a dataset
        param dataset: dataset to enumerate snapshots for
        returns: list of snapshots
        throws: ZFSBackupError if unable to get list of snapshots
     """
+    if inventory and inventory.has_dataset(dataset):
+        return inventory.get_snapshots(dataset)
     # get list of snapshots
     try:
-        zfs_command = ['zfs', 'list', '-H', '-t', 'snapshot', '-d', '1',
-                       '-o', 'name', dataset]
-        zfs = subprocess.run(zfs_command, stdout=subprocess.PIPE,
-                             stderr=subprocess.PIPE, check=True, timeout=60,
-                             encoding='utf-8')
-        # remove empty lines and return a list with the contents of stdout
-        snaps = __cleanup_stdout(zfs.stdout)
-        return snaps
+        return zfs_backend.list_snapshots(dataset)
     except CalledProcessError as e:
         # command returned non-zero error code
         logging.error("Unable to get list of snapshots for " + dataset
@@ -592,10 +2282,14 @@ def is_encrypted_dataset(dataset):
       returns: true if encrypted, false otherwise
       throws ZFSBackupError if it can't figure it out
     """
+    encryption = None
+    if inventory:
+        encryption = inventory.get_property(dataset.split('@')[0], 'encryption')
+    if encryption is not None:
+        return encryption != "off"
     try:
-        zfs_command = ['zfs', 'get', '-H', '-d', '0', 'encryption', dataset]
-        results = __run_command(zfs_command)[0].split('\t')
-        return results[0] == dataset and results[1] == "encryption" and results[2] != "off"
+        encryption = zfs_backend.get_property(dataset, 'encryption')
+        return encryption is not None and encryption != "off"
     except CalledProcessError as e:
         logging.error("Unable to determine if dataset " + dataset
                       + " is encrypted or not.")
@@ -619,116 +2313,170 @@ def has_backuplast(dataset, inc_name):
     else:
         return False
 
-def clean_dest_snaps(destinations, global_retain_snaps=None):
+def clean_dest_snaps(destinations, global_retain_snaps=None,
+                     global_retain=None):
     """
-       delete all but the n snapshots from destinations per config
+       delete the snapshots destinations don't need to keep anymore per
+       config, see SnapshotIndex.expired()
+       destinations are cleaned up concurrently
        param destinations: list of destinations from config file
        param global_retain_snaps: number of snapshots that should be kept
        as defined by the retain_snaps global config param.
+       param global_retain: the retain global config param, dict of
+       period (hourly, daily, ...) -> how many of them to keep a
+       snapshot for
     """
     for dest in destinations:
-        dataset = dest.get('dest')
-        transport = dest.get('transport')
-        if dest.get('retain_snaps') is None and global_retain_snaps is None:
-            # We're not deleting anything
-            logging.info("Not cleaning up snaps for: "+dataset
-                         + " via " +transport)
-            return
-        elif dest.get('retain_snaps') is None:
-            num_snaps = global_retain_snaps
-        else:
-            num_snaps = dest.get('retain_snaps')
-        zfs_command = ['zfs', 'list', '-H', '-t', 'snapshot', '-d', '1',
-                       '-o', 'name', dataset]
-        if get_transport_type(transport) == 'local':
-            # local transport
-            try:
-                snaps = __snap_delete_format(__run_command(zfs_command), num_snaps)
-            except subprocess.SubprocessError:
-                logging.warning("Unable to get list of snapshots to delete from "
-                             + dataset + " via " + transport + ". Aborting "
-                             + "deletion.")
-                return
-            errors = 0
-            logging.info("Deleting "+str(len(snaps))+ " from "
-                         + dataset + " via " +transport)
-            for snap in snaps:
-                try:
-                    delete_snapshot(snap)
-                except ZFSBackupError:
-                    errors += 1
-            if errors > 0:
-                logging.warning("Encountered errors while deleting old snapshots" 
-                             + "from destination: "+dataset+" via "
-                             + transport)
-        elif get_transport_type(transport) == 'ssh':
-            # ssh transport
-            user, host, port  = parse_ssh_transport(transport)
+        if get_transport_type(dest.get('transport')) not in ('local', 'ssh'):
+            # unsupported transport
+            raise ZFSBackupError("Invalid transport: "+dest.get('transport'))
+    if not destinations:
+        # nothing was backed up, or it all failed
+        return
+    if dest_inventory:
+        dest_inventory.forget(destinations)
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=len(destinations)) as executor:
+        cleanups = [executor.submit(__clean_dest_snaps, dest,
+                                    global_retain_snaps, global_retain)
+                    for dest in destinations]
+        for cleanup in cleanups:
+            cleanup.result()
+
+
+def __clean_dest_snaps(dest, global_retain_snaps, global_retain=None):
+    """
+       delete the snapshots a single destination doesn't need anymore
+       param dest: destination dict from config file
+       param global_retain_snaps: number of snapshots that should be kept
+       as defined by the retain_snaps global config param.
+       param global_retain: the retain global config param
+    """
+    dataset = dest.get('dest')
+    transport = dest.get('transport')
+    num_snaps = dest.get('retain_snaps')
+    if num_snaps is None:
+        num_snaps = global_retain_snaps
+    rules = dest.get('retain')
+    if rules is None:
+        rules = global_retain
+    if num_snaps is None and not rules:
+        # We're not deleting anything
+        logging.info("Not cleaning up snaps for: "+dataset
+                     + " via " +transport)
+        return
+    # oldest first, so runs of expired snaps can be destroyed as a range
+    zfs_command = ['zfs', 'list', '-H', '-p', '-t', 'snapshot', '-d', '1',
+                   '-o', 'name,guid,creation', '-s', 'createtxg', dataset]
+    if get_transport_type(transport) == 'local':
+        # local transport
+        run_command = __run_command
+    else:
+        # ssh transport
+        user, host, port = parse_ssh_transport(transport)
+
+        def run_command(cmd, timeout=60):
+            return __run_ssh_command(user, host, port, cmd, timeout=timeout)
+    try:
+        index = SnapshotIndex.parse(run_command(zfs_command))
+        all_snaps = index.names
+        snaps = index.expired(num_snaps, rules)
+    except subprocess.SubprocessError:
+        logging.warning("Unable to get list of snapshots to delete from "
+                        + dataset + " via " + transport + ". Aborting "
+                        + "deletion.")
+        return
+    logging.info("Deleting "+str(len(snaps))+ " from "
+                 + dataset + " via " +transport)
+    errors = 0
+    for arg, batch in __destroy_batches(dataset, snaps, all_snaps):
+        try:
+            run_command(['zfs', 'destroy', arg], timeout=600)
+            continue
+        except subprocess.SubprocessError:
+            pass
+        # figure out which of them is the problem
+        for snap in batch:
             try:
-                snaps = __snap_delete_format(__run_ssh_command(user, host, port,
-                                             zfs_command), num_snaps)
+                run_command(['zfs', 'destroy', snap], timeout=180)
             except subprocess.SubprocessError:
-                logging.warning("Unable to get list of snapshots to delete from "
-                             + dataset + " via " + transport + ". Aborting "
-                             + "deletion.")
-                return
-            errors = 0
-            logging.info("Deleting "+str(len(snaps))+ " from "
-                         + dataset + " via " +transport)
-            for snap in snaps:
-                zfs_snap_delete = ['zfs', 'destroy', snap]
-                try:
-                    __run_ssh_command(user, host, port, zfs_snap_delete)
-                except subprocess.SubprocessError:
-                    errors += 1
-            if errors > 0:
-                logging.warning("Encountered errors while deleting old snapshots"
-                             + "from destination: "+dataset+" via "
-                             + transport)
-        else:
-            # unsupported transport
-            raise ZFSBackupError("Invalid transport: "+transport)
+                logging.error("Unable to destroy snapshot "+snap+" via "
+                              + transport)
+                errors += 1
+    if errors > 0:
+        logging.warning("Encountered errors while deleting old snapshots"
+                        + "from destination: "+dataset+" via "
+                        + transport)
 
 
-def __snap_delete_format(snaps, nsave):
+def __destroy_batches(dataset, snaps, all_snaps, max_length=32768):
     """
-       sort the list of snaps and pair down to those we want to delete
-       filters the list for the snap format we have
-       param snaps: list of snaps
-       param nsave: number of snaps to save
+       group snapshots into as few zfs destroy arguments as possible.
+       runs of snapshots that are next to each other in all_snaps become
+       a first%last range, everything else is comma separated.
+       param dataset: dataset the snapshots belong to
+       param snaps: snapshots to delete (dataset@name)
+       param all_snaps: every snapshot of dataset, oldest first
+       param max_length: longest argument to hand to a single zfs destroy
+       returns: list of (argument, list of snapshots it destroys) tuples
     """
-    regex = re.compile(".*@zfsbackup-\d{8}-\d{6}")
-    matches = list(filter(regex.match, snaps))
-    if len(matches) < nsave:
-        return []
-    return sorted(matches)[:len(matches)-nsave]
+    doomed = set(snaps)
+    runs = []
+    current = []
+    for snap in all_snaps:
+        if snap in doomed:
+            current.append(snap)
+        elif current:
+            runs.append(current)
+            current = []
+    if current:
+        runs.append(current)
 
+    batches = []
+    names = []
+    batch = []
+    length = len(dataset) + 1
+    for r in runs:
+        first = r[0].split('@')[1]
+        last = r[-1].split('@')[1]
+        name = first if len(r) == 1 else first+'%'+last
+        if names and length + len(name) + 1 > max_length:
+            batches.append((dataset+'@'+','.join(names), batch))
+            names = []
+            batch = []
+            length = len(dataset) + 1
+        names.append(name)
+        batch += r
+        length += len(name) + 1
+    if names:
+        batches.append((dataset+'@'+','.join(names), batch))
+    return batches
 
-def __run_command(command):
+
+def __run_command(command, timeout=60):
     """
        run a command
        param command: command to run
+       param timeout: seconds to wait for command to finish
        returns: the stdout returned from command as a list
     """
-    cmd = subprocess.run(command, stdout=subprocess.PIPE, check=True,
-                         encoding='utf8', timeout=60)
+    cmd = engine.run_command(command, timeout=timeout)
     return __cleanup_stdout(cmd.stdout)
 
 
-def __run_ssh_command(user, host, port, cmd):
+def __run_ssh_command(user, host, port, cmd, timeout=60):
     """
        do a command via ssh
        param user: username to run as
        param host: host to run on
-       param ssh_args: arguments to ssh
+       param port: port ssh listens on
        param cmd: command to run
+       param timeout: seconds to wait for command to finish
        returns: the stdout of the command
     """
-    ssh_inv = ['ssh', '-o', 'PreferredAuthentications=publickey',
-               '-o', 'PubkeyAuthentication=yes',
-               '-o', 'StrictHostKeyChecking=yes', '-p', port, '-l',
-               user, host, ' '.join(cmd)]
-    return __run_command(ssh_inv)
+    cmd = engine.run_command(ssh_pool.command(user, host, port, ' '.join(cmd)),
+                             timeout=timeout, host=host)
+    return __cleanup_stdout(cmd.stdout)
 
 
 def create_lockfile(path):
@@ -816,29 +2564,1900 @@ class ZFSBackupError(Exception):
         logging.error(message)
 
 
-class run(subprocess.Popen):
+class RateLimiter:
+    """Token bucket that keeps the streams sharing it under a byte rate.
+       The rate comes from a schedule and is looked at again every time
+       bytes are paid for, so a long send speeds up or slows down as the
+       schedule changes. Bursts are capped at one second worth of bytes.
+    """
 
-    def __init__(self, *args, **kwargs):
-        self.log_tag = args[0]
-        subprocess.Popen.__init__(self, *args[1:], **kwargs)
+    def __init__(self, schedule):
+        """Constructor
+           param schedule: a bandwidth_limit from the config, see
+           parse_rate_schedule()
+        """
+        self.schedule = parse_rate_schedule(schedule)
+        self.tokens = 0.0
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
 
-    def __enter__(self):
-        return self
+    def current_rate(self, now=None):
+        """returns: the rate in bytes/s that applies now, None if unlimited
+        """
+        if now is None:
+            now = datetime.now().time()
+        for start, end, rate in self.schedule:
+            if start == end:
+                # the whole day
+                return rate
+            if start < end:
+                if start <= now < end:
+                    return rate
+            elif now >= start or now < end:
+                # window wraps past midnight
+                return rate
+        return None
+
+    def consume(self, n):
+        """Pay for n bytes, sleeping for as long as it takes"""
+        with self.lock:
+            self.tokens -= n
+        while True:
+            with self.lock:
+                rate = self.current_rate()
+                now = time.monotonic()
+                if not rate:
+                    # unlimited right now, forget any debt
+                    self.tokens = 0.0
+                    self.stamp = now
+                    return
+                self.tokens = min(self.tokens + (now - self.stamp) * rate, rate)
+                self.stamp = now
+                if self.tokens >= 0:
+                    return
+                wait = -self.tokens / rate
+            # short naps so a schedule change is noticed
+            time.sleep(min(wait, 1.0))
+
+
+def parse_rate(rate):
+    """Turn a rate like 20M into bytes/s. K, M, G and T are powers of 1024.
+       param rate: rate as an int or string, 0, None or unlimited for no limit
+       returns: bytes/s, or None for unlimited
+       throws: ZFSBackupError if rate doesn't make sense
+    """
+    if rate is None or rate == 0 or str(rate).lower() == 'unlimited':
+        return None
+    match = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([kmgt]?)i?b?(?:/s)?\s*$',
+                     str(rate).lower())
+    if not match:
+        raise ZFSBackupError("Invalid rate: "+str(rate))
+    multiplier = 1024 ** ' kmgt'.index(match.group(2) or ' ')
+    return int(float(match.group(1)) * multiplier) or None
+
+
+def parse_interval(interval):
+    """Turn an interval like 15m into seconds. s, m, h and d suffixes are
+       understood, a plain number is seconds.
+       param interval: interval as a number or string
+       returns: seconds
+       throws: ZFSBackupError if interval doesn't make sense
+    """
+    match = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([smhd]?)\s*$',
+                     str(interval).lower())
+    if not match or float(match.group(1)) <= 0:
+        raise ZFSBackupError("Invalid interval: "+str(interval))
+    multiplier = {'': 1, 's': 1, 'm': 60, 'h': 3600, 'd': 86400}
+    return float(match.group(1)) * multiplier[match.group(2)]
+
+
+def parse_rate_schedule(schedule):
+    """Parse a bandwidth_limit from the config. That's either a single rate
+       that always applies, or a list of {start: HH:MM, end: HH:MM,
+       rate: ...} windows. Outside of every window there's no limit.
+       param schedule: the bandwidth_limit
+       returns: list of (start time, end time, bytes/s or None)
+       throws: ZFSBackupError if it doesn't make sense
+    """
+    if schedule is None:
+        return []
+    if not isinstance(schedule, list):
+        rate = parse_rate(schedule)
+        midnight = datetime.min.time()
+        return [(midnight, midnight, rate)] if rate else []
+    windows = []
+    for window in schedule:
+        try:
+            start = datetime.strptime(str(window['start']), '%H:%M').time()
+            end = datetime.strptime(str(window['end']), '%H:%M').time()
+        except (KeyError, TypeError, ValueError):
+            raise ZFSBackupError("Invalid bandwidth_limit window: "
+                                 + str(window))
+        windows.append((start, end, parse_rate(window.get('rate'))))
+    return windows
+
+
+class Codec:
+    """A compression stage for the ssh send pipeline, along with the
+       decompressor that runs on the receiving end.
+    """
+    # name: (compressor, decompressor, default level)
+    codecs = {'lz4': ('lz4', 'lz4 -d', 1),
+              'zstd': ('zstd', 'zstd -d', 3),
+              'gzip': ('gzip', 'gzip -d', 6),
+              # pigz writes gzip, and gzip is much more likely to be around
+              'pigz': ('pigz', 'gzip -d', 6)}
+
+    def __init__(self, name, level=None, threads=None):
+        """Constructor
+           param name: one of the keys of Codec.codecs
+           param level: compression level, codec default if None
+           param threads: compression threads for zstd and pigz, 0 or
+           None lets the compressor decide
+        """
+        if name not in self.codecs:
+            raise ZFSBackupError("Unknown compression: "+str(name))
+        self.name = name
+        self.level = level if level is not None else self.codecs[name][2]
+        self.threads = threads
+
+    def compress_command(self):
+        """returns: the compressor command as a list"""
+        command = [self.codecs[self.name][0], '-q', '-'+str(self.level)]
+        if self.name == 'zstd':
+            if self.level > 19:
+                command.append('--ultra')
+            command.append('-T'+str(self.threads or 0))
+        elif self.name == 'pigz' and self.threads:
+            command += ['-p', str(self.threads)]
+        return command
+
+    def decompress_command(self):
+        """returns: the decompressor command line for the remote end"""
+        return self.codecs[self.name][1]
+
+
+class LinkProbe:
+    """Measures how fast links and compressors are, for compression: auto.
+       A link is timed by pushing sample_size bytes through ssh to
+       cat > /dev/null, which also tells us which decompressors the other
+       end has. Compressors are timed on a sample that's half random and
+       half text, which is about as compressible as a typical stream.
+       Results are kept for the rest of the run.
+    """
+
+    def __init__(self, sample_size=16*1024*1024):
+        self.sample_size = sample_size
+        self.links = {}
+        self.compressors = {}
+        self.sample = None
+        self.lock = threading.Lock()
+
+    def pick_codec(self, user, host, port, threads=None):
+        """Choose the codec that gets the most data across the link per
+           second: each codec is limited by either its own throughput or
+           the link throughput divided by its ratio, whichever is lower.
+           param user: user to connect as
+           param host: host on the other end of the link
+           param port: ssh port
+           param threads: threads to give zstd and pigz
+           returns: the best Codec, None if no compression wins
+        """
+        link_speed, remote_tools = self.measure_link(user, host, port)
+        if not link_speed:
+            # couldn't measure, fall back to the old default
+            return Codec('lz4')
+        best = None
+        best_speed = link_speed
+        for name in ('zstd', 'pigz', 'lz4'):
+            decompressor = Codec.codecs[name][1].split()[0]
+            if (not shutil.which(Codec.codecs[name][0])
+                    or decompressor not in remote_tools):
+                continue
+            codec = Codec(name, threads=threads)
+            speed, ratio = self.measure_compressor(codec)
+            if not speed:
+                continue
+            effective = min(speed, link_speed * ratio)
+            if effective > best_speed:
+                best = codec
+                best_speed = effective
+        return best
+
+    def measure_link(self, user, host, port):
+        """returns: (bytes/s, set of compression tools on host), speed is
+           None if the link couldn't be measured
+        """
+        key = (user, host, port)
+        with self.lock:
+            if key not in self.links:
+                self.links[key] = self.__time_link(user, host, port)
+            return self.links[key]
+
+    def __time_link(self, user, host, port):
+        command = ssh_pool.command(user, host, port,
+                                   'cat > /dev/null && '
+                                   + 'for t in lz4 zstd gzip; '
+                                   + 'do command -v $t; done; true')
+        start = time.monotonic()
+        try:
+            probe = subprocess.run(command, input=os.urandom(self.sample_size),
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.DEVNULL,
+                                   timeout=120, check=True)
+        except (CalledProcessError, TimeoutExpired, OSError):
+            logging.warning("Unable to measure link to "+host)
+            return (None, set())
+        elapsed = time.monotonic() - start
+        tools = set(os.path.basename(t) for t in
+                    probe.stdout.decode('utf-8', 'replace').split())
+        return (self.sample_size / max(elapsed, 0.001), tools)
+
+    def measure_compressor(self, codec):
+        """returns: (bytes/s, compression ratio) of codec, (None, 1) if it
+           couldn't be measured
+        """
+        key = tuple(codec.compress_command())
+        with self.lock:
+            if key not in self.compressors:
+                if self.sample is None:
+                    with open(__file__, 'rb') as f:
+                        text = f.read()
+                    half = self.sample_size // 2
+                    self.sample = (os.urandom(half)
+                                   + (text * (half // len(text) + 1))[:half])
+                start = time.monotonic()
+                try:
+                    out = subprocess.run(list(key), input=self.sample,
+                                         stdout=subprocess.PIPE,
+                                         stderr=subprocess.DEVNULL,
+                                         timeout=120, check=True).stdout
+                    elapsed = time.monotonic() - start
+                    self.compressors[key] = (len(self.sample)
+                                             / max(elapsed, 0.001),
+                                             len(self.sample)
+                                             / max(len(out), 1))
+                except (CalledProcessError, TimeoutExpired, OSError):
+                    self.compressors[key] = (None, 1)
+            return self.compressors[key]
+
+
+class ZFSInventory:
+    """In memory index of datasets, their snapshots and the properties we
+       care about. Built from a single recursive zfs list and a single
+       zfs get at the start of a run, then kept up to date as snapshots
+       are created, renamed and destroyed so lookups never have to fork
+       zfs. Datasets that aren't in the index are left to the callers to
+       look up themselves.
+    """
+
+    def __init__(self):
+        # dataset -> {'snapshots': OrderedDict(name -> info),
+        #             'bookmarks': {name -> info}, 'props': {}}
+        self.datasets = {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def load(cls, datasets, properties=('encryption',)):
+        """Build an inventory of datasets and everything below them
+           param datasets: list of datasets to index
+           param properties: dataset properties to fetch
+           returns: the new ZFSInventory
+           throws: ZFSBackupError if zfs can't be run
+        """
+        inv = cls()
+        list_command = ['zfs', 'list', '-H', '-p', '-r',
+                        '-t', 'filesystem,volume,snapshot,bookmark',
+                        '-o', 'name,guid,createtxg,creation'] + list(datasets)
+        get_command = (['zfs', 'get', '-H', '-p', '-o', 'name,property,value',
+                        ','.join(properties)] + list(datasets))
+        # a dataset that doesn't exist makes zfs exit non-zero, but the
+        # rest are still listed. Missing ones just don't get indexed.
+        listing = inv.__run(list_command)
+        for line in listing:
+            fields = line.split('\t')
+            if len(fields) != 4:
+                continue
+            name, guid, createtxg, creation = fields
+            if '@' in name or '#' in name:
+                kind = 'snapshots' if '@' in name else 'bookmarks'
+                dataset = re.split('[@#]', name)[0]
+                if dataset in inv.datasets:
+                    inv.datasets[dataset][kind][name] = {
+                        'guid': guid, 'createtxg': int(createtxg),
+                        'creation': int(creation)}
+            else:
+                inv.datasets[name] = {'snapshots': collections.OrderedDict(),
+                                      'bookmarks': {},
+                                      'props': {'guid': guid}}
+        for line in inv.__run(get_command):
+            fields = line.split('\t')
+            if len(fields) == 3 and fields[0] in inv.datasets:
+                inv.datasets[fields[0]]['props'][fields[1]] = fields[2]
+        for info in inv.datasets.values():
+            info['snapshots'] = collections.OrderedDict(
+                sorted(info['snapshots'].items(),
+                       key=lambda snap: snap[1]['createtxg']))
+        return inv
+
+    def __run(self, command):
+        try:
+            zfs = engine.run_command(command, timeout=600, check=False)
+        except (TimeoutExpired, OSError) as e:
+            raise ZFSBackupError("Unable to build zfs inventory: "+str(e))
+        if zfs.returncode != 0:
+            logging.warning("zfs inventory is incomplete: "+zfs.stderr.strip())
+        return list(filter(None, zfs.stdout.split('\n')))
+
+    def has_dataset(self, dataset):
+        """returns: True if dataset is in the index"""
+        with self.lock:
+            return dataset in self.datasets
+
+    def get_snapshots(self, dataset):
+        """returns: list of snapshots of dataset, oldest first"""
+        with self.lock:
+            return list(self.datasets[dataset]['snapshots'])
+
+    def get_property(self, dataset, prop):
+        """returns: value of prop for dataset, None if it isn't indexed"""
+        with self.lock:
+            if dataset not in self.datasets:
+                return None
+            return self.datasets[dataset]['props'].get(prop)
+
+    def get_bookmarks(self, dataset):
+        """returns: list of bookmarks of dataset (dataset#name)"""
+        with self.lock:
+            return list(self.datasets[dataset]['bookmarks'])
+
+    def add_bookmark(self, bookmark, snapshot):
+        """Record a bookmark (dataset#name) made of snapshot"""
+        dataset = bookmark.split('#')[0]
+        with self.lock:
+            if dataset in self.datasets:
+                info = self.datasets[dataset]['snapshots'].get(snapshot)
+                self.datasets[dataset]['bookmarks'][bookmark] = dict(
+                    info or {'guid': None, 'createtxg': None,
+                             'creation': int(time.time())})
+
+    def remove_bookmark(self, bookmark):
+        """Forget a destroyed bookmark (dataset#name)"""
+        dataset = bookmark.split('#')[0]
+        with self.lock:
+            if dataset in self.datasets:
+                self.datasets[dataset]['bookmarks'].pop(bookmark, None)
+
+    def get_snapshot(self, snapshot):
+        """returns: guid/createtxg/creation of snapshot (or bookmark), None
+           if unknown"""
+        dataset = re.split('[@#]', snapshot)[0]
+        kind = 'bookmarks' if '#' in snapshot else 'snapshots'
+        with self.lock:
+            if dataset not in self.datasets:
+                return None
+            info = self.datasets[dataset][kind].get(snapshot)
+            return dict(info) if info else None
+
+    def add_snapshot(self, snapshot, guid=None):
+        """Record a newly created snapshot (dataset@name)"""
+        dataset = snapshot.split('@')[0]
+        with self.lock:
+            if dataset in self.datasets:
+                self.datasets[dataset]['snapshots'][snapshot] = {
+                    'guid': guid, 'createtxg': None,
+                    'creation': int(time.time())}
+
+    def remove_snapshot(self, snapshot):
+        """Forget a destroyed snapshot (dataset@name)"""
+        dataset = snapshot.split('@')[0]
+        with self.lock:
+            if dataset in self.datasets:
+                self.datasets[dataset]['snapshots'].pop(snapshot, None)
+
+    def rename(self, old, new):
+        """Follow a rename of a snapshot or a dataset"""
+        with self.lock:
+            if '@' in old:
+                dataset = old.split('@')[0]
+                if dataset not in self.datasets:
+                    return
+                snaps = self.datasets[dataset]['snapshots']
+                self.datasets[dataset]['snapshots'] = collections.OrderedDict(
+                    (new if name == old else name, info)
+                    for name, info in snaps.items())
+                return
+            for dataset in list(self.datasets):
+                if dataset == old or dataset.startswith(old+'/'):
+                    renamed = new+dataset[len(old):]
+                    info = self.datasets.pop(dataset)
+                    info['snapshots'] = collections.OrderedDict(
+                        (renamed+'@'+name.split('@')[1], snap)
+                        for name, snap in info['snapshots'].items())
+                    info['bookmarks'] = dict(
+                        (renamed+'#'+name.split('#')[1], mark)
+                        for name, mark in info['bookmarks'].items())
+                    self.datasets[renamed] = info
+
+
+class DestinationInventory:
+    """What the destinations of a run hold: the snapshots (guid and
+       createtxg, oldest first) and receive_resume_token of every
+       destination dataset, from one zfs list per transport, all of them
+       at once. A transport that could be listed doesn't need its
+       connection tested again. What's known about a destination is
+       forgotten as soon as something is sent to it or destroyed on it,
+       after that callers go and ask zfs themselves.
+    """
+    # longest zfs list command line we build
+    max_length = 65536
+
+    def __init__(self):
+        # (transport, dest) -> {'token': token or None,
+        #                       'snapshots': OrderedDict(name -> info)}
+        self.datasets = {}
+        # transports that answered
+        self.transports = set()
+        self.lock = threading.Lock()
+
+    def load(self, destinations):
+        """List destinations, one zfs list per transport. A transport that
+           can't be listed is left out, as if it was never asked about.
+           param destinations: list of dest dicts
+        """
+        names = {}
+        for d in destinations:
+            transport = d.get('transport').lower()
+            if get_transport_type(transport) not in ('local', 'ssh'):
+                continue
+            names.setdefault(transport, set()).add(d.get('dest'))
+        if not names:
+            return
+        commands = []
+        for transport, datasets in sorted(names.items()):
+            for chunk in self.__chunks(sorted(datasets)):
+                command = ['zfs', 'list', '-H', '-p', '-d', '1', '-t',
+                           'filesystem,volume,snapshot', '-o',
+                           'name,guid,createtxg,receive_resume_token'] + chunk
+                host = 'localhost'
+                if get_transport_type(transport) == 'ssh':
+                    # connecting blocks, so not on the engine
+                    user, host, port = parse_ssh_transport(transport)
+                    command = ssh_pool.command(user, host, port,
+                                               ' '.join(command))
+                commands.append((transport, chunk, command, host))
+
+        async def run_all():
+            return await asyncio.gather(
+                *[engine.command(command, timeout=600, host=host,
+                                 check=False)
+                  for transport, chunk, command, host in commands],
+                return_exceptions=True)
+        results = engine.call(run_all())
+        failed = set()
+        found = {}
+        for (transport, chunk, command, host), zfs in zip(commands, results):
+            # missing destinations make zfs exit 1, the rest are listed
+            if isinstance(zfs, Exception) or zfs.returncode not in (0, 1):
+                logging.warning("Unable to list the destinations via "
+                                + transport+", asking again later")
+                failed.add(transport)
+                continue
+            for dataset in chunk:
+                found[(transport, dataset)] = {
+                    'token': None, 'snapshots': collections.OrderedDict()}
+            for line in zfs.stdout.split('\n'):
+                fields = line.split('\t')
+                if len(fields) != 4:
+                    continue
+                name, guid, createtxg, token = fields
+                entry = found.get((transport, name.split('@')[0]))
+                if entry is None:
+                    # a child of a destination
+                    continue
+                if '@' in name:
+                    entry['snapshots'][name] = {'guid': guid,
+                                                'createtxg': int(createtxg)}
+                elif token not in ('-', ''):
+                    entry['token'] = token
+        for entry in found.values():
+            entry['snapshots'] = collections.OrderedDict(
+                sorted(entry['snapshots'].items(),
+                       key=lambda snap: snap[1]['createtxg']))
+        with self.lock:
+            for key, entry in found.items():
+                if key[0] not in failed:
+                    self.datasets[key] = entry
+            self.transports.update(set(names) - failed)
+
+    def __chunks(self, datasets):
+        chunks = [[]]
+        length = 0
+        for dataset in datasets:
+            if chunks[-1] and length + len(dataset) + 1 > self.max_length:
+                chunks.append([])
+                length = 0
+            chunks[-1].append(dataset)
+            length += len(dataset) + 1
+        return chunks
+
+    def reachable(self, transport):
+        """returns: True if transport was listed fine"""
+        with self.lock:
+            return transport.lower() in self.transports
+
+    def dataset(self, dest):
+        """returns: {'token': ..., 'snapshots': ...} of a destination, None
+           if it isn't known"""
+        with self.lock:
+            entry = self.datasets.get((dest.get('transport').lower(),
+                                       dest.get('dest')))
+            if entry is None:
+                return None
+            return {'token': entry['token'],
+                    'snapshots': collections.OrderedDict(entry['snapshots'])}
+
+    def snapshots(self, dest):
+        """returns: OrderedDict of the snapshots of a destination, oldest
+           first, name -> {'guid': ..., 'createtxg': ...}. None if it isn't
+           known."""
+        entry = self.dataset(dest)
+        return entry['snapshots'] if entry is not None else None
+
+    def forget(self, destinations):
+        """Drop what's known about destinations, they're being changed"""
+        with self.lock:
+            for d in destinations:
+                self.datasets.pop((d.get('transport').lower(),
+                                   d.get('dest')), None)
+
+
+class CLIBackend:
+    """Local zfs metadata operations done by running the zfs command line
+       tool, what zfsbackup has always done. Failures come out as
+       CalledProcessError or TimeoutExpired with zfs's complaint in stderr,
+       whichever backend is in use, so callers don't have to care.
+    """
+    name = 'cli'
+
+    def snapshot(self, snapshots, timeout=60):
+        """Create snapshots, atomically
+           param snapshots: list of dataset@name
+        """
+        engine.run_command(['zfs', 'snap'] + list(snapshots), timeout=timeout)
+
+    def destroy(self, snapshot, timeout=180):
+        """Destroy a snapshot (dataset@name) or bookmark (dataset#name)"""
+        engine.run_command(['zfs', 'destroy', snapshot], timeout=timeout)
+
+    def bookmark(self, snapshot, bookmark, timeout=60):
+        """Bookmark a snapshot (dataset@name) as dataset#name"""
+        engine.run_command(['zfs', 'bookmark', snapshot, bookmark],
+                           timeout=timeout)
+
+    def list_bookmarks(self, dataset, timeout=60):
+        """returns: list of bookmarks of dataset"""
+        zfs = engine.run_command(['zfs', 'list', '-H', '-t', 'bookmark',
+                                  '-d', '1', '-o', 'name', dataset],
+                                 timeout=timeout)
+        return list(filter(None, zfs.stdout.split('\n')))
+
+    def rename(self, old, new, timeout=60):
+        """Rename a dataset or snapshot"""
+        engine.run_command(['zfs', 'rename', old, new], timeout=timeout)
+
+    def list_snapshots(self, dataset, timeout=60):
+        """returns: list of snapshots of dataset, oldest first"""
+        zfs = engine.run_command(['zfs', 'list', '-H', '-t', 'snapshot',
+                                  '-d', '1', '-o', 'name', dataset],
+                                 timeout=timeout)
+        return list(filter(None, zfs.stdout.split('\n')))
+
+    def get_property(self, dataset, prop, timeout=60):
+        """returns: value of prop for dataset, None if zfs didn't say"""
+        zfs = engine.run_command(['zfs', 'get', '-H', '-p', '-d', '0',
+                                  '-o', 'name,property,value', prop, dataset],
+                                 timeout=timeout)
+        for line in filter(None, zfs.stdout.split('\n')):
+            fields = line.split('\t')
+            if len(fields) == 3 and fields[:2] == [dataset, prop]:
+                return fields[2]
+        return None
+
+
+class LibZFSCoreBackend(CLIBackend):
+    """Local zfs metadata operations as ioctls through pyzfs (libzfs_core),
+       no fork/exec per operation. Listing snapshots and reading properties
+       use calls libzfs_core only has in some builds, without them those
+       go to the command line tool like before.
+    """
+    name = 'libzfs_core'
+
+    def __init__(self, lzc):
+        """param lzc: the imported libzfs_core module"""
+        self.lzc = lzc
+        self.listing = True
+        self.props = True
+
+    def __call(self, command, func, *args):
+        """Run an lzc function, turning its errors into what the zfs
+           command would have done"""
+        try:
+            return func(*args)
+        except self.lzc.exceptions.ZFSError as e:
+            raise CalledProcessError(e.errno or 1, command, stderr=str(e))
+
+    def snapshot(self, snapshots, timeout=60):
+        self.__call(['zfs', 'snap'] + list(snapshots), self.lzc.lzc_snapshot,
+                    [s.encode() for s in snapshots])
+
+    def destroy(self, snapshot, timeout=180):
+        if '%' in snapshot or ',' in snapshot:
+            return CLIBackend.destroy(self, snapshot, timeout)
+        if '#' in snapshot:
+            return self.__call(['zfs', 'destroy', snapshot],
+                               self.lzc.lzc_destroy_bookmarks,
+                               [snapshot.encode()])
+        # destroy_snaps quietly skips snapshots that aren't there,
+        # zfs destroy complains
+        if not self.lzc.lzc_exists(snapshot.encode()):
+            raise CalledProcessError(1, ['zfs', 'destroy', snapshot],
+                                     stderr="could not find any snapshots "
+                                     + "to destroy; check snapshot names.")
+        self.__call(['zfs', 'destroy', snapshot], self.lzc.lzc_destroy_snaps,
+                    [snapshot.encode()], False)
+
+    def rename(self, old, new, timeout=60):
+        self.__call(['zfs', 'rename', old, new], self.lzc.lzc_rename,
+                    old.encode(), new.encode())
+
+    def bookmark(self, snapshot, bookmark, timeout=60):
+        self.__call(['zfs', 'bookmark', snapshot, bookmark],
+                    self.lzc.lzc_bookmark,
+                    {bookmark.encode(): snapshot.encode()})
+
+    def list_snapshots(self, dataset, timeout=60):
+        if self.listing:
+            try:
+                snaps = self.__call(['zfs', 'list', dataset],
+                                    self.lzc.lzc_list_snaps, dataset.encode())
+                names = [s.decode() for s in snaps]
+                # oldest first, like zfs list
+                return sorted(names, key=self.__createtxg)
+            except NotImplementedError:
+                self.listing = False
+        return CLIBackend.list_snapshots(self, dataset, timeout)
+
+    def get_property(self, dataset, prop, timeout=60):
+        if self.props:
+            try:
+                props = self.__call(['zfs', 'get', prop, dataset],
+                                    self.lzc.lzc_get_props, dataset.encode())
+                value = props.get(prop.encode(), props.get(prop))
+                if isinstance(value, bytes):
+                    return value.decode()
+                if isinstance(value, str):
+                    return value
+                # numeric index properties (encryption is one) need the
+                # names zfs get would print, leave those to it
+            except NotImplementedError:
+                self.props = False
+        return CLIBackend.get_property(self, dataset, prop, timeout)
+
+    def __createtxg(self, snapshot):
+        props = self.__call(['zfs', 'get', 'createtxg', snapshot],
+                            self.lzc.lzc_get_props, snapshot.encode())
+        return int(props.get(b'createtxg', props.get('createtxg', 0)))
+
+
+class SSHConnectionPool:
+    """Keeps one multiplexed ssh master connection open per
+       (user, host, port) so every command and stream in a run shares it
+       instead of doing its own key exchange. If a master can't be opened
+       commands fall back to plain connections.
+    """
+    # options every ssh invocation gets
+    ssh_options = ['-o', 'PreferredAuthentications=publickey',
+                   '-o', 'PubkeyAuthentication=yes',
+                   '-o', 'StrictHostKeyChecking=yes']
+
+    def __init__(self, persist='10m'):
+        """Constructor
+           param persist: how long an idle master sticks around (ControlPersist),
+           a safety net in case close_all() never gets called.
+        """
+        self.persist = persist
+        self.control_dir = None
+        self.masters = {}
+        self.locks = {}
+        self.lock = threading.Lock()
+
+    def command(self, user, host, port, remote_command):
+        """Build an ssh command that goes over the shared connection
+           param user: username to connect as
+           param host: host to connect to
+           param port: port ssh listens on
+           param remote_command: command to run on host
+           returns: ssh command as a list
+        """
+        control_path = self.connect(user, host, port)
+        if control_path:
+            mux = ['-o', 'ControlMaster=no', '-o', 'ControlPath='+control_path]
+        else:
+            mux = ['-o', 'ControlMaster=no', '-o', 'ControlPath=none']
+        return (['ssh'] + self.ssh_options + mux
+                + ['-p', port, '-l', user, host, remote_command])
+
+    def connect(self, user, host, port):
+        """Open the master connection for user@host:port if it isn't yet
+           returns: control socket path, or None if no master could be opened
+        """
+        key = (user, host, port)
+        with self.lock:
+            if self.control_dir is None:
+                self.control_dir = tempfile.mkdtemp(prefix='zfsbackup-ssh-')
+            key_lock = self.locks.setdefault(key, threading.Lock())
+        # only one master per host, but don't hold up the other hosts
+        with key_lock:
+            if key in self.masters:
+                return self.masters[key]
+            name = hashlib.sha1('@'.join(key).encode()).hexdigest()[:16]
+            control_path = os.path.join(self.control_dir, name)
+            master = (['ssh'] + self.ssh_options
+                      + ['-o', 'ControlMaster=yes',
+                         '-o', 'ControlPath='+control_path,
+                         '-o', 'ControlPersist='+self.persist,
+                         '-N', '-f', '-p', port, '-l', user, host])
+            try:
+                # stderr stays closed, the backgrounded master keeps it open
+                subprocess.run(master, check=True, timeout=60,
+                               stdin=subprocess.DEVNULL,
+                               stdout=subprocess.DEVNULL,
+                               stderr=subprocess.DEVNULL)
+            except (CalledProcessError, TimeoutExpired, OSError):
+                logging.warning("Unable to open shared ssh connection to "
+                                + user+"@"+host+":"+port
+                                + ", using a new connection per command.")
+                return None
+            self.masters[key] = control_path
+            return control_path
+
+    def close_all(self):
+        """Shut down every master connection."""
+        with self.lock:
+            for (user, host, port), control_path in self.masters.items():
+                try:
+                    subprocess.run(['ssh', '-o', 'ControlPath='+control_path,
+                                    '-O', 'exit', '-p', port, '-l', user,
+                                    host], timeout=60,
+                                   stdin=subprocess.DEVNULL,
+                                   stdout=subprocess.DEVNULL,
+                                   stderr=subprocess.DEVNULL)
+                except (TimeoutExpired, OSError):
+                    logging.warning("Unable to close shared ssh connection "
+                                    + "to "+host)
+            self.masters = {}
+            if self.control_dir:
+                shutil.rmtree(self.control_dir, ignore_errors=True)
+                self.control_dir = None
+
+    def check_all(self):
+        """Forget master connections that have gone away, so the next
+           command for that host opens a new one."""
+        with self.lock:
+            masters = list(self.masters.items())
+        for (user, host, port), control_path in masters:
+            try:
+                subprocess.run(['ssh', '-o', 'ControlPath='+control_path,
+                                '-O', 'check', '-p', port, '-l', user, host],
+                               check=True, timeout=60,
+                               stdin=subprocess.DEVNULL,
+                               stdout=subprocess.DEVNULL,
+                               stderr=subprocess.DEVNULL)
+            except (CalledProcessError, TimeoutExpired, OSError):
+                logging.info("Shared ssh connection to "+host+" is gone, "
+                             + "reopening it when it's next needed.")
+                with self.lock:
+                    self.masters.pop((user, host, port), None)
+
+
+class SnapshotIndex:
+    """The snapshots of one dataset, oldest first, as parallel lists of
+       names, guids and creation times, out of a single
+       zfs list -H -p -o name,guid,creation.
+    """
+    # the backup snapshots, the only ones retention ever expires
+    backup_regex = re.compile(r'.*@zfsbackup-\d{8}-\d{6}$')
+
+    def __init__(self, names=(), guids=(), creations=()):
+        """Constructor
+           param names: snapshot names (dataset@name), oldest first
+           param guids: their guids
+           param creations: their creation times, seconds since the epoch
+        """
+        self.names = list(names)
+        self.guids = list(guids)
+        self.creations = list(creations)
+
+    @classmethod
+    def parse(cls, lines):
+        """param lines: lines of zfs list -H -p -o name,guid,creation
+           output, oldest first
+           returns: SnapshotIndex
+        """
+        index = cls()
+        for line in lines:
+            fields = line.split('\t')
+            if len(fields) != 3 or not fields[2].isdigit():
+                continue
+            index.names.append(fields[0])
+            index.guids.append(fields[1])
+            index.creations.append(int(fields[2]))
+        return index
+
+    def __len__(self):
+        return len(self.names)
+
+    @staticmethod
+    def period(kind, creation):
+        """param kind: one of RETAIN_PERIODS
+           param creation: seconds since the epoch
+           returns: key for the hour/day/week/month/year it falls in,
+           local time
+        """
+        t = time.localtime(creation)
+        if kind == 'hourly':
+            return (t.tm_year, t.tm_yday, t.tm_hour)
+        if kind == 'daily':
+            return (t.tm_year, t.tm_yday)
+        if kind == 'weekly':
+            return datetime(t.tm_year, t.tm_mon, t.tm_mday).isocalendar()[:2]
+        if kind == 'monthly':
+            return (t.tm_year, t.tm_mon)
+        return (t.tm_year,)
+
+    def expired(self, keep_last=None, rules=None):
+        """Work out which backup snapshots aren't worth keeping, in one
+           pass from newest to oldest. A snapshot is kept if it's one of
+           the keep_last newest, or the newest of one of the last n
+           periods (hours, days, ...) that have one, for any of the
+           rules. The newest one is always kept, it's what the next
+           incremental builds on.
+           param keep_last: number of newest snapshots to keep
+           param rules: dict of period (see RETAIN_PERIODS) -> number of
+           periods to keep a snapshot for
+           returns: names of the snapshots to destroy, oldest first
+        """
+        backups = [i for i, name in enumerate(self.names)
+                   if self.backup_regex.match(name)]
+        rules = dict((kind, n) for kind, n in (rules or {}).items() if n)
+        keep_last = max(keep_last or 0, 1)
+        keep = set()
+        # per rule, the last period something was kept for and how many
+        last = {}
+        counts = dict.fromkeys(rules, 0)
+        for rank, i in enumerate(reversed(backups)):
+            if rank < keep_last:
+                keep.add(i)
+            for kind, n in rules.items():
+                if counts[kind] >= n:
+                    continue
+                period = self.period(kind, self.creations[i])
+                if period != last.get(kind):
+                    last[kind] = period
+                    counts[kind] += 1
+                    keep.add(i)
+        return [self.names[i] for i in backups if i not in keep]
+
+
+class RetryQueue:
+    """Datasets waiting for another go at the destinations they failed
+       for. Every retry waits twice as long as the one before it, starting
+       at retry_delay, with up to half of that added or taken away at
+       random so retries of things that failed together spread out. A
+       dataset gets at most max_attempts goes and nothing is retried once
+       retry_deadline has passed since the queue was made.
+    """
+
+    def __init__(self, conf=None):
+        """param conf: the global config"""
+        if conf is None:
+            conf = {}
+        self.max_attempts = conf.get('max_attempts', 3)
+        self.delay = parse_interval(conf.get('retry_delay', '1m'))
+        self.deadline = (time.monotonic()
+                         + parse_interval(conf.get('retry_deadline', '2h')))
+        # (due time, sequence number, dataset dict, attempt)
+        self.waiting = []
+        self.sequence = 0
+
+    def __bool__(self):
+        return bool(self.waiting)
+
+    def add(self, ds, failed, attempt, conf=None):
+        """Queue another go at a dataset for the destinations that failed
+           param ds: dataset dict that was backed up
+           param failed: dest dicts that failed in a way worth retrying
+           param attempt: number of the attempt that failed
+           param conf: the global config
+           returns: True if it was queued, False if it's out of chances
+        """
+        name = ds.get('dataset_name')
+        if not failed:
+            return False
+        if not ds.get('resume', (conf or {}).get('resume', True)):
+            # the retry picks up this attempt's snapshot like an
+            # interrupted backup would
+            logging.warning("Not retrying "+name+", resume is off")
+            return False
+        if attempt >= self.max_attempts:
+            logging.error("Giving up on "+name+" after "+str(attempt)
+                          + " attempts")
+            return False
+        delay = self.delay * 2 ** (attempt - 1)
+        delay += random.uniform(-delay / 2, delay / 2)
+        due = time.monotonic() + delay
+        if due > self.deadline:
+            logging.error("Not retrying "+name+", the next attempt would "
+                          + "start after retry_deadline")
+            return False
+        retry = dict(ds)
+        # the destinations that made it don't need doing again
+        retry['destinations'] = [d for d in ds.get('destinations')
+                                 if d in failed]
+        logging.warning("Retrying "+name+" to "
+                        + ', '.join(d.get('dest')+" via "+d.get('transport')
+                                    for d in retry['destinations'])
+                        + " in %.0fs (attempt %d of %d)"
+                        % (delay, attempt + 1, self.max_attempts))
+        self.sequence += 1
+        self.waiting.append((due, self.sequence, retry, attempt + 1))
+        self.waiting.sort(key=lambda w: w[:2])
+        return True
+
+    def next_due(self):
+        """returns: seconds until the next retry is due, None if there
+           aren't any"""
+        if not self.waiting:
+            return None
+        return max(self.waiting[0][0] - time.monotonic(), 0)
+
+    def pop_due(self):
+        """returns: list of (dataset dict, attempt) of the retries that
+           are due, taken off the queue"""
+        now = time.monotonic()
+        due = [(w[2], w[3]) for w in self.waiting if w[0] <= now]
+        self.waiting = [w for w in self.waiting if w[0] > now]
+        return due
+
+
+class Daemon:
+    """Backs up every dataset in a config on its own interval until told
+       to stop. The config is read once (again on SIGHUP), and the zfs
+       inventory, ssh connections and lockfile are kept for the whole
+       time instead of being set up for every run.
+    """
+    # how often to make sure the shared ssh connections are still there
+    ssh_check_interval = 300
+
+    def __init__(self, conf_path, conf, inc_snap, jobs=None):
+        """Constructor
+           param conf_path: path to the config, for reloads
+           param conf: the validated config
+           param inc_snap: name of the incremental snapshot (@name)
+           param jobs: --jobs, overrides max_workers from the config
+        """
+        self.conf_path = conf_path
+        self.inc_snap = inc_snap
+        self.jobs = jobs
+        self.conf = None
+        self.executor = None
+        self.workers = None
+        # dataset name -> time it's due next
+        self.next_run = {}
+        # dataset name -> future of the backup that's running
+        self.running = {}
+        # (dataset, dest, transport) -> time of its last good backup
+        self.last_success = {}
+        self.wakeup = threading.Event()
+        self.stopping = False
+        self.reload_requested = False
+        self.refresh_inventory = True
+        self.last_ssh_check = time.monotonic()
+        self.lock = threading.Lock()
+        self.configure(conf)
+
+    def configure(self, conf):
+        """Switch to conf, keeping the schedule of datasets it still has"""
+        self.conf = conf
+        apply_config(conf)
+        workers = self.jobs or conf.get('max_workers') or 1
+        if workers != self.workers:
+            if self.executor is not None:
+                # running jobs finish on the old one
+                self.executor.shutdown(wait=False)
+            self.executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=workers)
+            self.workers = workers
+        names = [ds.get('dataset_name') for ds in conf.get('datasets')]
+        with self.lock:
+            self.next_run = dict((name, self.next_run.get(name, 0))
+                                 for name in names)
+        self.refresh_inventory = True
+
+    def interval(self, ds):
+        """returns: seconds between backups of dataset config ds"""
+        return parse_interval(ds.get('interval')
+                              or self.conf.get('interval', DEFAULT_INTERVAL))
+
+    def reload(self):
+        """Re-read the config file, keeping the old one if it's broken"""
+        self.reload_requested = False
+        logging.info("Reloading config from "+self.conf_path)
+        try:
+            conf = validate_config(self.conf_path)
+        except (ZFSBackupError, OSError, yaml.YAMLError) as e:
+            logging.error("Keeping the old config, unable to load the new "
+                          + "one: "+str(e))
+            return
+        self.configure(conf)
+
+    def handle_signal(self, signum, frame):
+        if signum == signal.SIGHUP:
+            self.reload_requested = True
+        else:
+            self.stopping = True
+        self.wakeup.set()
+
+    def run(self):
+        """Back up datasets as they come due until SIGTERM or SIGINT. Backups
+           that are running when that arrives are finished first.
+        """
+        for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, self.handle_signal)
+        # the connections stay up between runs
+        ssh_pool.persist = 'yes'
+        logging.info("zfsbackup daemon started")
+        while True:
+            if self.reload_requested:
+                self.reload()
+            if self.stopping:
+                break
+            self.start_due()
+            self.wakeup.wait(self.seconds_to_next())
+            self.wakeup.clear()
+        logging.info("zfsbackup daemon stopping, waiting for running "
+                     + "backups")
+        with self.lock:
+            running = list(self.running.values())
+        concurrent.futures.wait(running)
+        self.executor.shutdown()
+
+    def start_due(self):
+        """Start backups of every dataset that is due and not running"""
+        now = time.time()
+        with self.lock:
+            due = [ds for ds in self.conf.get('datasets')
+                   if ds.get('dataset_name') not in self.running
+                   and self.next_run.get(ds.get('dataset_name'), 0) <= now]
+            idle = not self.running
+        if not due:
+            return
+        if self.refresh_inventory and idle:
+            # only when nothing is using it, a backup could be halfway
+            # through updating the old one
+            load_inventory([ds.get('dataset_name')
+                            for ds in self.conf.get('datasets')],
+                           config_destinations(self.conf.get('datasets')))
+            self.refresh_inventory = False
+        unchanged = find_unchanged(due, self.inc_snap, self.conf)
+        for ds in due:
+            name = ds.get('dataset_name')
+            if name in unchanged:
+                logging.info("Skipping "+name+", unchanged since its last "
+                             + "backup")
+                with self.lock:
+                    if name in self.next_run:
+                        self.next_run[name] = now + self.interval(ds)
+        due = [ds for ds in due if ds.get('dataset_name') not in unchanged]
+        if not due:
+            return
+        if time.monotonic() - self.last_ssh_check > self.ssh_check_interval:
+            ssh_pool.check_all()
+            self.last_ssh_check = time.monotonic()
+        if dest_inventory:
+            # the last backups forgot what they sent to
+            dest_inventory.load(config_destinations(due))
+        snaps = snapshot_datasets(resumable_datasets(due, self.conf))
+        # the datasets started together are verified together
+        verifier = SnapshotVerifier()
+        for ds in due:
+            name = ds.get('dataset_name')
+            job = submit_backup(self.submit, verifier, ds, self.inc_snap,
+                                self.conf, new_snap=snaps.get(name))
+            with self.lock:
+                self.running[name] = job
+            # runs right away if it's already over
+            job.add_done_callback(
+                lambda job, ds=ds, started=now: self.finished(ds, started,
+                                                              job))
+
+    def submit(self, fn, *args):
+        """Run a job on the current executor, a reload may replace it"""
+        return self.executor.submit(fn, *args)
+
+    def finished(self, ds, started, job):
+        """Schedule the next run of a dataset once its backup is over
+           param ds: dataset dict from the config
+           param started: time the backup was started
+           param job: future of its submit_backup()
+        """
+        name = ds.get('dataset_name')
+        try:
+            errors = job.result()
+        except Exception as e:
+            logging.error("Unexpected error while backing up "+name+": "
+                          + str(e))
+            errors = 1
+        finished = time.time()
+        if errors:
+            # whatever went wrong may have left the index behind
+            self.refresh_inventory = True
+            for d in ds.get('destinations'):
+                last = self.last_success.get((name, d.get('dest'),
+                                              d.get('transport')))
+                logging.warning("Last good backup of "+name+" to "
+                                + d.get('dest')+" was "
+                                + (datetime.fromtimestamp(last).isoformat()
+                                   if last else "not since we started"))
+        else:
+            for d in ds.get('destinations'):
+                self.last_success[(name, d.get('dest'),
+                                   d.get('transport'))] = finished
+        next_run = started + self.interval(ds)
+        with self.lock:
+            if name in self.next_run:
+                self.next_run[name] = next_run
+            self.running.pop(name, None)
+        logging.info("Next backup of "+name+" at "
+                     + datetime.fromtimestamp(next_run).isoformat())
+        self.wakeup.set()
+        return errors
+
+    def seconds_to_next(self):
+        """returns: seconds until the next idle dataset is due, at most a
+           minute so the clock is never trusted for long"""
+        with self.lock:
+            waiting = [t for name, t in self.next_run.items()
+                       if name not in self.running]
+        if not waiting:
+            # everything is running, a finished backup wakes us up
+            return 60
+        return min(60, max(0, min(waiting) - time.time()))
+
+
+class AsyncEngine:
+    """Runs every command and send pipeline as a task on one asyncio event
+       loop, living in a background thread. Tasks can be cancelled and
+       have their own timeouts, and how many run at once is limited
+       globally and per host, so a slow host only holds up its own work.
+       Sends have slots of their own, so a few long transfers can't keep
+       the short zfs get/list commands waiting. They can also be limited
+       per source pool, destination host and destination pool, so disks
+       don't get thrashed.
+       The rest of zfsbackup stays synchronous and waits on the tasks
+       through run_command() and call().
+    """
+
+    def __init__(self, max_commands=64, max_host_commands=16, max_sends=16,
+                 send_timeout=None, send_limits=None):
+        """Constructor
+           param max_commands: most commands/pipelines running at once
+           param max_host_commands: most of those for any one host
+           param max_sends: most sends running at once
+           param send_timeout: seconds a send may take, None for no limit
+           param send_limits: dict of kind (see SEND_LIMITS) -> most sends
+           at once for any one of that kind, None for no limit
+        """
+        self.max_commands = max_commands
+        self.max_host_commands = max_host_commands
+        self.max_sends = max_sends
+        self.send_timeout = send_timeout
+        self.send_limits = dict(send_limits or {})
+        self.loop = None
+        self.thread = None
+        self.lock = threading.Lock()
+        self.futures = set()
+        # only touched from the loop
+        self.global_slots = None
+        self.host_slots = {}
+        self.global_send_slots = None
+        self.send_slots = {}
+
+    def configure(self, max_commands=None, max_host_commands=None,
+                  send_timeout=None, send_limits=None, max_sends=None):
+        """Change the limits. Slots that are in use are resized, so what's
+           running already counts against the new limits."""
+        if max_commands:
+            self.max_commands = max_commands
+        if max_host_commands:
+            self.max_host_commands = max_host_commands
+        if max_sends:
+            self.max_sends = max_sends
+        self.send_timeout = send_timeout
+        if send_limits is not None:
+            self.send_limits = dict(send_limits)
+        if self.loop:
+            self.loop.call_soon_threadsafe(self.__resize_slots)
+
+    def __resize_slots(self):
+        if self.global_slots is not None:
+            self.global_slots.resize(self.max_commands)
+        for slots in self.host_slots.values():
+            slots.resize(self.max_host_commands)
+        if self.global_send_slots is not None:
+            self.global_send_slots.resize(self.max_sends)
+        for (kind, name), slots in self.send_slots.items():
+            # a limit that's gone lets everyone through
+            slots.resize(self.send_limits.get(kind) or float('inf'))
+
+    def __reset_slots(self):
+        self.global_slots = None
+        self.host_slots = {}
+        self.global_send_slots = None
+        self.send_slots = {}
+
+    def start(self):
+        """Start the event loop thread if it isn't running yet
+           returns: the event loop
+        """
+        with self.lock:
+            if self.loop is not None:
+                return self.loop
+            loop = asyncio.new_event_loop()
+            if (sys.version_info < (3, 8) and threading.current_thread()
+                    is threading.main_thread()):
+                # older pythons only reap children for a loop the main
+                # thread has pointed the child watcher at
+                asyncio.get_child_watcher().attach_loop(loop)
+            self.thread = threading.Thread(target=self.__run_loop,
+                                           args=(loop,), daemon=True,
+                                           name='zfsbackup-engine')
+            self.thread.start()
+            self.loop = loop
+            return loop
+
+    def __run_loop(self, loop):
+        asyncio.set_event_loop(loop)
+        loop.run_forever()
+
+    def close(self):
+        """Cancel whatever is still running and stop the loop"""
+        with self.lock:
+            loop, thread = self.loop, self.thread
+            self.loop = self.thread = None
+        if loop is None:
+            return
+        self.cancel_all()
+        loop.call_soon_threadsafe(self.__reset_slots)
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+
+    def cancel_all(self):
+        """Cancel every task that's waited on through call()"""
+        with self.lock:
+            futures = list(self.futures)
+        for future in futures:
+            future.cancel()
+
+    def call(self, coro, timeout=None):
+        """Run a coroutine on the loop and wait for it
+           param coro: coroutine to run
+           param timeout: seconds before it is cancelled, None for never
+           returns: whatever the coroutine returns
+           throws: TimeoutExpired if it timed out, whatever it raised
+        """
+        loop = self.start()
+        if timeout is not None:
+            coro = asyncio.wait_for(coro, timeout)
+        future = asyncio.run_coroutine_threadsafe(coro, loop)
+        with self.lock:
+            self.futures.add(future)
+        try:
+            return future.result()
+        except (asyncio.TimeoutError, concurrent.futures.TimeoutError):
+            raise TimeoutExpired('task', timeout)
+        except BaseException:
+            # we're not waiting anymore (interrupted), neither should it
+            future.cancel()
+            raise
+        finally:
+            with self.lock:
+                self.futures.discard(future)
+
+    async def acquire(self, hosts):
+        """Take the global slot and one for each of hosts, in the same
+           order everywhere so tasks can't deadlock on each other.
+           param hosts: host names, 'localhost' for this machine
+           returns: the slots to hand back to release()
+        """
+        if self.global_slots is None:
+            self.global_slots = _Slots(self.max_commands)
+        slots = [self.global_slots]
+        for host in sorted(set(hosts)):
+            if host not in self.host_slots:
+                self.host_slots[host] = _Slots(self.max_host_commands)
+            slots.append(self.host_slots[host])
+        return await self.__take(slots)
+
+    async def acquire_sends(self, resources):
+        """Take a send slot, and one for each resource there's a limit
+           for. These are apart from the command slots acquire() hands
+           out, so sends never hold up plain commands.
+           param resources: (kind, name) pairs, kind one of SEND_LIMITS
+           returns: the slots to hand back to release()
+        """
+        if self.global_send_slots is None:
+            self.global_send_slots = _Slots(self.max_sends)
+        slots = [self.global_send_slots]
+        for kind, name in sorted(set(resources)):
+            if not self.send_limits.get(kind):
+                continue
+            if (kind, name) not in self.send_slots:
+                self.send_slots[(kind, name)] = _Slots(
+                    self.send_limits[kind])
+            slots.append(self.send_slots[(kind, name)])
+        return await self.__take(slots)
+
+    async def __take(self, slots):
+        taken = []
+        try:
+            for slot in slots:
+                await slot.acquire()
+                taken.append(slot)
+        except BaseException:
+            self.release(taken)
+            raise
+        return taken
+
+    def release(self, slots):
+        for slot in slots:
+            slot.release()
+
+    async def command(self, command, timeout=60, host='localhost',
+                      input=None, check=True, stderr=subprocess.PIPE):
+        """Run a command to completion
+           param command: command to run
+           param timeout: seconds before it's killed, None for never
+           param host: host the command has to count against
+           param input: bytes to feed it on stdin
+           param check: raise CalledProcessError if it exits non-zero
+           param stderr: subprocess.PIPE, DEVNULL or STDOUT
+           returns: CompletedProcess with stdout/stderr as text
+           throws: CalledProcessError, TimeoutExpired, OSError
+        """
+        slots = await self.acquire([host])
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                *command, stdout=subprocess.PIPE, stderr=stderr,
+                stdin=subprocess.DEVNULL if input is None else subprocess.PIPE)
+            try:
+                out, err = await asyncio.wait_for(proc.communicate(input),
+                                                  timeout)
+            except BaseException as e:
+                if proc.returncode is None:
+                    proc.kill()
+                await proc.wait()
+                if isinstance(e, asyncio.TimeoutError):
+                    raise TimeoutExpired(command, timeout)
+                raise
+        finally:
+            self.release(slots)
+        out = out.decode('utf-8', 'replace')
+        err = err.decode('utf-8', 'replace') if err is not None else None
+        if check and proc.returncode != 0:
+            raise CalledProcessError(proc.returncode, command, output=out,
+                                     stderr=err)
+        return subprocess.CompletedProcess(command, proc.returncode, out, err)
+
+    def run_command(self, command, timeout=60, host='localhost', input=None,
+                    check=True, stderr=subprocess.PIPE):
+        """Blocking version of command(), same parameters"""
+        return self.call(self.command(command, timeout, host, input, check,
+                                      stderr))
+
+    async def spawn(self, tag, command, stdin=None, stdout=None):
+        """Start one process of a pipeline, its stderr is drained in the
+           background, see _Stage. The caller is responsible for the
+           slots.
+           param tag: what to call the process in the logs
+           param command: command to run
+           param stdin: fd for it to read from
+           param stdout: fd for it to write to
+           returns: _Stage
+        """
+        proc = await asyncio.create_subprocess_exec(
+            *command, stdin=stdin, stdout=stdout, stderr=subprocess.PIPE)
+        return _Stage(self, tag, command, proc)
+
+
+class SnapshotVerifier:
+    """Verifies the backups of a run together: everything sent to a host
+       is looked up with one zfs list once the last send to that host is
+       over. Backups tell it up front which destinations they'll send to,
+       and when their sends are done what to look up. They are handed the
+       listings to finish with once every host they sent to is listed.
+       Every expect() has to be followed by a done(), or that host never
+       gets listed.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # transport -> sends that haven't finished yet
+        self.sending = collections.Counter()
+        # backups waiting for listings, dicts of their 'lookups',
+        # 'callback', the 'listings' they got and the transports 'listed'
+        # or being listed for them
+        self.waiting = []
+
+    def expect(self, destinations):
+        """A backup to destinations has been started
+           param destinations: list of dest dicts
+        """
+        with self.lock:
+            for d in destinations:
+                self.sending[d.get('transport').lower()] += 1
+
+    def done(self, destinations, lookups=None, callback=None):
+        """The sends of a backup to destinations are over. If that was the
+           last one for a host, everything waiting on it is listed now, in
+           this thread.
+           param destinations: the dest dicts given to expect()
+           param lookups: dict of transport -> snapshot names to look for
+           param callback: called with the find_snapshots() listings of
+           lookups when they're in, None if there's nothing to verify
+        """
+        batch = {}
+        members = []
+        with self.lock:
+            for d in destinations:
+                self.sending[d.get('transport').lower()] -= 1
+            if callback is not None:
+                self.waiting.append({'lookups': lookups or {},
+                                     'callback': callback, 'listings': {},
+                                     'listed': set()})
+            for backup in self.waiting:
+                for transport, names in backup['lookups'].items():
+                    if transport in backup['listed'] \
+                            or self.sending[transport] > 0:
+                        continue
+                    backup['listed'].add(transport)
+                    batch.setdefault(transport, set()).update(names)
+                    members.append((backup, transport))
+        try:
+            listings = find_snapshots(batch)
+        except Exception as e:
+            # the backups waiting on it fail verification, not hang
+            listings = dict((transport, e) for transport in batch)
+        with self.lock:
+            for backup, transport in members:
+                backup['listings'][transport] = listings[transport]
+            ready = []
+            waiting = []
+            for backup in self.waiting:
+                if len(backup['listings']) == len(backup['lookups']):
+                    ready.append(backup)
+                else:
+                    waiting.append(backup)
+            self.waiting = waiting
+        for backup in ready:
+            backup['callback'](backup['listings'])
+
+
+class _Slots:
+    """A semaphore whose limit can be changed while slots are taken. Going
+       below what's in use makes new takers wait until enough have been
+       handed back. Only used from the engine's loop."""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.taken = 0
+        self.waiters = collections.deque()
+
+    async def acquire(self):
+        if self.taken < self.limit and not self.waiters:
+            self.taken += 1
+            return
+        waiter = asyncio.get_event_loop().create_future()
+        self.waiters.append(waiter)
+        try:
+            await waiter
+        except BaseException:
+            if waiter in self.waiters:
+                self.waiters.remove(waiter)
+            elif not waiter.cancelled():
+                # handed a slot just as we gave up
+                self.release()
+            raise
+
+    def release(self):
+        self.taken -= 1
+        self.__wake()
+
+    def resize(self, limit):
+        self.limit = limit
+        self.__wake()
+
+    def __wake(self):
+        while self.waiters and self.taken < self.limit:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                self.taken += 1
+                waiter.set_result(None)
+
+
+class _Stage:
+    """A pipeline process started by AsyncEngine.spawn(), with a task
+       draining its stderr as it's written so the process never blocks on
+       it. Every line is logged at debug level as it comes in, and the
+       last stderr_limit bytes are kept for error messages."""
+    # most stderr kept per process, older output is dropped
+    stderr_limit = 65536
+
+    def __init__(self, engine, tag, args, process):
+        self.engine = engine
+        self.log_tag = tag
+        self.args = args
+        self.process = process
+        self.stderr = bytearray()
+        # bytes that fell off the front of stderr
+        self.stderr_dropped = 0
+        self.drain = asyncio.ensure_future(self.__drain())
+
+    async def __drain(self):
+        partial = b''
+        while True:
+            data = await self.process.stderr.read(65536)
+            if not data:
+                break
+            self.stderr += data
+            extra = len(self.stderr) - self.stderr_limit
+            if extra > 0:
+                del self.stderr[:extra]
+                self.stderr_dropped += extra
+            lines = (partial + data).split(b'\n')
+            partial = lines.pop()[-self.stderr_limit:]
+            for line in lines:
+                self.__forward(line)
+        if partial:
+            self.__forward(partial)
+
+    def __forward(self, line):
+        logging.debug(self.log_tag+': '
+                      + line.decode('utf-8', 'replace').rstrip())
+
+    @property
+    def returncode(self):
+        return self.process.returncode
+
+    async def wait(self):
+        await self.process.wait()
+        await self.drain
+        return self.process.returncode
+
+    def kill(self):
+        """Kill the process, safe to call from any thread"""
+        if threading.current_thread() is self.engine.thread:
+            self.__kill()
+        elif self.engine.loop is not None:
+            self.engine.loop.call_soon_threadsafe(self.__kill)
+
+    def __kill(self):
+        if self.process.returncode is None:
+            try:
+                self.process.kill()
+            except ProcessLookupError:
+                pass
+
+    def log_stderr(self):
+        """Log whatever this process wrote to stderr, or the end of it."""
+        tag = self.log_tag + ' stderr:'
+        if self.stderr_dropped:
+            tag = (self.log_tag + ' stderr (last '+str(len(self.stderr))
+                   + ' bytes):')
+        logging.error(tag + self.stderr.decode('utf-8', 'replace'))
+
+
+class StreamRelay(threading.Thread):
+    """Moves a stream from one pipe to another inside our process, counting
+       bytes and keeping timestamps as it goes. Uses os.splice where it's
+       available so the data never gets copied into python, otherwise it
+       reads into one big reusable buffer. Both ends are closed when the
+       stream ends or either side goes away.
+    """
+    # fcntl.F_SETPIPE_SZ, which python only names from 3.10 on
+    F_SETPIPE_SZ = 1031
+
+    def __init__(self, source, sink, chunk_size=1024*1024, limiters=(),
+                 digest=None):
+        """Constructor
+           param source: file object to read the stream from
+           param sink: file object to write the stream to
+           param chunk_size: most bytes to move at once, the pipes are
+           grown to this size if the kernel lets us
+           param limiters: RateLimiters the stream has to stay under
+           param digest: StreamDigest to hash the stream with, needs the
+           data in python so there's no splicing
+        """
+        threading.Thread.__init__(self, daemon=True)
+        self.source = source
+        self.sink = sink
+        self.chunk_size = chunk_size
+        self.limiters = limiters
+        self.digest = digest
+        self.bytes = 0
+        self.started = None
+        self.last_activity = None
+        self.finished = None
+        self.error = None
+
+    def count(self, n):
+        """Account for n more bytes having gone through"""
+        now = time.monotonic()
+        if self.started is None:
+            self.started = now
+        self.last_activity = now
+        self.bytes += n
+        for limiter in self.limiters:
+            limiter.consume(n)
+
+    def stats(self):
+        """returns: (bytes moved, seconds from first byte to the last,
+           bytes/s)
+        """
+        if self.started is None:
+            return (0, 0.0, 0.0)
+        elapsed = (self.finished or self.last_activity) - self.started
+        return (self.bytes, elapsed, self.bytes / max(elapsed, 0.001))
+
+    def idle(self):
+        """returns: seconds since data last moved"""
+        return time.monotonic() - (self.last_activity or self.started
+                                   or time.monotonic())
+
+    def run(self):
+        src = self.source.fileno()
+        dst = self.sink.fileno()
+        for fd in (src, dst):
+            try:
+                fcntl.fcntl(fd, self.F_SETPIPE_SZ, self.chunk_size)
+            except OSError:
+                pass
+        if self.digest is not None:
+            self.digest.start()
+        try:
+            if self.digest is not None or not self.splice(src, dst):
+                self.copy(src, dst)
+        except OSError as e:
+            # one side or the other went away
+            self.error = e
+        finally:
+            self.finished = self.last_activity
+            if self.digest is not None:
+                self.digest.close()
+            for f in (self.source, self.sink):
+                try:
+                    f.close()
+                except OSError:
+                    pass
+
+    def splice(self, src, dst):
+        """Move everything with os.splice
+           returns: False if splice can't be used here, True when done
+        """
+        splice = getattr(os, 'splice', None)
+        if splice is None:
+            return False
+        while True:
+            try:
+                n = splice(src, dst, self.chunk_size)
+            except OSError as e:
+                if e.errno in (errno.EINVAL, errno.ENOSYS) and not self.bytes:
+                    return False
+                raise
+            if n == 0:
+                return True
+            self.count(n)
+
+    def copy(self, src, dst):
+        """Move everything through a reusable buffer, or through fresh
+           ones when the digest needs to hang on to them"""
+        buf = bytearray(self.chunk_size)
+        view = memoryview(buf)
+        while True:
+            if self.digest is None:
+                n = os.readv(src, [buf])
+            else:
+                chunk = os.read(src, self.chunk_size)
+                n = len(chunk)
+                view = memoryview(chunk)
+            if n == 0:
+                return
+            if self.digest is not None:
+                self.digest.update(chunk)
+            written = 0
+            while written < n:
+                written += os.write(dst, view[written:n])
+            self.count(n)
+
+
+class StreamTee(StreamRelay):
+    """Copies one stream to several sinks. Every sink gets its own writer
+       thread and a bounded queue, so a slow sink only holds the others
+       back until it has been stalled for stall_timeout seconds, at which
+       point it is dropped. A sink that errors out is dropped right away.
+       Dropped sinks get their processes killed.
+    """
+
+    def __init__(self, source, sinks, chunk_size=1024*1024, queue_depth=16,
+                 stall_timeout=600, digest=None):
+        """Constructor
+           param source: file object to read the stream from
+           param sinks: list of (file object, processes, limiters) tuples
+           to copy to, limiters being the RateLimiters for that sink
+           param chunk_size: max size of a single read from source
+           param queue_depth: number of chunks buffered per sink
+           param stall_timeout: seconds a sink may block before it's dropped
+           param digest: StreamDigest to hash the stream with
+        """
+        StreamRelay.__init__(self, source, None, chunk_size, digest=digest)
+        self.stall_timeout = stall_timeout
+        self.sinks = [_TeeSink(f, procs, limiters, queue_depth)
+                      for f, procs, limiters in sinks]
+
+    def run(self):
+        for sink in self.sinks:
+            sink.start()
+        if self.digest is not None:
+            self.digest.start()
+        active = list(self.sinks)
+        try:
+            while active:
+                chunk = os.read(self.source.fileno(), self.chunk_size)
+                if not chunk:
+                    break
+                self.count(len(chunk))
+                if self.digest is not None:
+                    self.digest.update(chunk)
+                for sink in list(active):
+                    if not sink.put(chunk, self.stall_timeout):
+                        logging.error("Dropping stalled or failed receiver: "
+                                      + str(sink.procs[-1].args))
+                        sink.drop()
+                        active.remove(sink)
+        except OSError as e:
+            logging.error("Error reading send stream: "+str(e))
+        finally:
+            self.finished = self.last_activity
+            if self.digest is not None:
+                self.digest.close()
+            # closing our end lets zfs send notice if nobody is left
+            self.source.close()
+            for sink in active:
+                if not sink.put(None, self.stall_timeout):
+                    sink.drop()
+            for sink in self.sinks:
+                sink.join()
+
+
+class StreamDigest(threading.Thread):
+    """blake2b of a stream, worked out on its own thread from the chunks a
+       relay hands it, so hashing overlaps with moving the data. hashlib
+       lets go of the GIL while it hashes anything bigger than a couple of
+       KiB. Started by the relay.
+    """
+
+    def __init__(self, queue_depth=16):
+        """param queue_depth: number of chunks that can be waiting"""
+        threading.Thread.__init__(self, daemon=True)
+        self.hash = hashlib.blake2b()
+        self.chunks = queue.Queue(maxsize=queue_depth)
+
+    def update(self, chunk):
+        """Queue the next chunk of the stream to be hashed"""
+        self.chunks.put(chunk)
+
+    def close(self):
+        """Mark the end of the stream"""
+        self.chunks.put(None)
+
+    def hexdigest(self):
+        """returns: the digest, once everything queued has been hashed"""
+        self.join()
+        return self.hash.hexdigest()
+
+    def run(self):
+        while True:
+            chunk = self.chunks.get()
+            if chunk is None:
+                return
+            self.hash.update(chunk)
+
+
+class _TeeSink(threading.Thread):
+    """Writer half of StreamTee, one per sink."""
+
+    def __init__(self, f, procs, limiters, queue_depth):
+        threading.Thread.__init__(self, daemon=True)
+        self.f = f
+        self.procs = procs
+        self.limiters = limiters
+        self.chunks = queue.Queue(maxsize=queue_depth)
+        self.failed = False
+
+    def put(self, chunk, timeout):
+        """Queue a chunk for this sink, None marks the end of the stream.
+           returns: False if the sink failed or didn't take it in time
+        """
+        if self.failed:
+            return False
+        try:
+            self.chunks.put(chunk, timeout=timeout)
+        except queue.Full:
+            return False
+        return True
+
+    def drop(self):
+        """Give up on this sink and kill its processes. Only called from
+           the thread feeding the sink, so there's always room for the
+           end of stream marker once the queue is emptied.
+        """
+        self.failed = True
+        for p in self.procs:
+            p.kill()
+        while True:
+            try:
+                self.chunks.get_nowait()
+            except queue.Empty:
+                break
+        self.chunks.put_nowait(None)
+
+    def run(self):
+        while True:
+            chunk = self.chunks.get()
+            if chunk is None:
+                break
+            if self.failed:
+                continue
+            try:
+                self.f.write(chunk)
+                for limiter in self.limiters:
+                    limiter.consume(len(chunk))
+            except (OSError, ValueError):
+                # receiver went away, swallow the rest so we don't block
+                self.failed = True
+        try:
+            self.f.close()
+        except OSError:
+            pass
+
+
+# shared by everything that talks ssh during a run
+ssh_pool = SSHConnectionPool()
+# index of the datasets being backed up, set up by main()
+inventory = None
+# what their destinations hold, set up by main()
+dest_inventory = None
+# link and compressor measurements for compression: auto
+link_probe = LinkProbe()
+# the global bandwidth_limit all ssh sends share, set up by main()
+bandwidth_limiter = None
+# local zfs metadata operations, main() picks one
+zfs_backend = CLIBackend()
+# runs every command and send, main() sets the limits
+engine = AsyncEngine()
 
-    def __exit__(self, exc_type, value, traceback):
-    
-        if isinstance(value, ZFSBackupError):
-            logging.error(self.log_tag + ' stderr:' + self.stderr.read().decode('utf-8'))
-    
-        if self.stdout:
-            self.stdout.close()
-            
-        if self.stderr:
-            self.stderr.close()
-        
-        self.kill()
-        self.wait()
-            
 
 if sys.version_info[0] != 3 or sys.version_info[1] < 6:
     print("This program requires at least Python 3.6")